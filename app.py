@@ -1,14 +1,10 @@
 import streamlit as st
 import re
-import time
-import utils
-from io import StringIO
-import nltk
+import metrics
+import preprocessing
 from streamlit_extras.let_it_rain import rain
 import random
 from datetime import datetime as dt
-import PyPDF2
-from huggingface_hub import HfApi, upload_file
 
 # Streamlit app
 def main():
@@ -31,15 +27,6 @@ def main():
     with st.sidebar:
         st.title("Plagiarism Checker ✅")
         st.write('This application developed to check the plagiarism of document provided.')
-        downloading_nltk_message = st.sidebar.empty()
-        downloading_nltk_message.subheader("Downloading nltk punkt")
-        progress_bar = st.sidebar.progress(0)
-        nltk.download('punkt')
-        nltk.download('stopwords')
-        nltk.download('punkt_tab')
-        progress_bar.progress(100)
-        progress_bar.empty()
-        downloading_nltk_message.empty()
             
     if 'page' not in st.session_state:
         st.session_state.page = "Home"
@@ -64,6 +51,34 @@ def main():
         apply_custom_css()
         show_about_page()
 
+    # NLTK data is checked once per process, after the page is drawn; it is only downloaded
+    # when missing (provision it with `python preprocessing.py --download`)
+    try:
+        with st.spinner("Preparing the text tools..."):
+            preprocessing.ensure_nltk_data()
+    except LookupError as e:
+        st.sidebar.error(str(e))
+
+# Shared corpus for every session in this process, loaded from disk only when it changes
+def load_corpus():
+    # The checking modules pull in scikit-learn and the document parsers, so they are imported on first use
+    import corpus_stats
+    import corpus_store
+    import hub_sync
+    store = corpus_store.get_store()
+    with st.spinner("Loading the data..."):
+        parts, vectorizer = store.get_parts()
+    # Periodic IDF / vocabulary refresh; the rebuilt base is queued for the hub like any segment
+    corpus_stats.get_scheduler(on_refit=lambda result: hub_sync.get_worker().mark_dirty(result['segment']))
+    stats = store.stats()
+    st.sidebar.caption(
+        f"Corpus v{stats['version']}: {stats['documents']} documents in {len(parts)} segment(s), "
+        f"{stats['matrix_bytes'] / 1e6:.1f} MB matrix ({stats['mapped_bytes'] / 1e6:.1f} MB memory-mapped), "
+        f"loaded {stats['loads']}x in {stats['total_load_seconds']:.2f}s, "
+        f"{stats['hits']} cache hits, peak RSS {stats['peak_rss_bytes'] / 1e6:.0f} MB"
+    )
+    return parts, vectorizer
+
 def show_home():
     st.title("Welcome to the Plagiarism Checker")
     st.write("This application helps you check your text for potential plagiarism.")
@@ -71,218 +86,108 @@ def show_home():
 
 def show_text_input():
     
-    st.sidebar.subheader("Downloading nltk punkt")
-    # Create an empty container for the loading message
-    loading_message = st.empty()
-    loading_message.write("Loading the data...")
-    progress_bar = st.sidebar.progress(0)
-    tfidf_matrix, vectorizer = utils.load_tfidf_data()
-    progress_bar.progress(100)
-    # Wait for 5 seconds
-    time.sleep(5)
-    # Hide the progress bar and the loading message
-    progress_bar.empty()
-    loading_message.empty()
+    load_corpus()
     
     st.header("Text Input")
     text = st.text_area("Paste your text here:", height=300)
+    metadata, within_course = show_metadata_inputs()
     if st.button("Check Plagiarism"):
         st.session_state['text_to_check'] = text
         st.success("Text submitted for plagiarism check!")
         
         if 'text_to_check' in st.session_state and st.session_state['text_to_check']:
-            student_report = st.session_state['text_to_check']
-            new_report_vector = vectorizer.transform([utils.preprocess(student_report)])
-            
-            similarities = utils.cosine_similarity(new_report_vector, tfidf_matrix)
-            threshold = 0.2
+            with metrics.trace() as stages:
+                check_report(st.session_state['text_to_check'], metadata=metadata, within_course=within_course)
+            show_timings(stages)
 
-            if max(similarities[0]) > threshold:
-                max_similarity_index = similarities[0].argmax()
-                max_similarity_score = similarities[0][max_similarity_index]
-                similarity_percentage = max_similarity_score * 100
-                
-                st.info(f"Plagiarism detected! Similarity score: {similarity_percentage:.2f}%")
-                st.write(f"This document closely matches the uploaded report, which is why it was flagged.")
-                
-                st.write(f"**Most Similar Document:** Document {max_similarity_index + 1}")
-            else:
-                st.success("Minor Or No plagiarism detected. Adding the report to the reference set.")
-                
-                # Append the new report to the TF-IDF matrix
-                tfidf_matrix = utils.append_to_tfidf_matrix(student_report, vectorizer, tfidf_matrix)
-                
-                # Save the updated matrix and vectorizer for future use
-                utils.save_tfidf_data(tfidf_matrix, vectorizer)
-                
-                # Upload the TF-IDF matrix & vectorizer to the huggingface
-                repo_id = "Isuru0x01/plagiarism_checker_tfidf"
-                # Upload the TF-IDF matrix file
-                upload_file(
-                    path_or_fileobj="tfidf_matrix.npz",
-                    path_in_repo="tfidf_matrix.npz",  # name the file in the repo
-                    repo_id=repo_id,
-                    repo_type="model"  # or 'dataset'
-                )
-                
-                # Upload the vectorizer file
-                upload_file(
-                    path_or_fileobj="tfidf_vectorizer.pkl",
-                    path_in_repo="tfidf_vectorizer.pkl",
-                    repo_id=repo_id,
-                    repo_type="model"
-                )
-            
+# Optional details stored with a report added to the reference set; the course can also narrow the check
+def show_metadata_inputs():
+    col1, col2 = st.columns(2)
+    submitter = col1.text_input("Student (optional)")
+    course = col2.text_input("Course (optional)")
+    within_course = st.checkbox("Only compare with reports from this course", disabled=not course)
+    return {'submitter': submitter.strip() or None, 'course': course.strip() or None}, within_course
+
+# Where the time of the last check went, so slow checks can be told apart
+def show_timings(stages):
+    if stages:
+        st.caption("Timings: " + ", ".join(f"{stage} {seconds * 1000:.0f} ms" for stage, seconds in stages.items()))
+
+# Score a report against the reference set, show the top matches and add it when it passes
+def check_report(report, threshold=0.2, k=5, data=None, metadata=None, within_course=False):
+    import checker
+    import documents
+    import utils
+    metadata = metadata or {}
+    filters = {'course': metadata['course']} if within_course and metadata.get('course') else None
+    analysis = checker.analyse_report(report, k=k, data=data, filters=filters)
+    result = checker.verdict(analysis, threshold)
+    if result['duplicate_of'] is not None:
+        label = documents.get_store().labels([result['duplicate_of']])[result['duplicate_of']]
+        st.info(f"This report is already in the reference set as {label}.")
+        return
+    matches = result['matches']
+    # Passages copied into otherwise original text
+    passages = result['passages']
+    # Documents reworded rather than copied, found by the optional paraphrase engine
+    paraphrases = result['paraphrases']
+    labels = documents.get_store().labels([index for index, _ in matches + paraphrases] +
+                                          [p.doc_id for p in passages])
+
+    if matches:
+        max_similarity_index, max_similarity_score = matches[0]
+        similarity_percentage = max_similarity_score * 100
+        
+        st.info(f"Plagiarism detected! Similarity score: {similarity_percentage:.2f}%")
+        st.write(f"This document closely matches the uploaded report, which is why it was flagged.")
+        
+        st.write(f"**Most Similar Document:** {labels[max_similarity_index]}")
+        # Documents added with their text can be compared side by side
+        highlighted = checker.highlight_match(report, max_similarity_index)
+        if highlighted is not None:
+            with st.expander("Text shared with the most similar document"):
+                st.markdown(highlighted[0])
+        if len(matches) > 1:
+            st.write("**Other Similar Documents:**")
+            for index, score in matches[1:]:
+                st.write(f"- {labels[index]}: {score * 100:.2f}%")
+    if paraphrases:
+        import semantic
+        st.warning("Possible paraphrasing of " +
+                   ", ".join(f"{labels[index]} ({score * 100:.0f}% of the text)" for index, score in paraphrases) + ".")
+        spans = semantic.get_index().paraphrased_spans(report, paraphrases[0][0])
+        if spans:
+            with st.expander(f"Passages reworded from {labels[paraphrases[0][0]]}"):
+                st.markdown(utils.highlight_spans(report, spans))
+    if passages:
+        sources = [labels[doc_id] for doc_id in sorted({passage.doc_id for passage in passages})]
+        st.warning(f"Copied passages detected from {', '.join(sources)}.")
+        st.markdown(utils.highlight_spans(report, [(p.query_start, p.query_end) for p in passages]))
+    if not result['flagged']:
+        st.success("Minor Or No plagiarism detected. Adding the report to the reference set.")
+        checker.add_report(report, analysis['vector'], submitter=metadata.get('submitter'),
+                           course=metadata.get('course'))
 
 def show_file_upload():
+    import extraction
+    import result_cache
     st.header("File Upload")
     uploaded_file = st.file_uploader("Choose a file", type=['txt', 'docx', 'pdf'])
-    # Create an empty container for the loading message
-    loading_message = st.sidebar.empty()
-    loading_message.write("Loading the data...")
-    progress_bar = st.sidebar.progress(0)
-    tfidf_matrix, vectorizer = utils.load_tfidf_data()
-    progress_bar.progress(100)
-    # Wait for 5 seconds
-    time.sleep(5)
-    # Hide the progress bar and the loading message
-    progress_bar.empty()
-    loading_message.empty()
+    metadata, within_course = show_metadata_inputs()
+    load_corpus()
     
     if uploaded_file is not None:
-        if uploaded_file.type == "text/plain":
-            new_report = StringIO(uploaded_file.getvalue().decode("utf-8")).read()
-            new_report_vector = vectorizer.transform([utils.preprocess(new_report)])
-            
-            similarities = utils.cosine_similarity(new_report_vector, tfidf_matrix)
-            threshold = 0.2
-
-            if max(similarities[0]) > threshold:
-                max_similarity_index = similarities[0].argmax()
-                max_similarity_score = similarities[0][max_similarity_index]
-                similarity_percentage = max_similarity_score * 100
-                
-                st.info(f"Plagiarism detected! Similarity score: {similarity_percentage:.2f}%")
-                st.write(f"This document closely matches the uploaded report, which is why it was flagged.")
-                
-                st.write(f"**Most Similar Document:** Document {max_similarity_index + 1}")
-                
-            else:
-                st.success("Minor Or No plagiarism detected. Adding the report to the reference set.")
-                
-                # Append the new report to the TF-IDF matrix
-                tfidf_matrix = utils.append_to_tfidf_matrix(new_report, vectorizer, tfidf_matrix)
-                
-                # Save the updated matrix and vectorizer for future use
-                utils.save_tfidf_data(tfidf_matrix, vectorizer)
-                
-                # Upload the TF-IDF matrix & vectorizer to the huggingface
-                repo_id = "Isuru0x01/plagiarism_checker_tfidf"
-                # Upload the TF-IDF matrix file
-                upload_file(
-                    path_or_fileobj="tfidf_matrix.npz",
-                    path_in_repo="tfidf_matrix.npz",  # name the file in the repo
-                    repo_id=repo_id,
-                    repo_type="model"  # or 'dataset'
-                )
-                
-                # Upload the vectorizer file
-                upload_file(
-                    path_or_fileobj="tfidf_vectorizer.pkl",
-                    path_in_repo="tfidf_vectorizer.pkl",
-                    repo_id=repo_id,
-                    repo_type="model"
-                )
-        elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-            
-            new_report = utils.preprocess(utils.read_word_file(uploaded_file))
-            new_report_vector = vectorizer.transform([utils.preprocess(new_report)])
-            
-            similarities = utils.cosine_similarity(new_report_vector, tfidf_matrix)
-            threshold = 0.8
-
-            if max(similarities[0]) > threshold:
-                max_similarity_index = similarities[0].argmax()
-                max_similarity_score = similarities[0][max_similarity_index]
-                similarity_percentage = max_similarity_score * 100
-                
-                st.info(f"Plagiarism detected! Similarity score: {similarity_percentage:.2f}%")
-                st.write(f"This document closely matches the uploaded report, which is why it was flagged.")
-                
-                st.write(f"**Most Similar Document:** Document {max_similarity_index + 1}")
-            else:
-                st.success("Minor Or No plagiarism detected. Adding the report to the reference set.")
-                
-                # Append the new report to the TF-IDF matrix
-                tfidf_matrix = utils.append_to_tfidf_matrix(new_report, vectorizer, tfidf_matrix)
-                
-                # Save the updated matrix and vectorizer for future use
-                utils.save_tfidf_data(tfidf_matrix, vectorizer)
-                
-                # Upload the TF-IDF matrix & vectorizer to the huggingface
-                repo_id = "Isuru0x01/plagiarism_checker_tfidf"
-                # Upload the TF-IDF matrix file
-                upload_file(
-                    path_or_fileobj="tfidf_matrix.npz",
-                    path_in_repo="tfidf_matrix.npz",  # name the file in the repo
-                    repo_id=repo_id,
-                    repo_type="model"  # or 'dataset'
-                )
-                
-                # Upload the vectorizer file
-                upload_file(
-                    path_or_fileobj="tfidf_vectorizer.pkl",
-                    path_in_repo="tfidf_vectorizer.pkl",
-                    repo_id=repo_id,
-                    repo_type="model"
-                )
-                
-        elif uploaded_file.type == "application/pdf":
-            pdf_reader = PyPDF2.PdfReader(uploaded_file)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text()
-                
-            new_report_vector = vectorizer.transform([utils.preprocess(text)])
-            
-            similarities = utils.cosine_similarity(new_report_vector, tfidf_matrix)
-            threshold = 0.2
-            
-            if max(similarities[0]) > threshold:
-                max_similarity_index = similarities[0].argmax()
-                max_similarity_score = similarities[0][max_similarity_index]
-                similarity_percentage = max_similarity_score * 100
-                
-                st.info(f"Plagiarism detected! Similarity score: {similarity_percentage:.2f}%")
-                st.write(f"This document closely matches the uploaded report, which is why it was flagged.")
-                
-                st.write(f"**Most Similar Document:** Document {max_similarity_index + 1}")
+        data = uploaded_file.getvalue()
+        with metrics.trace() as stages:
+            # A file uploaded before skips extraction
+            new_report = result_cache.get_cache().cached_text(data)
+            if new_report is None:
+                new_report = extraction.extract(data, filename=uploaded_file.name)
+            if uploaded_file.type == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+                check_report(new_report, threshold=0.8, data=data, metadata=metadata, within_course=within_course)
             else:
-                st.success("Minor Or No plagiarism detected. Adding the report to the reference set.")
-                
-                # Append the new report to the TF-IDF matrix
-                tfidf_matrix = utils.append_to_tfidf_matrix(new_report, vectorizer, tfidf_matrix)
-                
-                # Save the updated matrix and vectorizer for future use
-                utils.save_tfidf_data(tfidf_matrix, vectorizer)
-                
-                # Upload the TF-IDF matrix & vectorizer to the huggingface
-                repo_id = "Isuru0x01/plagiarism_checker_tfidf"
-                # Upload the TF-IDF matrix file
-                upload_file(
-                    path_or_fileobj="tfidf_matrix.npz",
-                    path_in_repo="tfidf_matrix.npz",  # name the file in the repo
-                    repo_id=repo_id,
-                    repo_type="model"  # or 'dataset'
-                )
-                
-                # Upload the vectorizer file
-                upload_file(
-                    path_or_fileobj="tfidf_vectorizer.pkl",
-                    path_in_repo="tfidf_vectorizer.pkl",
-                    repo_id=repo_id,
-                    repo_type="model"
-                )
+                check_report(new_report, data=data, metadata=metadata, within_course=within_course)
+        show_timings(stages)
 
 def show_about_page():
     # Application title and description
@@ -0,0 +1,175 @@
+"""
+Headless plagiarism checking for whole folders of submissions.
+
+Usage:
+    python batch.py submissions/ --output results.csv
+    python batch.py submissions.zip --output results.jsonl --jobs 8
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from scipy import sparse
+from scipy.sparse import vstack
+from sklearn.preprocessing import normalize
+
+import cohort
+import corpus_store
+import search
+import streaming
+
+SUPPORTED_EXTENSIONS = ('.txt', '.docx', '.pdf')
+CSV_FIELDS = ['submission', 'characters', 'corpus_match', 'corpus_score',
+              'peer_match', 'peer_score', 'flagged', 'error']
+
+
+# Paths of every supported file under a directory, in a stable order
+def collect_submissions(directory):
+    paths = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(SUPPORTED_EXTENSIONS) and not name.startswith('.'):
+                paths.append(os.path.join(root, name))
+    return sorted(paths)
+
+
+# Unpack a .zip or .tar(.gz) archive into a directory
+def extract_archive(archive_path, directory):
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            archive.extractall(directory)
+    elif tarfile.is_tarfile(archive_path):
+        with tarfile.open(archive_path) as archive:
+            archive.extractall(directory, filter='data')
+    else:
+        raise ValueError("Unsupported archive format. Use a .zip or .tar archive.")
+
+
+def vectorize_submissions(source, vectorizer, jobs=None, timeout=60):
+    """
+    Extracts and vectorizes every submission in a directory or archive.
+    Workers stream each document into its TF-IDF row, so no full text
+    reaches this process. Documents that fail get an empty row.
+
+    Returns:
+        tuple: (names, CSR matrix with one row per submission, characters
+        per submission, error per submission or None, extraction seconds)
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        if os.path.isdir(source):
+            directory = source
+        else:
+            extract_archive(source, tmp)
+            directory = tmp
+        paths = collect_submissions(directory)
+        start = time.perf_counter()
+        vectorized = list(streaming.vectorize_many(paths, vectorizer, workers=jobs, timeout=timeout))
+        extraction_seconds = time.perf_counter() - start
+        names = [os.path.relpath(path, directory) for path in paths]
+
+    empty = sparse.csr_matrix((1, len(vectorizer.vocabulary_)))
+    rows = [row if row is not None else empty for row, _, _ in vectorized]
+    submissions = vstack(rows, format='csr') if rows else sparse.csr_matrix((0, empty.shape[1]))
+    characters = [stats['characters'] if stats else 0 for _, stats, _ in vectorized]
+    errors = [error for _, _, error in vectorized]
+    return names, submissions, characters, errors, extraction_seconds
+
+
+def check_submissions(source, threshold=0.2, jobs=None, timeout=60, tfidf_matrix=None, vectorizer=None):
+    """
+    Checks every submission in a directory or archive against the reference
+    corpus and against each other.
+
+    Args:
+        source (str): Directory or .zip/.tar archive of .txt, .docx and .pdf files.
+        threshold (float): Scores above this flag a submission.
+        jobs (int): Worker processes for extraction and vectorising, defaults to all cores.
+        timeout (float): Seconds allowed per document before extraction is abandoned.
+        tfidf_matrix, vectorizer: Reference data; the shared corpus, with its
+            accepted reports and current vectorizer, if omitted.
+
+    Returns:
+        tuple: (list of result dicts, dict of timings)
+    """
+    if tfidf_matrix is None or vectorizer is None:
+        index = search.get_index(corpus_store.get_store())
+    else:
+        index = search.SearchIndex(tfidf_matrix, vectorizer)
+    # The index's own vectorizer, so the rows are weighted like the corpus they are scored against
+    vectorizer = index.vectorizer
+    names, submissions, characters, errors, extraction_seconds = vectorize_submissions(source, vectorizer, jobs, timeout)
+    if not names:
+        return [], {'documents': 0, 'extraction_seconds': extraction_seconds, 'scoring_seconds': 0.0}
+
+    # One sparse product per corpus segment; peers are scored block by block (see cohort.py)
+    start = time.perf_counter()
+    submissions = normalize(submissions)
+    corpus_best = [matches[0] if matches else (None, 0.0) for matches in index.search_many(submissions, k=1)]
+    _, (peer_match, peer_score) = cohort.all_pairs(submissions, threshold=threshold)
+    scoring_seconds = time.perf_counter() - start
+
+    results = []
+    for i, name in enumerate(names):
+        corpus_match, corpus_score = corpus_best[i]
+        peer = float(peer_score[i])
+        results.append({
+            'submission': name,
+            'characters': characters[i],
+            'corpus_match': None if corpus_match is None else corpus_match + 1,
+            'corpus_score': round(corpus_score, 6),
+            'peer_match': None if peer_match[i] < 0 else names[peer_match[i]],
+            'peer_score': round(peer, 6),
+            'flagged': corpus_score > threshold or peer > threshold,
+            'error': errors[i],
+        })
+
+    timings = {
+        'documents': len(results),
+        'extraction_seconds': extraction_seconds,
+        'scoring_seconds': scoring_seconds,
+    }
+    return results, timings
+
+
+# Write results as CSV or JSON lines depending on the file extension
+def write_results(results, output_path):
+    if output_path.endswith('.jsonl'):
+        with open(output_path, 'w', encoding='utf-8') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+    else:
+        with open(output_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check a folder or archive of submissions for plagiarism.")
+    parser.add_argument('source', help="Directory or .zip/.tar archive of .txt, .docx and .pdf files")
+    parser.add_argument('--output', default='results.csv', help="Results file (.csv or .jsonl)")
+    parser.add_argument('--threshold', type=float, default=0.2)
+    parser.add_argument('--jobs', type=int, default=None, help="Extraction worker processes")
+    parser.add_argument('--timeout', type=float, default=60, help="Seconds allowed per document")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    results, timings = check_submissions(args.source, threshold=args.threshold, jobs=args.jobs, timeout=args.timeout)
+    write_results(results, args.output)
+    total = time.perf_counter() - start
+
+    n = timings['documents']
+    flagged = sum(result['flagged'] for result in results)
+    print(f"Checked {n} submissions, {flagged} flagged, results in {args.output}", file=sys.stderr)
+    print(f"Extraction {timings['extraction_seconds']:.2f}s, scoring {timings['scoring_seconds']:.2f}s, "
+          f"total {total:.2f}s ({n / total if total else 0:.1f} docs/sec)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
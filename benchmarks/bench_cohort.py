@@ -0,0 +1,89 @@
+"""
+Scaling benchmark for cohort all-pairs similarity on synthetic cohorts.
+
+Each cohort has groups of planted near-copies (rows derived from one
+source with a share of their terms replaced), so the benchmark reports
+how many planted pairs are found as well as the time and peak memory of
+all_pairs() and clusters() for growing cohort sizes and block limits.
+
+Usage:
+    python benchmarks/bench_cohort.py --sizes 1000,5000,10000 --max-block-entries 1000000,20000000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+from cohort import all_pairs, clusters
+
+
+def make_cohort(n_docs, n_columns=100000, terms_per_doc=300, n_groups=10, group_size=4, changed=0.2, seed=2):
+    """
+    L2-normalised TF-IDF-like rows with planted groups of edited copies.
+
+    Terms are drawn uniformly, as IDF weighting leaves little weight on the
+    words every report shares. In each group, every copy replaces a share
+    of its source's terms with random ones.
+
+    Returns:
+        tuple: (csr matrix, set of planted (row, column) pairs with row < column)
+    """
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(0, n_columns, (n_docs, terms_per_doc))
+    data = rng.random((n_docs, terms_per_doc)) + 0.1
+    groups = rng.choice(n_docs, n_groups * group_size, replace=False).reshape(n_groups, group_size)
+    planted = set()
+    for group in groups:
+        for row in group[1:]:
+            indices[row], data[row] = indices[group[0]], data[group[0]]
+            replaced = rng.random(terms_per_doc) < changed
+            indices[row, replaced] = rng.integers(0, n_columns, replaced.sum())
+        members = sorted(group.tolist())
+        planted.update((a, b) for i, a in enumerate(members) for b in members[i + 1:])
+    cohort = sparse.csr_matrix((data.ravel(), indices.ravel(), np.arange(0, indices.size + 1, terms_per_doc)),
+                               shape=(n_docs, n_columns))
+    cohort.sum_duplicates()
+    return normalize(cohort), planted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1000,5000', help="Comma-separated cohort sizes")
+    parser.add_argument('--max-block-entries', default='1000000,20000000',
+                        help="Comma-separated block limits (scores computed at once)")
+    parser.add_argument('--columns', type=int, default=100000)
+    parser.add_argument('--terms', type=int, default=300, help="Terms per submission (before dedup)")
+    parser.add_argument('--groups', type=int, default=10, help="Planted groups per cohort")
+    parser.add_argument('--group-size', type=int, default=4)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    args = parser.parse_args()
+
+    limits = [int(n) for n in args.max_block_entries.split(',')]
+    print(f"threshold {args.threshold}, {args.groups} planted groups of {args.group_size}")
+    for size in (int(n) for n in args.sizes.split(',')):
+        cohort, planted = make_cohort(size, args.columns, args.terms, args.groups, args.group_size)
+        print(f"\n{size} submissions, {cohort.nnz} non-zeros, a dense N x N result would be "
+              f"{size * size * 8 / 2 ** 20:.0f} MB")
+        for limit in limits:
+            tracemalloc.start()
+            start = time.perf_counter()
+            pairs, _ = all_pairs(cohort, args.threshold, limit)
+            groups = clusters(size, pairs)
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            found = set(zip(pairs[0].tolist(), pairs[1].tolist()))
+            print(f"  block {limit:>10}   {seconds:7.2f}s   peak {peak / 2 ** 20:8.1f} MB   "
+                  f"{len(found)} pairs, {len(groups)} groups, "
+                  f"planted pairs found {len(found & planted)}/{len(planted)}")
+
+
+if __name__ == '__main__':
+    main()
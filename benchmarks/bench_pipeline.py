@@ -0,0 +1,355 @@
+"""
+Per-stage benchmark and profiler for the report check pipeline.
+
+Synthetic reports are generated from the vectorizer's own vocabulary, with
+passages copied from synthetic reference reports, then pushed through each
+stage the app runs: extraction (txt, docx, pdf), preprocessing,
+vectorizing, scoring (SearchIndex and the legacy full cosine_similarity),
+highlighting (fingerprint passages) and persistence (journaled segment
+appends and the fingerprint index). Every stage reports latency
+percentiles, throughput and the peak memory it allocates.
+
+Everything runs offline against the local tfidf_matrix.npz and
+tfidf_vectorizer.pkl; only the NLTK stopword list must be installed. Runs
+are seeded, so two runs with the same arguments process the same data.
+
+Usage:
+    python benchmarks/bench_pipeline.py --docs 20 --words 3000
+    python benchmarks/bench_pipeline.py --corpus-docs 2000 --json run.json --baseline previous.json
+    python benchmarks/bench_pipeline.py --profile profiles/ --stages vectorize,score
+"""
+import argparse
+import cProfile
+import io
+import json
+import os
+import pickle
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import scipy
+import sklearn
+from docx import Document
+from scipy import sparse
+from sklearn.metrics.pairwise import cosine_similarity
+
+import extraction
+import fingerprint
+import search
+import utils
+from journal import CorpusWriter
+from segments import SegmentStore
+
+FILLER = "the of and to in is that for with as on by this are be from it an".split()
+
+
+# Vocabulary terms ranked from most to least common (lowest IDF first)
+def ranked_terms(vectorizer):
+    terms = vectorizer.get_feature_names_out()
+    order = np.argsort(vectorizer.idf_, kind='stable')
+    return [terms[i] for i in order if terms[i].isalpha()]
+
+
+def make_text(rng, terms, n_words, exponent=1.1):
+    """
+    Zipf-distributed vocabulary words with filler words, punctuation and
+    paragraph breaks, roughly like a coursework report.
+    """
+    weights = np.cumsum(1.0 / np.arange(1, len(terms) + 1) ** exponent)
+    picks = np.searchsorted(weights, rng.random(n_words) * weights[-1])
+    words = []
+    for i, pick in enumerate(picks):
+        word = terms[pick] if rng.random() < 0.6 else FILLER[pick % len(FILLER)]
+        if i % 13 == 12:
+            word += rng.choice(['.', ',', ';'])
+        if i % 150 == 149:
+            word += '\n'
+        words.append(word)
+    return ' '.join(words)
+
+
+# Reference reports, and reports copying `copied` passages of 60 words from them
+def make_reports(terms, n_docs, n_words, n_references, copied=2, seed=0):
+    rng = np.random.default_rng(seed)
+    references = [make_text(rng, terms, n_words) for _ in range(n_references)]
+    reports = []
+    for _ in range(n_docs):
+        words = make_text(rng, terms, n_words).split(' ')
+        for _ in range(copied):
+            source = references[rng.integers(n_references)].split(' ')
+            start = int(rng.integers(max(1, len(source) - 60)))
+            at = int(rng.integers(max(1, len(words) - 60)))
+            words[at:at + 60] = source[start:start + 60]
+        reports.append(' '.join(words))
+    return references, reports
+
+
+def to_docx(text):
+    document = Document()
+    for paragraph in text.split('\n'):
+        document.add_paragraph(paragraph)
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+
+def _pdf_escape(line):
+    return line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def to_pdf(text, words_per_line=12, lines_per_page=55):
+    """
+    Minimal text-only PDF, one Helvetica text object per page.
+    """
+    words = text.split()
+    lines = [' '.join(words[i:i + words_per_line]) for i in range(0, len(words), words_per_line)]
+    pages = [lines[i:i + lines_per_page] for i in range(0, len(lines), lines_per_page)] or [[]]
+    page_ids = [4 + 2 * i for i in range(len(pages))]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % i for i in page_ids) + b"] /Count %d >>" % len(pages),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for page_id, page in zip(page_ids, pages):
+        stream = ("BT /F1 9 Tf 11 TL 40 800 Td " +
+                  ' '.join(f"({_pdf_escape(line)}) Tj T*" for line in page) + " ET").encode('latin-1', 'replace')
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (page_id + 1))
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    out.write(b"".join(b"%010d 00000 n \n" % offset for offset in offsets))
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+class Pipeline:
+    """
+    The stages under test, each a function of one report index, plus the
+    state they share (corpus, indexes and a scratch segment store).
+
+    Args:
+        tfidf_matrix (scipy.sparse matrix): Local reference matrix.
+        vectorizer (TfidfVectorizer): Local fitted vectorizer.
+        references (list): Synthetic reference reports, added to the corpus.
+        reports (list): Synthetic reports to check.
+        tokenizer (str): Tokenizer of the preprocessing stage.
+        k (int): Matches per report.
+        directory (str): Scratch folder for the persistence stages.
+    """
+
+    def __init__(self, tfidf_matrix, vectorizer, references, reports, tokenizer, k, directory):
+        self.vectorizer = vectorizer
+        self.reports = reports
+        self.tokenizer = tokenizer
+        self.k = k
+        self.directory = directory
+        self.files = {
+            'txt': [report.encode('utf-8') for report in reports],
+            'docx': [to_docx(report) for report in reports],
+            'pdf': [to_pdf(report) for report in reports],
+        }
+        self.preprocessed = [utils.preprocess(report, tokenizer) for report in reports]
+        self.vectors = [vectorizer.transform([text]) for text in self.preprocessed]
+        reference_rows = vectorizer.transform([utils.preprocess(text, tokenizer) for text in references])
+        self.corpus = sparse.vstack([tfidf_matrix, reference_rows], format='csr')
+        self.index = search.SearchIndex(self.corpus, vectorizer)
+        self.fingerprints = fingerprint.FingerprintIndex(path=os.path.join(directory, 'fingerprints.log'))
+        for row, text in enumerate(references, start=tfidf_matrix.shape[0]):
+            self.fingerprints.add(row, text)
+        self.fingerprints.find_passages(reports[0])
+        self.writer = CorpusWriter(SegmentStore(os.path.join(directory, 'segments')))
+        self.writer.initialize(self.corpus)
+        self.stages = {
+            'extract_txt': lambda i: extraction.extract(self.files['txt'][i], 'report.txt'),
+            'extract_docx': lambda i: extraction.extract(self.files['docx'][i], 'report.docx'),
+            'extract_pdf': lambda i: extraction.extract(self.files['pdf'][i], 'report.pdf'),
+            'preprocess': lambda i: utils.preprocess(self.reports[i], self.tokenizer),
+            'vectorize': lambda i: self.vectorizer.transform([self.preprocessed[i]]),
+            'score': lambda i: self.index.search_vector(self.vectors[i], k=self.k),
+            'score_legacy': lambda i: cosine_similarity(self.vectors[i], self.corpus),
+            'highlight': self.highlight,
+            'persist_append': self.persist_append,
+            'persist_fingerprints': self.persist_fingerprints,
+        }
+
+    # Bytes each stage reads per report, for throughput in MB/s
+    def input_bytes(self, stage, i):
+        if stage.startswith('extract_'):
+            return len(self.files[stage[len('extract_'):]][i])
+        return len(self.files['txt'][i])
+
+    def highlight(self, i):
+        passages = self.fingerprints.find_passages(self.reports[i])
+        return utils.highlight_spans(self.reports[i], [(p.query_start, p.query_end) for p in passages])
+
+    def persist_append(self, i):
+        self.writer.submit(self.vectors[i])
+        return self.writer.apply()
+
+    def persist_fingerprints(self, i):
+        self.fingerprints.add(self.corpus.shape[0] + i, self.reports[i])
+
+
+def time_stage(function, n_docs, repeats):
+    latencies = []
+    for _ in range(repeats):
+        for i in range(n_docs):
+            start = time.perf_counter()
+            function(i)
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+# Peak bytes traced while the stage runs once over every report
+def stage_peak_memory(function, n_docs):
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(n_docs):
+        function(i)
+    return tracemalloc.get_traced_memory()[1] - before
+
+
+def profile_stage(name, function, n_docs, directory, top=25):
+    """
+    Writes <stage>.prof (cProfile, for snakeviz or pstats) and
+    <stage>.tracemalloc.txt (largest allocation sites) for one pass.
+    """
+    profiler = cProfile.Profile()
+    profiler.enable()
+    for i in range(n_docs):
+        function(i)
+    profiler.disable()
+    profiler.dump_stats(os.path.join(directory, f"{name}.prof"))
+
+    before = tracemalloc.take_snapshot()
+    for i in range(n_docs):
+        function(i)
+    stats = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+    with open(os.path.join(directory, f"{name}.tracemalloc.txt"), 'w', encoding='utf-8') as f:
+        f.writelines(f"{stat}\n" for stat in stats[:top])
+
+
+def summarise(latencies, total_bytes, peak_bytes):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1e3
+    return {
+        'runs': len(latencies),
+        'mean_ms': float(latencies.mean() * 1e3),
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+        'docs_per_s': float(len(latencies) / latencies.sum()),
+        'mb_per_s': float(total_bytes / latencies.sum() / 1e6),
+        'peak_mb': peak_bytes / 1e6,
+    }
+
+
+def print_report(results, baseline=None):
+    header = f"{'stage':<22}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'docs/s':>10}{'MB/s':>9}{'peak MB':>9}"
+    if baseline:
+        header += f"{'p50 vs base':>13}"
+    print(header)
+    for stage, row in results.items():
+        line = (f"{stage:<22}{row['mean_ms']:10.3f}{row['p50_ms']:10.3f}{row['p95_ms']:10.3f}{row['p99_ms']:10.3f}"
+                f"{row['docs_per_s']:10.1f}{row['mb_per_s']:9.2f}{row['peak_mb']:9.2f}")
+        previous = (baseline or {}).get(stage)
+        if previous:
+            line += f"{(row['p50_ms'] / previous['p50_ms'] - 1) * 100:+12.1f}%"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--matrix', default='tfidf_matrix.npz')
+    parser.add_argument('--vectorizer', default='tfidf_vectorizer.pkl')
+    parser.add_argument('--docs', type=int, default=20, help="Synthetic reports pushed through each stage")
+    parser.add_argument('--words', type=int, default=3000, help="Words per synthetic report")
+    parser.add_argument('--corpus-docs', type=int, default=100,
+                        help="Synthetic reference reports added to the local corpus")
+    parser.add_argument('--repeats', type=int, default=3, help="Timed passes over the reports per stage")
+    parser.add_argument('--tokenizer', default='nltk', help="Tokenizer of the preprocessing stage (nltk or regex)")
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--stages', default=None, help="Comma-separated subset of stages")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--profile', default=None, help="Folder for cProfile and tracemalloc dumps per stage")
+    parser.add_argument('--json', default=None, help="Write the results to this file")
+    parser.add_argument('--baseline', default=None, help="Results file of an earlier run to compare against")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    tracemalloc.start()
+    tfidf_matrix = sparse.load_npz(args.matrix)
+    with open(args.vectorizer, 'rb') as f:
+        vectorizer = pickle.load(f)
+    load = {'seconds': time.perf_counter() - start, 'peak_mb': tracemalloc.get_traced_memory()[1] / 1e6}
+    tracemalloc.stop()
+    print(f"Loaded {tfidf_matrix.shape[0]} x {tfidf_matrix.shape[1]} corpus in {load['seconds'] * 1e3:.1f} ms "
+          f"({load['peak_mb']:.1f} MB peak)")
+
+    references, reports = make_reports(ranked_terms(vectorizer), args.docs, args.words, args.corpus_docs,
+                                       seed=args.seed)
+    with tempfile.TemporaryDirectory() as directory:
+        pipeline = Pipeline(tfidf_matrix, vectorizer, references, reports, args.tokenizer, args.k, directory)
+        stages = args.stages.split(',') if args.stages else list(pipeline.stages)
+        unknown = set(stages) - set(pipeline.stages)
+        if unknown:
+            parser.error(f"Unknown stages {sorted(unknown)}. Use any of {list(pipeline.stages)}.")
+        print(f"{args.docs} reports x {args.words} words, {pipeline.corpus.shape[0]} corpus rows, "
+              f"{args.repeats} passes per stage\n")
+
+        results = {}
+        for stage in stages:
+            function = pipeline.stages[stage]
+            # Warm-up pass, also the memory measurement
+            tracemalloc.start()
+            peak = stage_peak_memory(function, args.docs)
+            tracemalloc.stop()
+            latencies = time_stage(function, args.docs, args.repeats)
+            total_bytes = sum(pipeline.input_bytes(stage, i) for i in range(args.docs)) * args.repeats
+            results[stage] = summarise(latencies, total_bytes, peak)
+            if args.profile:
+                os.makedirs(args.profile, exist_ok=True)
+                tracemalloc.start()
+                profile_stage(stage, function, args.docs, args.profile)
+                tracemalloc.stop()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['stages']
+    print_report(results, baseline)
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"\nProcess peak RSS: {max_rss:.1f} MB")
+    if args.profile:
+        print(f"Profiles written to {args.profile}/")
+
+    if args.json:
+        run = {
+            'arguments': vars(args),
+            'environment': {
+                'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                'numpy': np.__version__, 'scipy': scipy.__version__, 'sklearn': sklearn.__version__,
+            },
+            'load': load,
+            'max_rss_mb': max_rss,
+            'stages': results,
+        }
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(run, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
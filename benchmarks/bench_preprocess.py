@@ -0,0 +1,88 @@
+"""
+Benchmark utils.preprocess against the original per-call implementation.
+
+Usage:
+    python benchmarks/bench_preprocess.py --docs 200 --words 3000
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from nltk.corpus import stopwords
+from nltk.tokenize import word_tokenize
+
+from preprocessing import Preprocessor
+
+WORDS = (
+    "the analysis of data shows that our model cannot perform well when the "
+    "training set is small however results improve with more samples and "
+    "careful tuning of parameters students should cite their sources and "
+    "explain methodology in detail including limitations future work and "
+    "ethical considerations regarding privacy fairness accountability"
+).split()
+
+
+# The original utils.preprocess, kept here as the baseline
+def legacy_preprocess(text):
+    if isinstance(text, str):
+        text = text.lower()
+    else:
+        text = ' '.join(text).lower()
+    text = text.translate(str.maketrans('', '', string.punctuation))
+    words = word_tokenize(text)
+    stop_words = set(stopwords.words('english'))
+    words = [word for word in words if word not in stop_words]
+    return ' '.join(words)
+
+
+# Synthetic coursework reports with punctuation and a few unicode quotes
+def make_reports(n_docs, n_words, seed=0):
+    rng = random.Random(seed)
+    reports = []
+    for _ in range(n_docs):
+        words = []
+        for i in range(n_words):
+            word = rng.choice(WORDS)
+            if i % 17 == 0:
+                word = word.capitalize()
+            if i % 11 == 0:
+                word += rng.choice([',', '.', ';', "'s", '!'])
+            if i % 97 == 0:
+                word = f"“{word}”"
+            words.append(word)
+        reports.append(' '.join(words))
+    return reports
+
+
+def bench(name, fn, reports):
+    start = time.perf_counter()
+    outputs = list(fn(reports))
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {len(reports) / elapsed:10.1f} docs/sec  ({elapsed:.3f}s)")
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--docs', type=int, default=200)
+    parser.add_argument('--words', type=int, default=3000)
+    args = parser.parse_args()
+
+    reports = make_reports(args.docs, args.words)
+    print(f"{args.docs} reports x {args.words} words")
+
+    baseline = bench('legacy preprocess', lambda texts: map(legacy_preprocess, texts), reports)
+    nltk_outputs = bench('Preprocessor(nltk)', Preprocessor('nltk').preprocess_many, reports)
+    regex_outputs = bench('Preprocessor(regex)', Preprocessor('regex').preprocess_many, reports)
+
+    print(f"nltk output matches legacy:  {nltk_outputs == baseline}")
+    print(f"regex output matches legacy: {regex_outputs == baseline}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Latency and accuracy benchmark for the paraphrase engine with a budget.
+
+Synthetic reference reports are generated from the vectorizer's vocabulary
+(see bench_pipeline.py) and indexed by semantic.SemanticIndex. The queries
+are reworded copies of references: their sentences are shuffled and a
+share of their words are misspelt or given another ending, so TF-IDF
+loses the changed words. For growing batch sizes, the benchmark reports
+the per-report latency of TF-IDF search plus rerank_many(), and how often
+the true source ranks first by TF-IDF and after re-ranking. It also
+reports the error of the int8 vectors and how often the IVF lists, and an
+exhaustive search, find the source among a query's chunk neighbours.
+
+Exits with status 1 when the p99 latency per report exceeds the budget.
+
+Usage:
+    python benchmarks/bench_semantic.py --corpus-docs 2000 --batches 1,8,32 --budget-ms 100
+"""
+import argparse
+import os
+import pickle
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+
+import preprocessing
+import semantic
+import utils
+from bench_pipeline import make_text, ranked_terms
+from search import SearchIndex
+
+
+def reword(rng, text, share):
+    """
+    Shuffles the sentences of a text and misspells or re-inflects a share of its longer words.
+    """
+    sentences = re.split(r'(?<=[.;])\s+', text)
+    rng.shuffle(sentences)
+
+    def change(match):
+        word = match.group()
+        if rng.random() >= share:
+            return word
+        if rng.random() < 0.5:
+            return word.rstrip('s') + rng.choice(['ing', 'ed', 's', 'ion'])
+        i = int(rng.integers(1, len(word) - 1))
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    return re.sub(r'[a-z]{5,}', change, ' '.join(sentences))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--vectorizer', default='tfidf_vectorizer.pkl')
+    parser.add_argument('--corpus-docs', type=int, default=2000, help="Indexed reference reports")
+    parser.add_argument('--words', type=int, default=800, help="Words per report")
+    parser.add_argument('--queries', type=int, default=64)
+    parser.add_argument('--share', type=float, default=0.6, help="Share of longer words changed in a query")
+    parser.add_argument('--batches', default='1,8,32', help="Comma-separated reports re-ranked together")
+    parser.add_argument('--candidates', type=int, default=semantic.CANDIDATES, help="TF-IDF matches re-ranked")
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--budget-ms', type=float, default=150, help="p99 budget per report")
+    parser.add_argument('--tokenizer', default='nltk', choices=['nltk', 'regex'], help="Preprocessing tokenizer")
+    args = parser.parse_args()
+
+    with open(args.vectorizer, 'rb') as f:
+        vectorizer = pickle.load(f)
+    rng = np.random.default_rng(0)
+    terms = ranked_terms(vectorizer)
+    references = [make_text(rng, terms, args.words) for _ in range(args.corpus_docs)]
+    sources = rng.choice(len(references), args.queries, replace=False)
+    queries = [reword(rng, references[i], args.share) for i in sources]
+
+    embedder = semantic.HashedEmbedder(args.dim, vectorizer=vectorizer,
+                                       stop_words=preprocessing.get_preprocessor('regex').stop_words)
+    index = semantic.SemanticIndex(embedder, nprobe=args.nprobe)
+    start = time.perf_counter()
+    index.add_many(range(len(references)), references)
+    embed_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    index.rebuild(max(1, int(np.sqrt(len(index)))))
+    train_seconds = time.perf_counter() - start
+    print(f"{len(references)} references, {len(index)} chunks embedded in {embed_seconds:.2f}s "
+          f"({len(index) / embed_seconds:.0f} chunks/s), {len(index.centroids)} lists trained in {train_seconds:.2f}s")
+    print(f"Vectors: {index.codes.nbytes / 1e6:.1f} MB int8 (float32 would be {index.codes.nbytes * 4 / 1e6:.1f} MB)")
+
+    # int8 error, and how often the source is among the neighbours of a query's chunks by IVF and exhaustively
+    query_vectors, query_owners = index.embed(queries[:16])[:2]
+    exact_vectors = index.embed([references[i] for i in sources[:16]])[0]
+    codes, scales = semantic.quantize(exact_vectors)
+    error = np.abs(query_vectors @ exact_vectors.T - query_vectors @ (codes * scales[:, None]).T).mean()
+    found, _ = index.search_chunks(query_vectors, 10)
+    everything = index.codes.astype(np.float32) * index.scales[:, None]
+    exact = index.owners[np.argsort(-(query_vectors @ everything.T), axis=1)[:, :10]]
+    ivf_hits = np.mean([sources[i] in found[query_owners == i] for i in range(16)])
+    exact_hits = np.mean([sources[i] in exact[query_owners == i] for i in range(16)])
+    print(f"Mean |cosine error| of int8 vectors {error:.4f}; source among chunk neighbours "
+          f"{ivf_hits:.3f} at nprobe {args.nprobe} ({exact_hits:.3f} exhaustive)")
+
+    tfidf = SearchIndex(vectorizer.transform([utils.preprocess(text, args.tokenizer) for text in references]), vectorizer)
+    failures = []
+    print(f"\n{'batch':>6}{'p50 ms':>10}{'p99 ms':>10}{'TF-IDF top-1':>14}{'re-ranked top-1':>17}")
+    for batch in (int(n) for n in args.batches.split(',')):
+        latencies, tfidf_hits, semantic_hits = [], 0, 0
+        for begin in range(0, len(queries), batch):
+            texts = queries[begin:begin + batch]
+            start = time.perf_counter()
+            vectors = vectorizer.transform([utils.preprocess(text, args.tokenizer) for text in texts])
+            candidates = tfidf.search_many(vectors, k=args.candidates)
+            reranked = index.rerank_many(texts, candidates, k=5)
+            latencies.extend([(time.perf_counter() - start) * 1e3 / len(texts)] * len(texts))
+            for source, report_candidates, report_reranked in zip(sources[begin:begin + batch], candidates, reranked):
+                tfidf_hits += bool(report_candidates) and report_candidates[0][0] == source
+                semantic_hits += bool(report_reranked) and report_reranked[0][0] == source
+        p50, p99 = np.percentile(latencies, [50, 99])
+        over = p99 > args.budget_ms
+        print(f"{batch:>6}{p50:10.1f}{p99:10.1f}{tfidf_hits / len(queries):14.3f}{semantic_hits / len(queries):17.3f}"
+              f"{'  OVER BUDGET' if over else ''}")
+        if over:
+            failures.append(f"batch {batch}: p99 {p99:.1f} ms per report (budget {args.budget_ms:.0f} ms)")
+
+    if failures:
+        print("\nFAILED:\n  " + "\n  ".join(failures))
+        return 1
+    print(f"\nWithin the {args.budget_ms:.0f} ms budget per report.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
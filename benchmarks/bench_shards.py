@@ -0,0 +1,131 @@
+"""
+Scaling benchmark for sharded scatter-gather search on synthetic corpora.
+
+Compares one SearchIndex against ShardedIndex in thread mode
+(from_parts) and process mode (write_shards + open) for growing corpus
+sizes and shard counts, and checks that every sharded result equals the
+unsharded one. Speed-ups need as many free cores as shards.
+
+Usage:
+    python benchmarks/bench_shards.py --sizes 10000,100000,1000000 --shards 1,2,4
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+from search import SearchIndex
+from shards import ShardedIndex, write_shards
+
+
+# Zipf-distributed term ids, like word frequencies in real reports
+def _zipf_columns(rng, n, n_columns, exponent=1.1):
+    weights = 1.0 / np.arange(1, n_columns + 1) ** exponent
+    cdf = np.cumsum(weights)
+    return np.searchsorted(cdf, rng.random(n) * cdf[-1]).astype(np.int32)
+
+
+def make_corpus(n_docs, n_columns=100000, terms_per_doc=80, seed=0, chunk=50000):
+    """
+    L2-normalised float32 TF-IDF-like rows, built in chunks to bound memory.
+    """
+    rng = np.random.default_rng(seed)
+    chunks = []
+    for start in range(0, n_docs, chunk):
+        rows = min(chunk, n_docs - start)
+        indices = _zipf_columns(rng, rows * terms_per_doc, n_columns)
+        indptr = np.arange(0, rows * terms_per_doc + 1, terms_per_doc, dtype=np.int64)
+        data = rng.random(len(indices), dtype=np.float32) + 0.1
+        part = sparse.csr_matrix((data, indices, indptr), shape=(rows, n_columns))
+        part.sum_duplicates()
+        chunks.append(normalize(part, norm='l2', copy=False))
+    return sparse.vstack(chunks, format='csr')
+
+
+# Queries are perturbed corpus rows, so every query has real matches
+def make_queries(corpus, n_queries, seed=1):
+    rng = np.random.default_rng(seed)
+    queries = sparse.csr_matrix(corpus[rng.choice(corpus.shape[0], n_queries, replace=False)], dtype=np.float64)
+    queries.data *= rng.random(len(queries.data)) + 0.5
+    return queries
+
+
+# Per-query latencies in ms, and the results of the last pass
+def measure(index, queries, k, batch):
+    latencies, results = [], []
+    for start in range(0, queries.shape[0], batch):
+        block = queries[start:start + batch]
+        begin = time.perf_counter()
+        results.extend(index.search_many(block, k))
+        latencies.append((time.perf_counter() - begin) * 1e3 / block.shape[0])
+    return np.array(latencies), results
+
+
+def _same(results, expected):
+    return all([row for row, _ in got] == [row for row, _ in want] and
+               np.allclose([s for _, s in got], [s for _, s in want], atol=1e-6)
+               for got, want in zip(results, expected))
+
+
+def report(name, build_seconds, latencies, matches):
+    p50, p99 = np.percentile(latencies, [50, 99])
+    print(f"  {name:<22} build {build_seconds:8.2f}s   p50 {p50:8.3f} ms   p99 {p99:8.3f} ms   "
+          f"{1e3 / latencies.mean():9.1f} q/s   {'same' if matches else 'DIFFERENT'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='10000,100000', help="Comma-separated corpus sizes")
+    parser.add_argument('--shards', default='1,2,4', help="Comma-separated shard counts")
+    parser.add_argument('--columns', type=int, default=100000)
+    parser.add_argument('--terms', type=int, default=80, help="Distinct terms per document (before dedup)")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=1, help="Queries scored per search_many call")
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--no-processes', action='store_true', help="Skip the process-mode shards")
+    args = parser.parse_args()
+
+    shard_counts = [int(n) for n in args.shards.split(',')]
+    print(f"{os.cpu_count()} CPUs, {args.queries} queries, batch {args.batch}, k={args.k}")
+    for size in (int(n) for n in args.sizes.split(',')):
+        start = time.perf_counter()
+        corpus = make_corpus(size, args.columns, args.terms)
+        queries = make_queries(corpus, min(args.queries, size))
+        print(f"\n{size} documents, {corpus.nnz} non-zeros (generated in {time.perf_counter() - start:.1f}s)")
+
+        start = time.perf_counter()
+        baseline = SearchIndex(corpus, None)
+        build = time.perf_counter() - start
+        latencies, expected = measure(baseline, queries, args.k, args.batch)
+        report('SearchIndex', build, latencies, True)
+        del baseline
+
+        for n_shards in shard_counts:
+            start = time.perf_counter()
+            with ShardedIndex.from_parts([corpus], None, n_shards) as index:
+                build = time.perf_counter() - start
+                latencies, results = measure(index, queries, args.k, args.batch)
+            report(f"threads x{n_shards}", build, latencies, _same(results, expected))
+
+            if args.no_processes:
+                continue
+            with tempfile.TemporaryDirectory() as directory:
+                start = time.perf_counter()
+                write_shards(corpus, directory, n_shards)
+                with ShardedIndex.open(directory) as index:
+                    # The first search waits for every worker to map its shard
+                    index.search_many(queries[:1], args.k)
+                    build = time.perf_counter() - start
+                    latencies, results = measure(index, queries, args.k, args.batch)
+                report(f"processes x{n_shards}", build, latencies, _same(results, expected))
+
+
+if __name__ == '__main__':
+    main()
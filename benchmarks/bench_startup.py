@@ -0,0 +1,134 @@
+"""
+Startup-time benchmark with a budget.
+
+Each target is imported in a fresh interpreter, several times, and the
+median wall time is compared against its budget. Importing the app must
+also leave the heavy libraries (NLTK, scikit-learn, the document parsers
+and huggingface_hub) unloaded; they are imported on first use. With
+--first-check, the time from a cold interpreter to the first scored report
+is measured too, against the local corpus files.
+
+Exits with status 1 when a budget is exceeded or a heavy module is loaded
+eagerly, so it can run in CI.
+
+Usage:
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --budget app=800 --budget utils=400 --details
+    python benchmarks/bench_startup.py --first-check --first-check-budget 6000
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Import budgets in milliseconds, for a warm disk cache on a developer machine
+BUDGETS = {
+    'app': 1500,
+    'utils': 1000,
+    'preprocessing': 200,
+    'extraction': 300,
+    'metrics': 100,
+}
+# Must not be imported by `import app`
+HEAVY_MODULES = ('nltk', 'sklearn', 'PyPDF2', 'docx', 'huggingface_hub')
+
+FIRST_CHECK = """
+import checker
+report = ' '.join(['the student analysed the training data and reported the results'] * 200)
+checker.analyse_report(report)
+"""
+
+
+def _run(code, cwd=ROOT, extra_args=()):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, *extra_args, '-c', code], cwd=cwd, capture_output=True, text=True,
+                            env=dict(os.environ, PYTHONPATH=ROOT))
+    elapsed = (time.perf_counter() - start) * 1e3
+    if result.returncode:
+        raise RuntimeError(f"{code.strip()!r} failed:\n{result.stderr}")
+    return elapsed, result
+
+
+# Median wall time of a fresh interpreter running code, minus a bare interpreter's start-up
+def measure(code, runs, baseline=0.0, cwd=ROOT):
+    return statistics.median(_run(code, cwd)[0] for _ in range(runs)) - baseline
+
+
+# (cumulative ms, module) rows of python -X importtime
+def _import_times(code):
+    _, result = _run(code, extra_args=('-X', 'importtime'))
+    rows = []
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]) / 1e3, parts[2].strip()))
+    return rows
+
+
+# The slowest imports of a module by cumulative time, leaving out the interpreter's own start-up
+def slowest_imports(module, top=8):
+    startup = {name for _, name in _import_times("pass")}
+    return sorted(row for row in _import_times(f"import {module}") if row[1] not in startup)[::-1][:top]
+
+
+def eager_heavy_modules(module):
+    _, result = _run(f"import sys, {module}\n"
+                     f"print(' '.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))")
+    return result.stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per target")
+    parser.add_argument('--budget', action='append', default=[], metavar='MODULE=MS',
+                        help="Override or add an import budget")
+    parser.add_argument('--details', action='store_true', help="Show the slowest imports of every target")
+    parser.add_argument('--first-check', action='store_true', help="Also time a cold start to the first check")
+    parser.add_argument('--first-check-budget', type=float, default=8000)
+    parser.add_argument('--corpus-dir', default=ROOT, help="Folder with tfidf_matrix.npz and tfidf_vectorizer.pkl")
+    args = parser.parse_args()
+
+    budgets = dict(BUDGETS)
+    for item in args.budget:
+        module, _, milliseconds = item.partition('=')
+        budgets[module] = float(milliseconds)
+
+    interpreter = measure("pass", args.runs)
+    print(f"Bare interpreter: {interpreter:.0f} ms (subtracted below), median of {args.runs} runs\n")
+    print(f"{'target':<16}{'ms':>8}{'budget':>9}")
+    failures = []
+    for module, budget in budgets.items():
+        elapsed = measure(f"import {module}", args.runs, interpreter)
+        over = elapsed > budget
+        print(f"{module:<16}{elapsed:8.0f}{budget:9.0f}{'  OVER BUDGET' if over else ''}")
+        if over:
+            failures.append(f"import {module} took {elapsed:.0f} ms (budget {budget:.0f} ms)")
+        if over or args.details:
+            for milliseconds, name in slowest_imports(module):
+                print(f"    {milliseconds:8.1f} ms  {name}")
+
+    if 'app' in budgets:
+        eager = eager_heavy_modules('app')
+        print(f"\nHeavy modules loaded by `import app`: {', '.join(eager) or 'none'}")
+        if eager:
+            failures.append(f"import app loads {', '.join(eager)} eagerly")
+
+    if args.first_check:
+        elapsed = measure(FIRST_CHECK, args.runs, interpreter, cwd=args.corpus_dir)
+        print(f"\nCold start to first check: {elapsed:.0f} ms (budget {args.first_check_budget:.0f} ms)")
+        if elapsed > args.first_check_budget:
+            failures.append(f"first check took {elapsed:.0f} ms (budget {args.first_check_budget:.0f} ms)")
+
+    if failures:
+        print("\nFAILED:\n  " + "\n  ".join(failures))
+        return 1
+    print("\nAll startup budgets met.")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
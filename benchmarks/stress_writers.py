@@ -0,0 +1,101 @@
+"""
+Stress test for journaled corpus writes: many processes append rows to one
+segment store at once while readers keep loading it.
+
+Usage:
+    python benchmarks/stress_writers.py --writers 16 --appends 25
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from scipy import sparse
+
+from journal import CorpusWriter
+from segments import SegmentStore
+
+N_COLUMNS = 1000
+
+
+# Each row carries a unique marker value in column 0 so lost or duplicated rows show up
+def _marker_row(writer_id, i):
+    return sparse.csr_matrix(([float(writer_id * 100000 + i + 1)], ([0], [0])), shape=(1, N_COLUMNS))
+
+
+def _writer(directory, writer_id, appends, max_segments):
+    store = SegmentStore(directory, max_segments=max_segments)
+    writer = CorpusWriter(store)
+    for i in range(appends):
+        ticket = writer.submit(_marker_row(writer_id, i))
+        # Half the appends wait for publication, the rest leave it to whoever holds the lock
+        manifest = writer.apply(blocking=(i % 2 == 0))
+        if manifest is not None and i % 2 == 0 and writer.row_of(ticket, manifest) is None:
+            raise AssertionError(f"Entry {ticket} missing after apply")
+
+
+def _reader(directory, stop, errors):
+    store = SegmentStore(directory)
+    while not stop.is_set():
+        try:
+            store.load()
+        except Exception as e:
+            errors.put(f"{type(e).__name__}: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--writers', type=int, default=16)
+    parser.add_argument('--appends', type=int, default=25)
+    parser.add_argument('--readers', type=int, default=2)
+    parser.add_argument('--max-segments', type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = SegmentStore(directory, max_segments=args.max_segments)
+        CorpusWriter(store).initialize(sparse.csr_matrix((0, N_COLUMNS)))
+
+        stop, errors = multiprocessing.Event(), multiprocessing.Queue()
+        readers = [multiprocessing.Process(target=_reader, args=(directory, stop, errors))
+                   for _ in range(args.readers)]
+        writers = [multiprocessing.Process(target=_writer, args=(directory, i, args.appends, args.max_segments))
+                   for i in range(args.writers)]
+        start = time.perf_counter()
+        for process in readers + writers:
+            process.start()
+        for process in writers:
+            process.join()
+        elapsed = time.perf_counter() - start
+        stop.set()
+        for process in readers:
+            process.join()
+
+        # Anything still queued by non-blocking appends
+        manifest = CorpusWriter(store).apply()
+        matrix = store.load(manifest).tocsc()
+        markers = np.sort(matrix[:, 0].toarray().ravel())
+        expected = np.sort([float(w * 100000 + i + 1) for w in range(args.writers) for i in range(args.appends)])
+
+        total = args.writers * args.appends
+        print(f"{total} appends from {args.writers} processes in {elapsed:.2f}s "
+              f"({total / elapsed:.0f} appends/sec), {len(manifest['segments'])} live segments, "
+              f"manifest version {manifest['version']}")
+        failed = [process.exitcode for process in writers if process.exitcode != 0]
+        reader_errors = []
+        while not errors.empty():
+            reader_errors.append(errors.get())
+        ok = np.array_equal(markers, expected) and not failed and not reader_errors
+        print(f"rows {matrix.shape[0]}/{total}, writer failures {len(failed)}, "
+              f"reader errors {len(reader_errors)}: {'OK' if ok else 'FAILED'}")
+        for error in reader_errors[:5]:
+            print(f"  {error}")
+        sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
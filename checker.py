@@ -0,0 +1,176 @@
+"""
+Report checking without the UI: scoring, verdicts and adding to the corpus.
+
+Used by the Streamlit app and the HTTP service alike. Results are cached
+per report (see result_cache), and analyse_many() vectorizes and scores a
+whole batch of reports at once. Added reports are recorded with their
+metadata and text in the document store (see documents), which filtered
+checks and highlighting read from. With SEMANTIC_ENABLED=1, the TF-IDF
+candidates are re-ranked by the paraphrase engine (see semantic).
+"""
+import corpus_stats
+import corpus_store
+import documents
+import fingerprint
+import hub_sync
+import metrics
+import result_cache
+import search
+import segments
+import semantic
+import utils
+
+
+def analyse_many(reports, k=5, data=None, filters=None):
+    """
+    Vector, top matches and copied passages of each report.
+
+    Args:
+        reports (list): Report texts.
+        k (int): Matches kept per report.
+        data (list): Optional raw upload bytes per report, cached as aliases.
+        filters (dict): Optional documents.DocumentStore.rows() filters, e.g.
+            {'course': 'CS101'}; only matching documents are compared against.
+            Filtered results are not cached.
+
+    Returns:
+        list: One result_cache entry per report.
+    """
+    store = corpus_store.get_store()
+    parts, vectorizer = store.get_parts()
+    cache = result_cache.get_cache()
+    data = data or [None] * len(reports)
+    rows = documents.get_store().rows(**filters) if filters else None
+    results = [None if filters else cache.get(report, store.corpus_id, k=k) for report in reports]
+    if semantic.ENABLED:
+        # Entries cached while the paraphrase engine was off are checked again
+        results = [None if result is not None and result.get('semantic') is None else result for result in results]
+    missing = [i for i, result in enumerate(results) if result is None]
+    metrics.inc(metrics.CHECKS, len(reports) - len(missing), result='cached')
+    if not missing:
+        return results
+
+    for i in missing:
+        metrics.observe(metrics.DOCUMENT_CHARACTERS, len(reports[i]))
+    preprocessed = [utils.preprocess(reports[i]) for i in missing]
+    with metrics.timed('vectorize', documents=len(missing)):
+        vectors = vectorizer.transform(preprocessed)
+    duplicates = result_cache.get_duplicates()
+    fingerprint_index = fingerprint.get_index()
+    to_score = []
+    for row, i in enumerate(missing):
+        results[i] = {
+            'text': reports[i], 'vector': vectors[row], 'k': k, 'corpus_id': store.corpus_id,
+            'matches': [], 'passages': [], 'semantic': [] if semantic.ENABLED else None,
+            # Reports already in the reference set are recognised without scoring
+            'duplicate_of': duplicates.find(vectors[row], parts),
+        }
+        if results[i]['duplicate_of'] is None:
+            # Reports sharing nearly all their passages with a document (MinHash LSH) are copies too
+            near = fingerprint_index.near_duplicates(reports[i], fingerprint.NEAR_DUPLICATE_SIMILARITY)
+            if near:
+                results[i]['duplicate_of'] = near[0][0]
+        if results[i]['duplicate_of'] is None:
+            to_score.append((row, i))
+    metrics.inc(metrics.CHECKS, len(missing) - len(to_score), result='duplicate')
+    metrics.inc(metrics.CHECKS, len(to_score), result='scored')
+    if to_score:
+        # The paraphrase engine re-ranks a wider set of TF-IDF candidates
+        candidates = max(k, semantic.CANDIDATES) if semantic.ENABLED else k
+        with metrics.timed('score', documents=len(to_score), k=candidates):
+            matches = search.get_index(store).search_many(vectors[[row for row, _ in to_score]], k=candidates,
+                                                          rows=rows)
+        if semantic.ENABLED:
+            with metrics.timed('semantic', documents=len(to_score), candidates=candidates):
+                reranked = semantic.get_index().rerank_many([reports[i] for _, i in to_score], matches, k=k, rows=rows)
+            for (_, i), report_semantic in zip(to_score, reranked):
+                results[i]['semantic'] = report_semantic
+        allowed = None if rows is None else set(rows.tolist())
+        with metrics.timed('passages', documents=len(to_score)):
+            for (_, i), report_matches in zip(to_score, matches):
+                results[i]['matches'] = report_matches[:k]
+                passages = fingerprint_index.find_passages(reports[i])
+                if allowed is not None:
+                    passages = [passage for passage in passages if passage.doc_id in allowed]
+                results[i]['passages'] = passages
+    if not filters:
+        for i in missing:
+            cache.put(results[i], data[i])
+    return results
+
+
+def analyse_report(report, k=5, data=None, filters=None):
+    return analyse_many([report], k=k, data=[data], filters=filters)[0]
+
+
+# Matches above the threshold, likely paraphrases and whether the report needs attention
+def verdict(result, threshold=0.2, semantic_threshold=semantic.THRESHOLD):
+    # Scores equal to the threshold are not plagiarism
+    matches = [(index, score) for index, score in result['matches'] if score > threshold]
+    # Documents the report paraphrases, unless TF-IDF flagged them already
+    flagged_rows = {index for index, _ in matches}
+    paraphrases = [(index, score) for index, score in result.get('semantic') or []
+                   if score > semantic_threshold and index not in flagged_rows]
+    return {
+        'duplicate_of': result['duplicate_of'],
+        'matches': matches,
+        'paraphrases': paraphrases,
+        'passages': result['passages'],
+        'flagged': result['duplicate_of'] is not None or bool(matches) or bool(paraphrases)
+        or bool(result['passages']),
+    }
+
+
+def add_report(report, vector=None, doc_id=None, submitter=None, course=None, timestamp=None):
+    """
+    Adds a report to the reference set: appends its vector as a segment,
+    fingerprints it under its new row, records its metadata and text in the
+    document store and queues the segment for the hub.
+
+    Args:
+        report (str): Report text.
+        vector (scipy.sparse matrix): Its TF-IDF row, computed here if omitted.
+        doc_id, submitter, course, timestamp: Metadata, see documents.DocumentStore.add.
+
+    Returns:
+        int: The report's corpus row.
+    """
+    store = corpus_store.get_store()
+    _, vectorizer = store.get_parts()
+    preprocessed = utils.preprocess(report)
+    if vector is None:
+        vector = vectorizer.transform([preprocessed])
+    # Words the vectorizer does not know yet are counted for the next IDF refresh
+    with metrics.timed('append'):
+        manifest, row = store.append(vector, [corpus_stats.new_terms(preprocessed, vectorizer)], vectorizer)
+
+    # Fingerprint the report under its row so later copies of its passages are found
+    with metrics.timed('fingerprint_save', row=row):
+        fingerprint.get_index().add(row, report)
+
+    with metrics.timed('document_save', row=row):
+        documents.get_store().add(row, report, doc_id, submitter, course, timestamp)
+
+    if semantic.ENABLED:
+        with metrics.timed('semantic_add', row=row):
+            semantic.get_index().add(row, report)
+
+    # Queue the new segment for the background upload to the huggingface
+    hub_sync.get_worker().mark_dirty(segments.SegmentStore.segment_for_row(manifest, row))
+    return row
+
+
+def highlight_match(report, row):
+    """
+    The report with the text it shares with a corpus document highlighted,
+    see utils.highlight_similar_text.
+
+    Returns:
+        tuple: (highlighted report, matching passages or words), or None when
+        the document's text is not in the document store.
+    """
+    reference = documents.get_store().text(row)
+    if reference is None:
+        return None
+    _, vectorizer = corpus_store.get_store().get_parts()
+    return utils.highlight_similar_text(report, reference, vectorizer)
@@ -0,0 +1,198 @@
+"""
+Collusion detection within a cohort: all-pairs similarity of submissions.
+
+The cohort's L2-normalised TF-IDF rows are multiplied against the whole
+cohort one block of rows at a time. Each block is thresholded as soon as
+it is computed, so only pairs above the threshold (and each submission's
+best peer) are kept and no N x N result ever exists. The block height is
+chosen so a block product holds at most max_block_entries scores, which
+bounds memory whatever the cohort size.
+
+Groups of mutually similar submissions are the connected components of
+the graph of pairs above the threshold. Each group reports its density
+(the share of its member pairs above the threshold), so a chain of
+pairwise matches can be told apart from a ring sharing one source.
+
+Usage:
+    python cohort.py submissions/ --threshold 0.5 --output pairs.csv --clusters clusters.json
+"""
+import argparse
+import csv
+import json
+import sys
+import time
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from sklearn.preprocessing import normalize
+
+import corpus_store
+
+# A score costs about 16 bytes in a block product (two int32 indices and a float64), so about 320 MB
+MAX_BLOCK_ENTRIES = 20_000_000
+
+
+# Rows per block so that a block x cohort product stays within max_entries scores
+def rows_per_block(n_rows, max_entries=MAX_BLOCK_ENTRIES):
+    return max(1, min(n_rows, max_entries // max(n_rows, 1)))
+
+
+def all_pairs(submissions, threshold=0.5, max_block_entries=MAX_BLOCK_ENTRIES):
+    """
+    Cosine similarity of every pair of submissions, keeping only pairs above a threshold.
+
+    Args:
+        submissions (scipy.sparse matrix): One TF-IDF row per submission.
+        threshold (float): Pairs scoring above this are returned.
+        max_block_entries (int): Largest number of scores computed at once.
+
+    Returns:
+        tuple: (pairs, best) where pairs is (rows, columns, scores) with
+        rows < columns, best first, and best is (best peer per row or -1,
+        its score).
+    """
+    submissions = normalize(sparse.csr_matrix(submissions, dtype=np.float64), norm='l2')
+    n = submissions.shape[0]
+    transposed = submissions.T.tocsr()
+    rows, columns, scores = [], [], []
+    best_peer = np.full(n, -1, dtype=np.int64)
+    best_score = np.zeros(n)
+    step = rows_per_block(n, max_block_entries)
+    for start in range(0, n, step):
+        stop = min(start + step, n)
+        block = (submissions[start:stop] @ transposed).tocoo()
+        block_rows, block_columns = block.row + start, block.col
+        # A submission is not its own peer
+        keep = block_rows != block_columns
+        block_rows, block_columns, values = block_rows[keep], block_columns[keep], block.data[keep]
+
+        if len(values):
+            # Best peer per row: order by row, then score descending, and take each row's first entry
+            order = np.lexsort((-values, block_rows))
+            first = np.r_[True, block_rows[order][1:] != block_rows[order][:-1]]
+            winners = order[first]
+            best_peer[block_rows[winners]] = block_columns[winners]
+            best_score[block_rows[winners]] = values[winners]
+
+        # Each pair once, from its lower-numbered submission
+        above = (values > threshold) & (block_columns > block_rows)
+        rows.append(block_rows[above])
+        columns.append(block_columns[above])
+        scores.append(values[above])
+
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+    columns = np.concatenate(columns) if columns else np.empty(0, dtype=np.int64)
+    scores = np.concatenate(scores) if scores else np.empty(0)
+    order = np.lexsort((columns, rows, -scores))
+    return (rows[order], columns[order], scores[order]), (best_peer, best_score)
+
+
+def clusters(n, pairs):
+    """
+    Groups of submissions linked by similar pairs, largest first.
+
+    Args:
+        n (int): Number of submissions.
+        pairs (tuple): (rows, columns, scores) as returned by all_pairs().
+
+    Returns:
+        list: One dict per group of two or more, with 'members' (sorted
+        submission indices), 'pairs', 'density', 'max_score' and 'mean_score'.
+    """
+    rows, columns, scores = pairs
+    if not len(rows):
+        return []
+    graph = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    sizes = np.bincount(labels)
+    pair_labels = labels[rows]
+    groups = []
+    for label in np.flatnonzero(sizes > 1):
+        in_group = pair_labels == label
+        size = int(sizes[label])
+        groups.append({
+            'members': np.flatnonzero(labels == label).tolist(),
+            'pairs': int(in_group.sum()),
+            'density': round(float(in_group.sum()) / (size * (size - 1) / 2), 6),
+            'max_score': round(float(scores[in_group].max()), 6),
+            'mean_score': round(float(scores[in_group].mean()), 6),
+        })
+    groups.sort(key=lambda group: (-len(group['members']), -group['max_score']))
+    return groups
+
+
+def check_cohort(source, threshold=0.5, jobs=None, timeout=60, vectorizer=None,
+                 max_block_entries=MAX_BLOCK_ENTRIES):
+    """
+    Finds similar pairs and groups among the submissions of one assignment.
+
+    Args:
+        source (str): Directory or .zip/.tar archive of .txt, .docx and .pdf files.
+        threshold (float): Pairs scoring above this are reported.
+        jobs (int): Worker processes for extraction and vectorising.
+        timeout (float): Seconds allowed per document.
+        vectorizer: Fitted vectorizer, the shared corpus's current one if omitted.
+
+    Returns:
+        tuple: (list of pair dicts, list of group dicts, dict of timings)
+    """
+    # batch scores its peers with all_pairs(), so it is imported here rather than at the top
+    import batch
+    if vectorizer is None:
+        _, vectorizer = corpus_store.get_store().get_parts()
+    names, submissions, _, errors, extraction_seconds = batch.vectorize_submissions(source, vectorizer, jobs, timeout)
+
+    start = time.perf_counter()
+    pairs, _ = all_pairs(submissions, threshold, max_block_entries)
+    groups = clusters(len(names), pairs)
+    scoring_seconds = time.perf_counter() - start
+
+    pair_results = [{'submission': names[row], 'peer': names[column], 'score': round(float(score), 6)}
+                    for row, column, score in zip(*pairs)]
+    for group in groups:
+        group['members'] = [names[i] for i in group['members']]
+    timings = {
+        'documents': len(names),
+        'errors': sum(error is not None for error in errors),
+        'pairs': len(pair_results),
+        'extraction_seconds': extraction_seconds,
+        'scoring_seconds': scoring_seconds,
+    }
+    return pair_results, groups, timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find submissions of one cohort that are similar to each other.")
+    parser.add_argument('source', help="Directory or .zip/.tar archive of .txt, .docx and .pdf files")
+    parser.add_argument('--output', default='pairs.csv', help="Similar pairs (.csv or .jsonl)")
+    parser.add_argument('--clusters', default=None, help="Groups of similar submissions (.json)")
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--jobs', type=int, default=None, help="Extraction worker processes")
+    parser.add_argument('--timeout', type=float, default=60, help="Seconds allowed per document")
+    parser.add_argument('--max-block-entries', type=int, default=MAX_BLOCK_ENTRIES,
+                        help="Scores computed at once, bounds memory")
+    args = parser.parse_args(argv)
+
+    pairs, groups, timings = check_cohort(args.source, args.threshold, args.jobs, args.timeout,
+                                          max_block_entries=args.max_block_entries)
+    if args.output.endswith('.jsonl'):
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(pair) + '\n' for pair in pairs)
+    else:
+        with open(args.output, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=['submission', 'peer', 'score'])
+            writer.writeheader()
+            writer.writerows(pairs)
+    if args.clusters:
+        with open(args.clusters, 'w', encoding='utf-8') as f:
+            json.dump(groups, f, indent=2)
+
+    print(f"{timings['documents']} submissions, {timings['pairs']} pairs above {args.threshold}, "
+          f"{len(groups)} group(s), results in {args.output}", file=sys.stderr)
+    print(f"Extraction {timings['extraction_seconds']:.2f}s, scoring {timings['scoring_seconds']:.2f}s",
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
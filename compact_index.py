@@ -0,0 +1,339 @@
+"""
+Compact TF-IDF index: pruned vocabulary, float32 matrix, dict-free vectorizer.
+
+A fitted TfidfVectorizer pickles its vocabulary as a Python dict of
+117k strings and keeps float64 IDF weights, so the vectorizer file is
+larger than the matrix and slow to unpickle. prune() drops terms that are
+too rare (min_df) or too common (max_df) to help, re-normalises the rows
+over the remaining terms exactly as a vectorizer fitted with those limits
+would, and stores the matrix as float32 with int32 indices.
+
+CompactVectorizer replaces the sklearn object with a few flat arrays: the
+terms as one UTF-8 blob with offsets, and a sorted array of their 64-bit
+hashes for lookups, so a whole document is looked up with a few array
+operations. It provides the parts of the TfidfVectorizer API this
+app uses (transform, build_analyzer, vocabulary_, idf_ and the weighting
+flags), so the compact files can be passed anywhere the originals are.
+
+Usage:
+    python compact_index.py --min-df 2 --max-df 0.95
+"""
+import argparse
+import numbers
+import os
+import pickle
+import random
+import re
+import time
+from collections import Counter
+from collections.abc import Mapping
+
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+
+HASH_PRIME = np.uint64(0x9E3779B97F4A7C15)
+
+
+# Stable 64-bit hashes of encoded terms, computed 8 bytes at a time over the whole batch
+def _term_hashes(encoded):
+    lengths = np.fromiter(map(len, encoded), dtype=np.uint64, count=len(encoded))
+    width = max(8, -(-int(lengths.max(initial=0)) // 8) * 8)
+    words = np.array(encoded, dtype=f"S{width}").view('<u8').reshape(len(encoded), width // 8)
+    n_words = (lengths + np.uint64(7)) // np.uint64(8)
+    hashes = lengths * HASH_PRIME
+    for i, column in enumerate(words.T):
+        mixed = (hashes ^ column) * HASH_PRIME
+        mixed ^= mixed >> np.uint64(29)
+        # Only a term's own words count, so the hash does not depend on the batch's padding
+        hashes = np.where(n_words > np.uint64(i), mixed, hashes)
+    return hashes
+
+
+class CompactVocabulary(Mapping):
+    """
+    Read-only term -> column mapping stored as flat arrays.
+
+    Args:
+        blob (bytes): UTF-8 bytes of all terms, in column order.
+        offsets (np.ndarray): Start of each term in blob, plus the end of the last.
+        hashes (np.ndarray): Sorted uint64 term hashes.
+        columns (np.ndarray): Column of the term behind each entry of hashes.
+    """
+
+    def __init__(self, blob, offsets, hashes, columns):
+        self._blob = blob
+        self._offsets = offsets
+        self._hashes = hashes
+        self._columns = columns
+
+    @classmethod
+    def from_terms(cls, terms):
+        encoded = [term.encode('utf-8') for term in terms]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+        np.cumsum([len(term) for term in encoded], out=offsets[1:])
+        hashes = _term_hashes(encoded)
+        order = np.argsort(hashes, kind='stable')
+        hashes = hashes[order]
+        if len(hashes) > 1 and (np.diff(hashes) == 0).any():
+            raise ValueError("Two terms share a 64-bit hash.")
+        return cls(b''.join(encoded), offsets, hashes, order.astype(np.int32))
+
+    def term(self, column):
+        return self._blob[self._offsets[column]:self._offsets[column + 1]].decode('utf-8')
+
+    def lookup(self, terms):
+        """
+        Columns of many terms at once, -1 for terms outside the vocabulary.
+        """
+        columns = np.full(len(terms), -1, dtype=np.int64)
+        if not len(self._hashes) or not len(terms):
+            return columns
+        encoded = [term.encode('utf-8') for term in terms]
+        hashes = _term_hashes(encoded)
+        positions = np.minimum(np.searchsorted(self._hashes, hashes), len(self._hashes) - 1)
+        found = np.nonzero(self._hashes[positions] == hashes)[0]
+        candidates = self._columns[positions[found]]
+        starts, ends = self._offsets[candidates].tolist(), self._offsets[candidates + 1].tolist()
+        blob = self._blob
+        # A hash match is confirmed against the stored term
+        confirmed = [blob[start:end] == encoded[i] for i, start, end in zip(found.tolist(), starts, ends)]
+        columns[found[confirmed]] = candidates[confirmed]
+        return columns
+
+    def __getitem__(self, term):
+        column = self.lookup([term])[0]
+        if column < 0:
+            raise KeyError(term)
+        return int(column)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __iter__(self):
+        return (self.term(column) for column in range(len(self)))
+
+    @property
+    def nbytes(self):
+        return len(self._blob) + self._offsets.nbytes + self._hashes.nbytes + self._columns.nbytes
+
+
+class CompactVectorizer:
+    """
+    Word-unigram TF-IDF vectorizer over a CompactVocabulary.
+
+    Args:
+        vocabulary (CompactVocabulary): Terms in column order.
+        idf (np.ndarray): IDF weight per column.
+        token_pattern (str): Regex selecting tokens, as in TfidfVectorizer.
+        lowercase, binary, sublinear_tf, use_idf (bool), norm (str): TfidfVectorizer settings.
+        dtype: Output dtype of transform().
+    """
+
+    def __init__(self, vocabulary, idf, token_pattern=r"(?u)\b\w\w+\b", lowercase=True, binary=False,
+                 sublinear_tf=False, use_idf=True, norm='l2', dtype=np.float32):
+        self.vocabulary_ = vocabulary
+        self.idf_ = idf
+        self.token_pattern = token_pattern
+        self.lowercase = lowercase
+        self.binary = binary
+        self.sublinear_tf = sublinear_tf
+        self.use_idf = use_idf
+        self.norm = norm
+        self.dtype = dtype
+
+    @classmethod
+    def from_vectorizer(cls, vectorizer, columns=None, dtype=np.float32):
+        """
+        Converts a fitted TfidfVectorizer, optionally keeping only the given columns.
+        """
+        if (vectorizer.analyzer != 'word' or vectorizer.ngram_range != (1, 1) or vectorizer.tokenizer is not None
+                or vectorizer.preprocessor is not None or vectorizer.stop_words is not None
+                or vectorizer.strip_accents is not None):
+            raise ValueError("Only plain word-unigram vectorizers without custom hooks can be compacted.")
+        terms = np.empty(len(vectorizer.vocabulary_), dtype=object)
+        for term, column in vectorizer.vocabulary_.items():
+            terms[column] = term
+        idf = vectorizer.idf_ if vectorizer.use_idf else np.ones(len(terms))
+        if columns is not None:
+            terms, idf = terms[columns], idf[columns]
+        return cls(CompactVocabulary.from_terms(list(terms)), idf.astype(dtype), vectorizer.token_pattern,
+                   vectorizer.lowercase, vectorizer.binary, vectorizer.sublinear_tf, vectorizer.use_idf,
+                   vectorizer.norm, dtype)
+
+    def build_analyzer(self):
+        pattern = re.compile(self.token_pattern)
+        if self.lowercase:
+            return lambda doc: pattern.findall(doc.lower())
+        return pattern.findall
+
+    def get_feature_names_out(self):
+        return np.array(list(self.vocabulary_), dtype=object)
+
+    def transform(self, raw_documents):
+        analyze = self.build_analyzer()
+        indptr, indices, data = [0], [], []
+        for document in raw_documents:
+            counts = Counter(analyze(document))
+            terms = list(counts)
+            columns = self.vocabulary_.lookup(terms)
+            known = np.nonzero(columns >= 0)[0]
+            order = known[np.argsort(columns[known])]
+            indices.append(columns[order])
+            data.append(np.fromiter((counts[terms[i]] for i in order), dtype=np.float64, count=len(order)))
+            indptr.append(indptr[-1] + len(order))
+        indices = np.concatenate(indices) if indices else np.empty(0, dtype=np.int64)
+        data = np.concatenate(data) if data else np.empty(0)
+        if self.binary:
+            data[:] = 1.0
+        if self.sublinear_tf:
+            data = np.log(data) + 1.0
+        if self.use_idf:
+            data *= self.idf_[indices]
+        matrix = sparse.csr_matrix((data, indices.astype(np.int32), np.asarray(indptr, dtype=np.int32)),
+                                   shape=(len(indptr) - 1, len(self.vocabulary_)))
+        if self.norm is not None:
+            matrix = normalize(matrix, norm=self.norm, copy=False)
+        return matrix.astype(self.dtype)
+
+    def extended(self, new_terms, idf):
+        """
+        Copy with new_terms appended as the last columns and the given IDF weights.
+        """
+        terms = list(self.vocabulary_) + list(new_terms)
+        return CompactVectorizer(CompactVocabulary.from_terms(terms), np.asarray(idf, dtype=self.dtype),
+                                 self.token_pattern, self.lowercase, self.binary, self.sublinear_tf,
+                                 self.use_idf, self.norm, self.dtype)
+
+
+def prune(tfidf_matrix, vectorizer, min_df=2, max_df=0.95, dtype=np.float32):
+    """
+    Drops rare and overly common terms and converts the index to the compact format.
+
+    Args:
+        tfidf_matrix (scipy.sparse matrix): Reference documents, one per row.
+        vectorizer (TfidfVectorizer): The vectorizer that produced the matrix.
+        min_df (int): Keep terms found in at least this many documents.
+        max_df (float or int): Drop terms found in more than this fraction
+            (float) or number (int) of documents, like sklearn's max_df.
+        dtype: Value type of the compacted matrix.
+
+    Returns:
+        tuple: (compact csr matrix, CompactVectorizer)
+    """
+    n_documents = tfidf_matrix.shape[0]
+    max_count = max_df if isinstance(max_df, numbers.Integral) else max_df * n_documents
+    df = np.bincount(sparse.csr_matrix(tfidf_matrix).indices, minlength=tfidf_matrix.shape[1])
+    columns = np.nonzero((df >= min_df) & (df <= max_count))[0]
+    # Removing terms changes each row's norm; IDF only depends on n and df, so it is unchanged
+    matrix = sparse.csc_matrix(tfidf_matrix)[:, columns].tocsr()
+    if vectorizer.norm is not None:
+        matrix = normalize(matrix, norm=vectorizer.norm, copy=False)
+    matrix = matrix.astype(dtype)
+    matrix.indices = matrix.indices.astype(np.int32)
+    matrix.indptr = matrix.indptr.astype(np.int32)
+    return matrix, CompactVectorizer.from_vectorizer(vectorizer, columns, dtype)
+
+
+def save(tfidf_matrix, vectorizer, matrix_path, vectorizer_path):
+    sparse.save_npz(matrix_path, tfidf_matrix)
+    with open(vectorizer_path, 'wb') as f:
+        pickle.dump(vectorizer, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load(matrix_path, vectorizer_path):
+    with open(vectorizer_path, 'rb') as f:
+        vectorizer = pickle.load(f)
+    return sparse.load_npz(matrix_path), vectorizer
+
+
+# Query texts built from the terms of random corpus rows, so they hit both indexes
+def _sample_queries(tfidf_matrix, vectorizer, n_queries, words=300, seed=0):
+    rng = random.Random(seed)
+    terms = vectorizer.get_feature_names_out()
+    matrix = sparse.csr_matrix(tfidf_matrix)
+    queries = []
+    for row in rng.sample(range(matrix.shape[0]), min(n_queries, matrix.shape[0])):
+        row_terms = terms[matrix.indices[matrix.indptr[row]:matrix.indptr[row + 1]]]
+        if len(row_terms):
+            queries.append(' '.join(rng.choice(row_terms) for _ in range(words)))
+    return queries
+
+
+def _measure(matrix_path, vectorizer_path, queries, k, repeats=3):
+    import search
+
+    load_seconds = min(_timed(lambda: _load(matrix_path, vectorizer_path))[1] for _ in range(repeats))
+    tfidf_matrix, vectorizer = _load(matrix_path, vectorizer_path)
+    index = search.SearchIndex(tfidf_matrix, vectorizer)
+    results, latencies = [], []
+    for query in queries:
+        found, seconds = _timed(lambda: index.search_vector(vectorizer.transform([query]), k=k))
+        results.append([doc for doc, _ in found])
+        latencies.append(seconds)
+    return {
+        'file_bytes': os.path.getsize(matrix_path) + os.path.getsize(vectorizer_path),
+        'matrix_bytes': tfidf_matrix.data.nbytes + tfidf_matrix.indices.nbytes + tfidf_matrix.indptr.nbytes,
+        'terms': len(vectorizer.vocabulary_),
+        'load_seconds': load_seconds,
+        'median_query_ms': float(np.median(latencies)) * 1e3 if latencies else 0.0,
+        'results': results,
+    }
+
+
+def _timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+# --max-df like sklearn's max_df: a whole number of at least 1 is a document count, anything else a fraction
+def _max_df(value):
+    number = float(value)
+    return int(number) if number >= 1 and number.is_integer() else number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prune the TF-IDF index and report the size and speed impact.")
+    parser.add_argument('--matrix', default='tfidf_matrix.npz', help="Current matrix")
+    parser.add_argument('--vectorizer', default='tfidf_vectorizer.pkl', help="Current vectorizer")
+    parser.add_argument('--out-matrix', default='tfidf_matrix.compact.npz', help="Compacted matrix to write")
+    parser.add_argument('--out-vectorizer', default='tfidf_vectorizer.compact.pkl',
+                        help="Compacted vectorizer to write")
+    parser.add_argument('--min-df', type=int, default=2, help="Keep terms in at least this many documents")
+    parser.add_argument('--max-df', type=_max_df, default=0.95,
+                        help="Drop terms in more than this fraction of documents, or this many if a whole number")
+    parser.add_argument('--queries', type=int, default=50, help="Sample queries for latency and agreement")
+    parser.add_argument('-k', type=int, default=5, help="Matches compared per query")
+    args = parser.parse_args(argv)
+
+    tfidf_matrix, vectorizer = _load(args.matrix, args.vectorizer)
+    (compact_matrix, compact_vectorizer), seconds = _timed(
+        lambda: prune(tfidf_matrix, vectorizer, args.min_df, args.max_df))
+    save(compact_matrix, compact_vectorizer, args.out_matrix, args.out_vectorizer)
+    print(f"Kept {compact_matrix.shape[1]} of {tfidf_matrix.shape[1]} terms in {seconds:.2f}s")
+
+    queries = _sample_queries(tfidf_matrix, vectorizer, args.queries)
+    before = _measure(args.matrix, args.vectorizer, queries, args.k)
+    after = _measure(args.out_matrix, args.out_vectorizer, queries, args.k)
+    agreement = [len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(before['results'], after['results'])]
+
+    print(f"{'':18}{'current':>14}{'compact':>14}")
+    rows = [
+        ('terms', lambda r: f"{r['terms']}"),
+        ('files', lambda r: f"{r['file_bytes'] / 1e6:.2f} MB"),
+        ('matrix in memory', lambda r: f"{r['matrix_bytes'] / 1e6:.2f} MB"),
+        ('load', lambda r: f"{r['load_seconds'] * 1e3:.1f} ms"),
+        ('median query', lambda r: f"{r['median_query_ms']:.2f} ms"),
+    ]
+    for label, describe in rows:
+        print(f"{label:18}{describe(before):>14}{describe(after):>14}")
+    if agreement:
+        print(f"Top-{args.k} agreement over {len(queries)} queries: {np.mean(agreement) * 100:.1f}%")
+
+
+if __name__ == '__main__':
+    # Go through the importable module so the pickled classes resolve to compact_index, not __main__
+    import compact_index
+    compact_index.main()
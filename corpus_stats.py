@@ -0,0 +1,245 @@
+"""
+Incremental corpus statistics and offline IDF / vocabulary refresh.
+
+The pickled vectorizer is frozen: transform() drops words it has never
+seen and its IDF weights describe the corpus it was fitted on. Instead of
+refitting on every report, the statistics here are kept current on every
+append (document frequencies of vocabulary terms, plus document
+frequencies and counts of unseen terms), and a background job periodically
+promotes frequent new terms into the vocabulary, recomputes IDF and
+re-weights the matrix, then publishes the result as a new manifest version.
+"""
+import json
+import pickle
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+from segments import atomic_write
+
+# Terms of an already preprocessed text that the vectorizer does not know, with counts
+def new_terms(preprocessed_text, vectorizer):
+    vocabulary = vectorizer.vocabulary_
+    counts = Counter(vectorizer.build_analyzer()(preprocessed_text))
+    return {term: count for term, count in counts.items() if term not in vocabulary}
+
+
+class CorpusStats:
+    """
+    Document frequencies for the vocabulary and for not-yet-indexed terms.
+
+    A statistics file is published with each manifest version (see
+    journal.CorpusWriter), so the counts always describe exactly the rows
+    of that version.
+
+    Args:
+        df (np.ndarray): Document frequency per vocabulary column.
+        n_documents (int): Documents in the corpus.
+        new_df (Counter): Document frequency of terms outside the vocabulary.
+        new_counts (Counter): Total occurrences of terms outside the vocabulary.
+    """
+
+    def __init__(self, df, n_documents, new_df=None, new_counts=None):
+        self.df = df
+        self.n_documents = n_documents
+        self.new_df = Counter(new_df or {})
+        self.new_counts = Counter(new_counts or {})
+
+    @classmethod
+    def from_matrix(cls, parts):
+        """
+        Bootstraps the statistics from the stored matrix segments.
+        """
+        n_columns = parts[0].shape[1]
+        df = np.zeros(n_columns, dtype=np.int64)
+        for part in parts:
+            df += np.bincount(part.tocsr().indices, minlength=n_columns)
+        return cls(df, sum(part.shape[0] for part in parts))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            terms = json.loads(bytes(data['new_terms']).decode('utf-8'))
+            return cls(data['df'], int(data['n_documents']), terms['df'], terms['counts'])
+
+    def save(self, path):
+        terms = json.dumps({'df': self.new_df, 'counts': self.new_counts}).encode('utf-8')
+        arrays = {
+            'df': self.df,
+            'n_documents': np.array(self.n_documents),
+            'new_terms': np.frombuffer(terms, dtype=np.uint8),
+        }
+        atomic_write(path, lambda f: np.savez(f, **arrays))
+
+    def update(self, rows, new_terms_per_row=()):
+        """
+        Counts appended rows and the unseen terms of their documents.
+        """
+        rows = rows.tocsr()
+        self.df += np.bincount(rows.indices, minlength=len(self.df))
+        self.n_documents += rows.shape[0]
+        for terms in new_terms_per_row:
+            self.new_df.update(terms.keys())
+            self.new_counts.update(terms)
+
+    def idf(self):
+        # Same smoothed formula as TfidfVectorizer(smooth_idf=True)
+        return np.log((1 + self.n_documents) / (1 + self.df)) + 1.0
+
+
+def reweight(matrix, old_idf, new_idf):
+    """
+    Rows weighted with old_idf re-weighted with new_idf and re-normalised.
+    Columns new_idf has beyond old_idf stay zero.
+
+    Returns:
+        scipy.sparse.csr_matrix: float64 rows with len(new_idf) columns.
+    """
+    matrix = sparse.csr_matrix(matrix, dtype=np.float64, copy=True)
+    # Undo the old IDF weighting, apply the new one; the L2 norm absorbs the lost scale
+    matrix.data *= (new_idf[:len(old_idf)] / old_idf)[matrix.indices]
+    matrix.resize((matrix.shape[0], len(new_idf)))
+    return normalize(matrix, norm='l2', copy=False)
+
+
+def refit(parts, vectorizer, stats, min_df=2, max_new_terms=50000):
+    """
+    Builds a refreshed vectorizer and matrix from the current statistics.
+
+    Unseen terms in at least min_df documents are added to the vocabulary
+    as new columns, IDF is recomputed for every column, and existing rows
+    are re-weighted from their old IDF to the new one and re-normalised.
+    Rows stored before a term was promoted keep a zero for it, because the
+    original texts are not kept.
+
+    Returns:
+        tuple: (new matrix, new vectorizer, list of promoted terms)
+    """
+    if not vectorizer.use_idf or vectorizer.sublinear_tf:
+        raise ValueError("Only plain use_idf TF-IDF vectorizers can be refreshed in place.")
+    old_idf = vectorizer.idf_
+    n_old = len(old_idf)
+
+    vocabulary = dict(vectorizer.vocabulary_)
+    promoted = [term for term, df in stats.new_df.most_common(max_new_terms)
+                if df >= min_df and term not in vocabulary]
+    for offset, term in enumerate(promoted):
+        vocabulary[term] = n_old + offset
+        stats.df = np.append(stats.df, stats.new_df.pop(term))
+        stats.new_counts.pop(term, None)
+    new_idf = stats.idf()
+
+    matrix = reweight(sparse.vstack(parts, format='csr'), old_idf, new_idf).astype(vectorizer.dtype)
+
+    if hasattr(vectorizer, 'extended'):
+        # compact_index.CompactVectorizer
+        return matrix, vectorizer.extended(promoted, new_idf), promoted
+    new_vectorizer = pickle.loads(pickle.dumps(vectorizer))
+    new_vectorizer.vocabulary_ = vocabulary
+    new_vectorizer.idf_ = new_idf
+    # The idf_ setter leaves the inner transformer's input-width check at the old size
+    if hasattr(new_vectorizer._tfidf, 'n_features_in_'):
+        new_vectorizer._tfidf.n_features_in_ = len(new_idf)
+    return matrix, new_vectorizer, promoted
+
+
+class RefitScheduler:
+    """
+    Background thread that rebuilds the IDF weights and vocabulary when the
+    corpus has grown enough, without stopping readers: the new matrix and
+    vectorizer are published together as one manifest version.
+
+    Args:
+        writer (journal.CorpusWriter): Writer whose lock serialises the rebuild with appends.
+        interval (float): Seconds between checks.
+        min_growth (float): Relative growth in documents since the last rebuild that triggers one.
+        min_df (int): Document frequency needed to promote a new term.
+        on_refit (callable): Called with the rebuild summary after each published rebuild.
+    """
+
+    def __init__(self, writer, interval=3600.0, min_growth=0.05, min_df=2, on_refit=None):
+        self.writer = writer
+        self.on_refit = on_refit
+        self.interval = interval
+        self.min_growth = min_growth
+        self.min_df = min_df
+        self._stopped = threading.Event()
+        self._thread = None
+        self.last_result = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name='idf-refresh', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        # A store that was never rebuilt grows from the documents it had when first seen here
+        baseline = self.writer.documents()
+        while not self._stopped.wait(self.interval):
+            try:
+                if baseline is None:
+                    baseline = self.writer.documents()
+                    continue
+                start = time.perf_counter()
+                result = self.writer.refit(min_df=self.min_df, min_growth=self.min_growth, baseline=baseline)
+                if result is not None:
+                    self.last_result = dict(result, seconds=time.perf_counter() - start)
+                    if self.on_refit is not None:
+                        self.on_refit(self.last_result)
+            except Exception as e:
+                self.last_result = {'error': f"{type(e).__name__}: {e}"}
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+# Shared refresh job for the process, rebuilding the store from corpus_store.get_store()
+def get_scheduler(on_refit=None):
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            import corpus_store
+            _scheduler = RefitScheduler(corpus_store.get_store().writer, on_refit=on_refit).start()
+        return _scheduler
+
+
+def main(argv=None):
+    import argparse
+
+    import corpus_store
+
+    parser = argparse.ArgumentParser(description="Rebuild IDF weights and the vocabulary of the segment store.")
+    parser.add_argument('--segments', default=corpus_store.SEGMENT_DIR, help="Segment store folder")
+    parser.add_argument('--vectorizer', default=corpus_store.VECTORIZER_PATH,
+                        help="Vectorizer used until the store has been refreshed once")
+    parser.add_argument('--min-df', type=int, default=2, help="Documents a new term needs to be added")
+    parser.add_argument('--min-growth', type=float, default=0.0,
+                        help="Skip unless the corpus grew by this fraction since the last rebuild")
+    args = parser.parse_args(argv)
+
+    from journal import CorpusWriter
+    from segments import SegmentStore
+    start = time.perf_counter()
+    result = CorpusWriter(SegmentStore(args.segments), args.vectorizer).refit(args.min_df, args.min_growth)
+    if result is None:
+        print("Nothing to rebuild.")
+    else:
+        print(f"Published version {result['version']}: {result['documents']} documents, "
+              f"{result['columns']} terms ({result['promoted_terms']} new) "
+              f"in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
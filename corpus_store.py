@@ -0,0 +1,256 @@
+import hashlib
+import os
+import resource
+import threading
+import time
+
+import numpy as np
+from scipy.sparse import vstack
+
+import hub_sync
+import metrics
+import mmap_matrix
+import utils
+from journal import CorpusWriter
+from segments import SegmentStore
+
+MATRIX_PATH = 'tfidf_matrix.npz'
+VECTORIZER_PATH = 'tfidf_vectorizer.pkl'
+MMAP_PATH = 'tfidf_matrix.mm'
+SEGMENT_DIR = 'tfidf_segments'
+
+
+# Size and mtime of each backing file, None when a file is missing (hub fallback)
+def _file_signature(paths):
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def _file_digest(paths):
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def _matrix_nbytes(tfidf_matrix):
+    return tfidf_matrix.data.nbytes + tfidf_matrix.indices.nbytes + tfidf_matrix.indptr.nbytes
+
+
+# True when the matrix arrays are views over np.memmap files
+def _is_mapped(tfidf_matrix):
+    base = tfidf_matrix.data
+    while base is not None and not isinstance(base, np.memmap):
+        base = getattr(base, 'base', None)
+    return base is not None
+
+
+class CorpusStore:
+    """
+    Process-wide holder for the TF-IDF matrix and vectorizer.
+
+    The data is loaded once and shared by every Streamlit session in the
+    process. It is reloaded only when the files on disk change: a changed
+    mtime/size triggers a content hash check, so touching a file without
+    modifying it does not cause a reload.
+
+    Once a report has been appended the matrix lives in a SegmentStore and
+    the single tfidf_matrix.npz is only the starting point it was seeded from.
+    Memory-mapped matrices (tfidf_matrix.mm or segment bases) are kept as
+    read-only views, and get_parts() hands them out without stacking. After
+    an IDF refresh (journal.CorpusWriter.refit) the manifest names the
+    vectorizer that matches the segments, and that one replaces
+    tfidf_vectorizer.pkl.
+    """
+
+    def __init__(self, matrix_path=MATRIX_PATH, vectorizer_path=VECTORIZER_PATH,
+                 segment_dir=SEGMENT_DIR, mmap_path=MMAP_PATH, check_hash=True):
+        self.matrix_path = matrix_path
+        self.mmap_path = mmap_path
+        self.vectorizer_path = vectorizer_path
+        self.segments = SegmentStore(segment_dir)
+        self.writer = CorpusWriter(self.segments, vectorizer_path)
+        self.check_hash = check_hash
+        self._lock = threading.Lock()
+        self._parts = None
+        self._matrix = None
+        self._vectorizer = None
+        self._vectorizer_file = None
+        # (vectorizer, manifest name) of the current vectorizer and the one before, see append()
+        self._vectorizers = []
+        self._signature = None
+        self._digest = None
+        self.version = 0
+        # Identifies the corpus content across processes, e.g. for result caches
+        self.corpus_id = None
+        self.metrics = {
+            'loads': 0,
+            'hits': 0,
+            'last_load_seconds': 0.0,
+            'total_load_seconds': 0.0,
+            'documents': 0,
+            'matrix_bytes': 0,
+            'mapped_bytes': 0,
+            'vectorizer_file_bytes': 0,
+        }
+
+    # Files whose changes mean the in-memory copy is out of date
+    @property
+    def paths(self):
+        if self.segments.exists():
+            return (self.segments.manifest_path, self.vectorizer_path)
+        if mmap_matrix.is_mmap_matrix(self.mmap_path):
+            return (os.path.join(self.mmap_path, 'meta.json'), self.vectorizer_path)
+        return (self.matrix_path, self.vectorizer_path)
+
+    def _is_stale(self):
+        if self._parts is None:
+            return True
+        signature = _file_signature(self.paths)
+        if signature is None or signature == self._signature:
+            return False
+        if self.check_hash and self._digest is not None and _file_digest(self.paths) == self._digest:
+            # Files were touched but their content is unchanged
+            self._signature = signature
+            return False
+        return True
+
+    def _load(self):
+        start = time.perf_counter()
+        with metrics.timed('load_corpus'):
+            if not self.segments.exists() and not os.path.exists(self.matrix_path):
+                try:
+                    hub_sync.restore_segments(self.segments.directory)
+                except Exception:
+                    # No published segments yet, utils.load_tfidf_data pulls the base files
+                    pass
+            if self.segments.exists():
+                manifest, parts = self.segments.snapshot()
+                vectorizer = self._manifest_vectorizer(manifest)
+            else:
+                tfidf_matrix, vectorizer = utils.load_tfidf_data(self.matrix_path, self.vectorizer_path, self.mmap_path)
+                parts = [tfidf_matrix]
+        elapsed = time.perf_counter() - start
+        self._set(parts, vectorizer)
+        self.metrics['loads'] += 1
+        self.metrics['last_load_seconds'] = elapsed
+        self.metrics['total_load_seconds'] += elapsed
+
+    # Vectorizer matching a manifest version, re-read only when a refit replaced it
+    def _manifest_vectorizer(self, manifest):
+        name = manifest.get('vectorizer')
+        if self._vectorizer is None or name != self._vectorizer_file:
+            self._vectorizer = self.writer.load_vectorizer(manifest)
+            self._vectorizer_file = name
+        return self._vectorizer
+
+    def _set(self, parts, vectorizer):
+        if not self._vectorizers or self._vectorizers[0][0] is not vectorizer:
+            self._vectorizers = [(vectorizer, self._vectorizer_file or '')] + self._vectorizers[:1]
+        self._parts = parts
+        # Stacked lazily, so mapped segments are only copied if someone needs one matrix
+        self._matrix = parts[0] if len(parts) == 1 else None
+        self._vectorizer = vectorizer
+        self._signature = _file_signature(self.paths)
+        self._digest = _file_digest(self.paths) if self.check_hash and self._signature else None
+        self.version += 1
+        if self._digest is not None:
+            self.corpus_id = self._digest
+        elif self._signature is not None:
+            self.corpus_id = hashlib.sha256(repr(self._signature).encode('utf-8')).hexdigest()
+        else:
+            self.corpus_id = f"{os.getpid()}-{self.version}"
+        self.metrics['documents'] = sum(part.shape[0] for part in parts)
+        self.metrics['matrix_bytes'] = sum(_matrix_nbytes(part) for part in parts)
+        self.metrics['mapped_bytes'] = sum(_matrix_nbytes(part) for part in parts if _is_mapped(part))
+        self.metrics['vectorizer_file_bytes'] = self._signature[1][2] if self._signature else 0
+        metrics.set_gauge(metrics.CORPUS_DOCUMENTS, self.metrics['documents'])
+        metrics.set_gauge(metrics.CORPUS_SEGMENTS, len(parts))
+        metrics.set_gauge(metrics.CORPUS_BYTES, self.metrics['matrix_bytes'])
+        metrics.set_gauge(metrics.CORPUS_VERSION, self.version)
+
+    def get(self):
+        """
+        Returns the shared (tfidf_matrix, vectorizer) pair, loading or
+        reloading it from disk only when needed.
+        """
+        with self._lock:
+            if self._is_stale():
+                self._load()
+            else:
+                self.metrics['hits'] += 1
+            if self._matrix is None:
+                self._matrix = vstack(self._parts, format='csr')
+            return self._matrix, self._vectorizer
+
+    def get_parts(self):
+        """
+        Returns ([matrix segments in row order], vectorizer) without stacking
+        the segments into one matrix.
+        """
+        with self._lock:
+            if self._is_stale():
+                self._load()
+            else:
+                self.metrics['hits'] += 1
+            return list(self._parts), self._vectorizer
+
+    def append(self, rows, new_terms=None, vectorizer=None):
+        """
+        Adds already vectorized rows to the corpus through the journal and
+        waits until they are published as a segment. Appends from other
+        sessions and processes queued at the same time go into the same segment.
+
+        Args:
+            rows (scipy.sparse matrix): Vectorized documents.
+            new_terms (list): Optional dict per row of terms the vectorizer
+                does not know, counted towards the next IDF refresh.
+            vectorizer: The vectorizer from get_parts() that produced the
+                rows, the current one if omitted. Rows made before an IDF
+                refresh are re-weighted to the refreshed weights.
+
+        Returns:
+            tuple: (manifest, corpus row of the first appended row)
+        """
+        with self._lock:
+            if vectorizer is None and self._vectorizers:
+                vectorizer = self._vectorizers[0][0]
+            name = next((name for known, name in self._vectorizers if known is vectorizer), None)
+            if self._is_stale():
+                self._load()
+            if not self.segments.exists():
+                self.writer.initialize(vstack(self._parts, format='csr'))
+        ticket = self.writer.submit(rows, new_terms, name)
+        manifest = self.writer.apply()
+        with self._lock:
+            self._set(self.segments.load_parts(manifest), self._manifest_vectorizer(manifest))
+        return manifest, self.writer.row_of(ticket, manifest)
+
+    def stats(self):
+        stats = dict(self.metrics)
+        stats['version'] = self.version
+        stats['corpus_id'] = self.corpus_id
+        # ru_maxrss is reported in kilobytes on Linux
+        stats['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return stats
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+# Shared store for the whole process (Streamlit keeps imported modules across reruns)
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = CorpusStore()
+        return _store
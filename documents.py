@@ -0,0 +1,286 @@
+"""
+Metadata and text of the corpus documents, aligned with the TF-IDF rows.
+
+A matrix row is the only identity a document has in the corpus. The
+DocumentStore keeps, per row, the document id, submitter, course,
+submission time, a content hash and the zlib-compressed original text in
+one SQLite file. Lookups by row use the table's primary key, and filters
+(e.g. one course) return the matching rows, which search.SearchIndex can
+restrict its scoring to. The stored text is what matches are highlighted
+against.
+
+Rows added before the store existed have no entry; they keep their
+"Document N" label, are left out of filtered searches and cannot be
+highlighted.
+
+Usage:
+    python documents.py show 12
+    python documents.py import metadata.csv
+"""
+import csv
+import datetime
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+import numpy as np
+
+from result_cache import text_key
+
+DOCUMENTS_PATH = 'documents.db'
+# Columns returned by get() and get_many(); the text is only read by text()
+FIELDS = ('row', 'id', 'submitter', 'course', 'submitted_at', 'content_hash', 'characters')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    corpus_row INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    submitter TEXT,
+    course TEXT,
+    submitted_at REAL NOT NULL,
+    content_hash TEXT NOT NULL,
+    characters INTEGER NOT NULL,
+    text BLOB
+);
+CREATE INDEX IF NOT EXISTS documents_course ON documents (course, corpus_row);
+CREATE INDEX IF NOT EXISTS documents_submitter ON documents (submitter, corpus_row);
+CREATE INDEX IF NOT EXISTS documents_submitted_at ON documents (submitted_at);
+CREATE INDEX IF NOT EXISTS documents_content_hash ON documents (content_hash);
+"""
+_COLUMNS = 'corpus_row, id, submitter, course, submitted_at, content_hash, characters'
+
+
+def _record(values):
+    return dict(zip(FIELDS, values))
+
+
+def label(row, record=None):
+    """
+    Human-readable name of a corpus row, e.g. "ab12 (jsmith, CS101, 2026-03-01)".
+    """
+    if record is None:
+        return f"Document {row + 1}"
+    details = [record['submitter'], record['course'],
+               datetime.datetime.fromtimestamp(record['submitted_at']).strftime('%Y-%m-%d')]
+    return f"{record['id']} ({', '.join(detail for detail in details if detail)})"
+
+
+class DocumentStore:
+    """
+    SQLite table of document metadata and compressed text keyed by corpus row.
+
+    One connection is shared by the threads of a process behind a lock. The
+    database runs in WAL mode, so other processes (the app and the service)
+    can read while one of them adds documents.
+
+    Args:
+        path (str): SQLite file, created on first use.
+        compression (int): zlib level of the stored texts.
+    """
+
+    def __init__(self, path=DOCUMENTS_PATH, compression=6):
+        self.path = path
+        self.compression = compression
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript(SCHEMA)
+
+    def _compress(self, text):
+        return zlib.compress(text.encode('utf-8'), self.compression)
+
+    def add(self, row, text, doc_id=None, submitter=None, course=None, timestamp=None):
+        """
+        Records the document stored in a corpus row.
+
+        Args:
+            row (int): Corpus row the document was appended as.
+            text (str): Original document text.
+            doc_id (str): Stable id, e.g. the LMS submission id; generated if omitted.
+            submitter (str): Student or author.
+            course (str): Course or assignment the document belongs to.
+            timestamp (float): Submission time in seconds since the epoch, now if omitted.
+
+        Returns:
+            str: The document id.
+        """
+        doc_id = doc_id or uuid.uuid4().hex
+        with self._lock, self._connection:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO documents ({_COLUMNS}, text) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (row, doc_id, submitter, course, time.time() if timestamp is None else timestamp,
+                 text_key(text), len(text), self._compress(text)))
+        return doc_id
+
+    def add_many(self, records):
+        """
+        Records many documents in one transaction.
+
+        Args:
+            records (iterable): Dicts with 'row' and 'text' (None when the text
+                is not available), and optionally 'id', 'submitter', 'course' and 'submitted_at'.
+
+        Returns:
+            int: Documents recorded.
+        """
+        now = time.time()
+        values = [(record['row'], record.get('id') or uuid.uuid4().hex, record.get('submitter'),
+                   record.get('course'), record.get('submitted_at') or now,
+                   text_key(record['text'] or ''), len(record['text'] or ''),
+                   None if record['text'] is None else self._compress(record['text']))
+                  for record in records]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                f"INSERT OR REPLACE INTO documents ({_COLUMNS}, text) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", values)
+        return len(values)
+
+    def get(self, row):
+        """
+        Metadata of a corpus row as a dict of FIELDS, or None.
+        """
+        with self._lock:
+            values = self._connection.execute(
+                f"SELECT {_COLUMNS} FROM documents WHERE corpus_row = ?", (int(row),)).fetchone()
+        return None if values is None else _record(values)
+
+    def get_many(self, rows):
+        """
+        Metadata of several corpus rows as {row: dict}; rows without an entry are left out.
+        """
+        rows = sorted({int(row) for row in rows})
+        if not rows:
+            return {}
+        with self._lock:
+            found = self._connection.execute(
+                f"SELECT {_COLUMNS} FROM documents WHERE corpus_row IN ({','.join('?' * len(rows))})",
+                rows).fetchall()
+        return {values[0]: _record(values) for values in found}
+
+    def text(self, row):
+        """
+        Original text of a corpus row, or None when it was not stored.
+        """
+        with self._lock:
+            values = self._connection.execute(
+                "SELECT text FROM documents WHERE corpus_row = ?", (int(row),)).fetchone()
+        if values is None or values[0] is None:
+            return None
+        return zlib.decompress(values[0]).decode('utf-8')
+
+    def labels(self, rows):
+        """
+        label() of each row as {row: str}.
+        """
+        records = self.get_many(rows)
+        return {int(row): label(int(row), records.get(int(row))) for row in rows}
+
+    def rows(self, course=None, submitter=None, since=None, until=None, exclude_submitter=None):
+        """
+        Corpus rows whose metadata matches every given filter.
+
+        Args:
+            course (str): Only documents of this course.
+            submitter (str): Only documents of this submitter.
+            since (float): Only documents submitted at or after this time.
+            until (float): Only documents submitted before this time.
+            exclude_submitter (str): Leave out this submitter's own documents.
+
+        Returns:
+            np.ndarray: Sorted int64 rows, for SearchIndex.search_many(rows=...).
+        """
+        conditions, values = [], []
+        for condition, value in (('course = ?', course), ('submitter = ?', submitter),
+                                 ('submitted_at >= ?', since), ('submitted_at < ?', until),
+                                 ('submitter IS NOT ?', exclude_submitter)):
+            if value is not None:
+                conditions.append(condition)
+                values.append(value)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ''
+        with self._lock:
+            found = self._connection.execute(
+                f"SELECT corpus_row FROM documents{where} ORDER BY corpus_row", values).fetchall()
+        return np.fromiter((values[0] for values in found), dtype=np.int64, count=len(found))
+
+    def find_hash(self, content_hash):
+        """
+        Rows whose text has this content hash (result_cache.text_key).
+        """
+        with self._lock:
+            found = self._connection.execute(
+                "SELECT corpus_row FROM documents WHERE content_hash = ? ORDER BY corpus_row",
+                (content_hash,)).fetchall()
+        return [values[0] for values in found]
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+# Shared store for the process, next to the corpus files
+def get_store(path=DOCUMENTS_PATH):
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = DocumentStore(path)
+        return _store
+
+
+# Records of a CSV with a 'row' column and optional id, submitter, course, submitted_at and path columns
+def _read_csv(path):
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for entry in csv.DictReader(f):
+            text = None
+            if entry.get('path'):
+                import utils
+                text = utils.read_files(os.path.join(directory, entry['path']))
+            submitted_at = entry.get('submitted_at')
+            if submitted_at:
+                try:
+                    submitted_at = float(submitted_at)
+                except ValueError:
+                    submitted_at = datetime.datetime.fromisoformat(submitted_at).timestamp()
+            yield {'row': int(entry['row']), 'text': text, 'id': entry.get('id') or None,
+                   'submitter': entry.get('submitter') or None, 'course': entry.get('course') or None,
+                   'submitted_at': submitted_at or None}
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show or import the metadata of corpus documents.")
+    parser.add_argument('command', choices=['show', 'import'])
+    parser.add_argument('target', help="Corpus row (show) or CSV file (import)")
+    parser.add_argument('--database', default=DOCUMENTS_PATH)
+    args = parser.parse_args(argv)
+
+    store = DocumentStore(args.database)
+    if args.command == 'show':
+        record = store.get(int(args.target))
+        if record is None:
+            print(f"No metadata for row {args.target}.")
+            return
+        for name in FIELDS:
+            print(f"{name:>13}: {record[name]}")
+        text = store.text(record['row'])
+        if text is not None:
+            print(f"\n{text[:1000]}{'...' if len(text) > 1000 else ''}")
+    else:
+        count = store.add_many(_read_csv(args.target))
+        print(f"Recorded {count} documents, {len(store)} in {args.database}.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+import io
+import os
+import signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import metrics
+
+FORMATS = ('txt', 'docx', 'pdf')
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+# Work out the document format from the file name, falling back to magic bytes
+def detect_format(source, filename=None):
+    name = filename or (source if isinstance(source, str) else getattr(source, 'name', None))
+    if isinstance(name, str):
+        extension = os.path.splitext(name)[1].lower().lstrip('.')
+        if extension in FORMATS:
+            return extension
+    if isinstance(source, (bytes, bytearray)):
+        head = bytes(source[:5])
+    elif isinstance(source, str):
+        with open(source, 'rb') as f:
+            head = f.read(5)
+    else:
+        position = source.tell()
+        head = source.read(5)
+        source.seek(position)
+    if head.startswith(b'%PDF'):
+        return 'pdf'
+    if head.startswith(b'PK'):
+        return 'docx'
+    return 'txt'
+
+
+# Open a path, bytes or file-like object as a binary stream
+def _open_binary(source):
+    if isinstance(source, (bytes, bytearray)):
+        return io.BytesIO(source), True
+    if isinstance(source, str):
+        return open(source, 'rb'), True
+    return source, False
+
+
+# Stream the text of a PDF one page at a time
+def iter_pdf_pages(source, start=0, stop=None):
+    # PyPDF2 and python-docx are imported on first use, they are slow to import
+    import PyPDF2
+    stream, owned = _open_binary(source)
+    try:
+        pdf_reader = PyPDF2.PdfReader(stream)
+        pages = pdf_reader.pages
+        for page_number in range(start, len(pages) if stop is None else min(stop, len(pages))):
+            yield pages[page_number].extract_text() or ''
+    finally:
+        if owned:
+            stream.close()
+
+
+# Stream the non-empty paragraphs of a Word document
+def iter_docx_paragraphs(source):
+    from docx import Document
+    stream, owned = _open_binary(source)
+    try:
+        for paragraph in Document(stream).paragraphs:
+            if paragraph.text:
+                yield paragraph.text
+    finally:
+        if owned:
+            stream.close()
+
+
+# Stream the non-empty lines of a UTF-8 text file
+def iter_txt_lines(source):
+    stream, owned = _open_binary(source)
+    text = io.TextIOWrapper(stream, encoding='utf-8', errors='replace')
+    try:
+        for line in text:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if owned:
+            text.close()
+        else:
+            # Detaching keeps the caller's stream open
+            text.detach()
+
+
+CHUNK_READERS = {
+    'pdf': iter_pdf_pages,
+    'docx': iter_docx_paragraphs,
+    'txt': iter_txt_lines,
+}
+
+
+def iter_chunks(file_or_bytes, filename=None):
+    """
+    Streams a document as text chunks: pages for PDF, paragraphs for Word
+    and lines for text files.
+    """
+    return CHUNK_READERS[detect_format(file_or_bytes, filename)](file_or_bytes)
+
+
+# Raise ExtractionTimeout in the current (main) thread after timeout seconds, Unix only
+@contextmanager
+def deadline(timeout):
+    if not timeout:
+        yield
+        return
+
+    def _on_timeout(signum, frame):
+        raise ExtractionTimeout(f"Extraction took longer than {timeout}s")
+
+    previous = signal.signal(signal.SIGALRM, _on_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def extract(file_or_bytes, filename=None, timeout=None):
+    """
+    Extracts the text of a .txt, .docx or .pdf document.
+
+    Args:
+        file_or_bytes: Path, raw bytes or binary file-like object (e.g. a Streamlit upload).
+        filename (str): Optional name used to detect the format.
+        timeout (float): Seconds before ExtractionTimeout is raised (main thread, Unix only).
+
+    Returns:
+        str: The document text with chunks joined by spaces.
+    """
+    document_format = detect_format(file_or_bytes, filename)
+    size = _source_size(file_or_bytes)
+    if size is not None:
+        metrics.observe(metrics.UPLOAD_BYTES, size, format=document_format)
+    with metrics.timed('extract', format=document_format, bytes=size), deadline(timeout):
+        return ' '.join(CHUNK_READERS[document_format](file_or_bytes))
+
+
+# Size in bytes of a path or bytes source, None for streams
+def _source_size(source):
+    if isinstance(source, (bytes, bytearray)):
+        return len(source)
+    if isinstance(source, str):
+        return os.path.getsize(source)
+    return None
+
+
+# Worker for ExtractionPool, errors are returned rather than raised
+def _extract_task(source, filename, timeout):
+    try:
+        return extract(source, filename, timeout=timeout), None
+    except Exception as e:
+        return '', f"{type(e).__name__}: {e}"
+
+
+# Worker extracting a slice of PDF pages
+def _extract_pages_task(source, start, stop, timeout):
+    with deadline(timeout):
+        return ' '.join(iter_pdf_pages(source, start, stop))
+
+
+class ExtractionPool:
+    """
+    Process pool for CPU-bound document extraction.
+
+    Each task runs under its own timeout inside the worker, so a pathological
+    PDF fails with ExtractionTimeout instead of blocking a worker. At most
+    max_pending documents are in flight, which bounds memory when streaming
+    through large folders.
+
+    Args:
+        workers (int): Worker processes, defaults to all cores.
+        timeout (float): Per-document (or per-page-range) timeout in seconds.
+        max_pending (int): Maximum number of submitted, unfinished tasks.
+        initializer, initargs: Optional per-worker setup, as for ProcessPoolExecutor.
+    """
+
+    def __init__(self, workers=None, timeout=60, max_pending=None, initializer=None, initargs=()):
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.max_pending = max_pending or self.workers * 4
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=initializer, initargs=initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(cancel_futures=True)
+
+    def map_tasks(self, task, sources):
+        """
+        Runs task(source, filename, timeout) for each source in the workers,
+        yielding results in input order with at most max_pending in flight.
+
+        Args:
+            task: Picklable module-level function.
+            sources: Iterable of paths, bytes, or (source, filename) pairs.
+        """
+        pending = deque()
+        for source in sources:
+            source, filename = source if isinstance(source, tuple) else (source, None)
+            pending.append(self._executor.submit(task, source, filename, self.timeout))
+            if len(pending) >= self.max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def extract_many(self, sources):
+        """
+        Extracts documents in parallel, yielding results in input order.
+
+        Args:
+            sources: Iterable of paths, bytes, or (source, filename) pairs.
+
+        Yields:
+            tuple: (text, error) where error is None on success.
+        """
+        return self.map_tasks(_extract_task, sources)
+
+    def extract_pdf(self, source, pages_per_task=20):
+        """
+        Extracts one large PDF by splitting its pages across the workers.
+        """
+        import PyPDF2
+        stream, owned = _open_binary(source)
+        try:
+            page_count = len(PyPDF2.PdfReader(stream).pages)
+        finally:
+            if owned:
+                stream.close()
+        if not isinstance(source, (str, bytes)):
+            source.seek(0)
+            source = source.read()
+        futures = [
+            self._executor.submit(_extract_pages_task, source, start, start + pages_per_task, self.timeout)
+            for start in range(0, page_count, pages_per_task)
+        ]
+        return ' '.join(future.result() for future in futures)
@@ -0,0 +1,354 @@
+"""
+Passage-level copy detection with word shingles, winnowing and MinHash.
+
+Each document is reduced to a small set of winnowed shingle hashes, each
+remembering the character span it covers. Fingerprints of all indexed
+documents live in flat NumPy arrays kept sorted by hash, so finding every
+document sharing a passage with a query is a binary search per query
+fingerprint rather than a scan of the corpus. A MinHash signature per
+document feeds an LSH band index for whole-document near duplicates.
+
+The shared index is persisted as an append-only log of per-document
+records (fingerprints.log), so each accepted report costs one small append
+and every process picks up the reports the others added.
+"""
+import hashlib
+import os
+import re
+import struct
+import threading
+import zlib
+from collections import defaultdict, namedtuple
+
+import numpy as np
+
+WORD_PATTERN = re.compile(r"\w+")
+SHINGLE_PRIME = np.uint64(1099511628211)
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+# Estimated Jaccard similarity above which a report counts as a copy of a whole document
+NEAR_DUPLICATE_SIMILARITY = 0.9
+
+# Log file: header with the index parameters, then per document: doc_id, fingerprint count, CRC of
+# the payload, then its MinHash signature, hashes, start and end offsets
+LOG_MAGIC = b'FPLOG001'
+LOG_HEADER = struct.Struct('<8s5q')
+RECORD_HEADER = struct.Struct('<qII')
+
+PassageMatch = namedtuple('PassageMatch', [
+    'doc_id', 'query_start', 'query_end', 'reference_start', 'reference_end', 'fingerprints',
+])
+
+
+# Stable 64-bit hash per distinct word (Python's hash() is salted per process)
+def _word_hashes(words):
+    cache = {}
+    hashes = np.empty(len(words), dtype=np.uint64)
+    for i, word in enumerate(words):
+        value = cache.get(word)
+        if value is None:
+            value = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+            cache[word] = value
+        hashes[i] = value
+    return hashes
+
+
+def fingerprints(text, shingle_size=5, window=4):
+    """
+    Winnowed word-shingle fingerprints of a text.
+
+    Args:
+        text (str): Raw document text.
+        shingle_size (int): Words per shingle.
+        window (int): Winnowing window, in shingles. Any copied run of at
+            least shingle_size + window - 1 words is guaranteed a shared fingerprint.
+
+    Returns:
+        tuple: (hashes, positions, starts, ends) arrays: the word index of
+        each fingerprint and the character offsets of the passage it covers.
+    """
+    matches = list(WORD_PATTERN.finditer(text.lower()))
+    if len(matches) < shingle_size:
+        return (np.empty(0, dtype=np.uint64),) + tuple(np.empty(0, dtype=np.int64) for _ in range(3))
+    words = _word_hashes([match.group() for match in matches])
+    word_starts = np.fromiter((match.start() for match in matches), dtype=np.int64, count=len(matches))
+    word_ends = np.fromiter((match.end() for match in matches), dtype=np.int64, count=len(matches))
+
+    # Polynomial hash of every run of shingle_size words (uint64 arithmetic wraps)
+    n_shingles = len(words) - shingle_size + 1
+    shingles = np.zeros(n_shingles, dtype=np.uint64)
+    for offset in range(shingle_size):
+        shingles = shingles * SHINGLE_PRIME + words[offset:offset + n_shingles]
+
+    # Winnowing keeps the minimum hash of every window of consecutive shingles
+    if n_shingles <= window:
+        selected = np.array([np.argmin(shingles)])
+    else:
+        windows = np.lib.stride_tricks.sliding_window_view(shingles, window)
+        selected = np.unique(np.argmin(windows, axis=1) + np.arange(len(windows)))
+    return shingles[selected], selected, word_starts[selected], word_ends[selected + shingle_size - 1]
+
+
+class MinHasher:
+    """
+    MinHash signatures over fingerprint hashes, using (a * x + b) mod (2^61 - 1)
+    permutations of the low 32 bits of each hash.
+    """
+
+    def __init__(self, num_perm=64, seed=1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+
+    def signature(self, hashes, chunk_size=8192):
+        signature = np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint64)
+        # Chunked so long documents never build a num_perm x n_hashes array
+        for start in range(0, len(hashes), chunk_size):
+            values = (hashes[start:start + chunk_size] & MAX_HASH)[np.newaxis, :]
+            permuted = (self.a[:, np.newaxis] * values + self.b[:, np.newaxis]) % MERSENNE_PRIME
+            np.minimum(signature, permuted.min(axis=1), out=signature)
+        return (signature & MAX_HASH).astype(np.uint32)
+
+
+class FingerprintIndex:
+    """
+    Index of winnowed fingerprints and MinHash signatures for many documents.
+
+    With a path, the index is backed by an append-only log: add() appends one
+    CRC-checked record per document under a file lock, and refresh() reads
+    only the records written since the last read, by this or any other
+    process. Adding a document costs I/O proportional to the document, and
+    concurrent writers never overwrite each other. Without a path the index
+    lives in memory only.
+
+    Args:
+        shingle_size (int): Words per shingle.
+        window (int): Winnowing window size.
+        num_perm (int): MinHash permutations, split into bands for LSH.
+        bands (int): LSH bands; num_perm must be divisible by it.
+        max_postings (int): Fingerprints shared by more documents than this
+            (boilerplate such as assignment questions) are ignored at query time.
+        path (str): Optional log file; when it exists its own parameters are used.
+    """
+
+    def __init__(self, shingle_size=5, window=4, num_perm=64, bands=16, max_postings=50, path=None):
+        if path is not None and os.path.exists(path) and os.path.getsize(path) >= LOG_HEADER.size:
+            with open(path, 'rb') as f:
+                magic, *params = LOG_HEADER.unpack(f.read(LOG_HEADER.size))
+            if magic != LOG_MAGIC:
+                raise ValueError(f"{path} is not a fingerprint log.")
+            shingle_size, window, num_perm, bands, max_postings = params
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands.")
+        self.shingle_size = shingle_size
+        self.window = window
+        self.bands = bands
+        self.max_postings = max_postings
+        self.minhasher = MinHasher(num_perm)
+        self.path = path
+        self._offset = LOG_HEADER.size
+        self._lock = threading.Lock()
+        self.doc_ids = np.empty(0, dtype=np.int64)
+        self.signatures = np.empty((0, num_perm), dtype=np.uint32)
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.owners = np.empty(0, dtype=np.int32)
+        self.starts = np.empty(0, dtype=np.int32)
+        self.ends = np.empty(0, dtype=np.int32)
+        self._pending = []
+        self._buckets = defaultdict(list)
+        self.refresh()
+
+    def __len__(self):
+        return len(self.doc_ids) + len(self._pending)
+
+    def _band_keys(self, signature):
+        rows = len(signature) // self.bands
+        return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(self.bands)]
+
+    # Queue a fingerprinted document for the next merge (called under the lock)
+    def _queue(self, doc_id, signature, hashes, starts, ends):
+        self._pending.append((doc_id, signature, hashes, starts, ends))
+        # Documents too short to fingerprint would all share one signature
+        if len(hashes):
+            for key in self._band_keys(signature):
+                self._buckets[key].append(doc_id)
+
+    def add(self, doc_id, text):
+        """
+        Fingerprints a document and adds it to the index under doc_id
+        (typically its corpus row), appending it to the log if there is one.
+        """
+        hashes, _, starts, ends = fingerprints(text, self.shingle_size, self.window)
+        signature = self.minhasher.signature(hashes)
+        starts, ends = starts.astype(np.int32), ends.astype(np.int32)
+        if self.path is None:
+            with self._lock:
+                self._queue(doc_id, signature, hashes, starts, ends)
+            return
+        payload = signature.tobytes() + hashes.tobytes() + starts.tobytes() + ends.tobytes()
+        record = RECORD_HEADER.pack(doc_id, len(hashes), zlib.crc32(payload)) + payload
+        # The journal's file lock; imported here so utils does not load the writer at startup
+        from journal import FileLock
+        with FileLock(f"{self.path}.lock"):
+            # Read what others wrote first; anything past it was torn by a crash and is dropped
+            self.refresh()
+            with open(self.path, 'ab') as f:
+                if f.tell() < LOG_HEADER.size:
+                    f.truncate(0)
+                    f.write(LOG_HEADER.pack(LOG_MAGIC, self.shingle_size, self.window,
+                                            self.minhasher.num_perm, self.bands, self.max_postings))
+                elif f.tell() > self._offset:
+                    f.truncate(self._offset)
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+        self.refresh()
+
+    def refresh(self):
+        """
+        Reads the log records added since the last refresh. A record still
+        being written is left for the next one.
+
+        Returns:
+            int: Documents read.
+        """
+        if self.path is None or not os.path.exists(self.path):
+            return 0
+        with self._lock:
+            if os.path.getsize(self.path) <= self._offset:
+                return 0
+            with open(self.path, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+            offset, count, num_perm = 0, 0, self.minhasher.num_perm
+            while offset + RECORD_HEADER.size <= len(data):
+                doc_id, n_hashes, checksum = RECORD_HEADER.unpack_from(data, offset)
+                start = offset + RECORD_HEADER.size
+                end = start + num_perm * 4 + n_hashes * 16
+                payload = data[start:end]
+                if end > len(data) or zlib.crc32(payload) != checksum:
+                    break
+                signature = np.frombuffer(payload, dtype=np.uint32, count=num_perm)
+                hashes = np.frombuffer(payload, dtype=np.uint64, count=n_hashes, offset=num_perm * 4)
+                starts = np.frombuffer(payload, dtype=np.int32, count=n_hashes, offset=num_perm * 4 + n_hashes * 8)
+                ends = np.frombuffer(payload, dtype=np.int32, count=n_hashes, offset=num_perm * 4 + n_hashes * 12)
+                self._queue(doc_id, signature, hashes, starts, ends)
+                offset, count = end, count + 1
+            self._offset += offset
+            return count
+
+    # Merge pending documents into the sorted arrays (called under the lock)
+    def _merge_pending(self):
+        if not self._pending:
+            return
+        doc_ids, signatures, hashes, starts, ends = zip(*self._pending)
+        self._pending = []
+        self.doc_ids = np.concatenate([self.doc_ids, np.asarray(doc_ids, dtype=np.int64)])
+        self.signatures = np.vstack([self.signatures, np.vstack(signatures)])
+        # Only the new fingerprints are sorted; they are inserted into the sorted arrays by position
+        new_hashes = np.concatenate(hashes)
+        order = np.argsort(new_hashes, kind='stable')
+        positions = np.searchsorted(self.hashes, new_hashes[order], side='right')
+        owners = np.concatenate([np.full(len(h), doc_id, dtype=np.int32) for doc_id, h in zip(doc_ids, hashes)])
+        self.hashes = np.insert(self.hashes, positions, new_hashes[order])
+        self.owners = np.insert(self.owners, positions, owners[order])
+        self.starts = np.insert(self.starts, positions, np.concatenate(starts)[order])
+        self.ends = np.insert(self.ends, positions, np.concatenate(ends)[order])
+
+    def find_passages(self, text, min_fingerprints=2, exclude=None):
+        """
+        Finds passages of text copied from indexed documents.
+
+        Args:
+            text (str): Raw query text.
+            min_fingerprints (int): Shared fingerprints needed to report a passage.
+            exclude (int): Optional doc_id to ignore (e.g. the query document itself).
+
+        Returns:
+            list: PassageMatch tuples ordered by document then query offset.
+        """
+        query_hashes, query_positions, query_starts, query_ends = fingerprints(text, self.shingle_size, self.window)
+        with self._lock:
+            self._merge_pending()
+            left = np.searchsorted(self.hashes, query_hashes, side='left')
+            right = np.searchsorted(self.hashes, query_hashes, side='right')
+            counts = right - left
+            usable = (counts > 0) & (counts <= self.max_postings)
+            query_index = np.repeat(np.nonzero(usable)[0], counts[usable])
+            entries = np.concatenate([np.arange(l, r) for l, r in zip(left[usable], right[usable])]) \
+                if usable.any() else np.empty(0, dtype=np.int64)
+            owners = self.owners[entries]
+            reference_starts = self.starts[entries]
+            reference_ends = self.ends[entries]
+
+        passages = []
+        # Winnowing leaves at most one window between fingerprints of a copied run
+        gap = self.shingle_size + self.window
+        for doc_id in np.unique(owners):
+            if exclude is not None and doc_id == exclude:
+                continue
+            mine = owners == doc_id
+            if mine.sum() < min_fingerprints:
+                continue
+            q_index = query_index[mine]
+            order = np.argsort(q_index, kind='stable')
+            q_index, r_starts, r_ends = q_index[order], reference_starts[mine][order], reference_ends[mine][order]
+            # Fingerprints close together in the query belong to one copied passage
+            breaks = np.nonzero(np.diff(query_positions[q_index]) > gap)[0] + 1
+            for group in np.split(np.arange(len(q_index)), breaks):
+                if len(group) < min_fingerprints:
+                    continue
+                passages.append(PassageMatch(
+                    int(doc_id),
+                    int(query_starts[q_index[group]].min()),
+                    int(query_ends[q_index[group]].max()),
+                    int(r_starts[group].min()),
+                    int(r_ends[group].max()),
+                    len(group),
+                ))
+        return passages
+
+    def near_duplicates(self, text, min_similarity=0.5):
+        """
+        Whole-document near duplicates via MinHash LSH.
+
+        Returns:
+            list: (doc_id, estimated Jaccard similarity) pairs, best first.
+        """
+        hashes = fingerprints(text, self.shingle_size, self.window)[0]
+        if not len(hashes):
+            return []
+        signature = self.minhasher.signature(hashes)
+        with self._lock:
+            self._merge_pending()
+            candidates = {doc_id for key in self._band_keys(signature) for doc_id in self._buckets.get(key, ())}
+            if not candidates:
+                return []
+            rows = np.nonzero(np.isin(self.doc_ids, list(candidates)))[0]
+            similarity = (self.signatures[rows] == signature).mean(axis=1)
+            results = [(int(self.doc_ids[row]), float(score)) for row, score in zip(rows, similarity)
+                       if score >= min_similarity]
+        return sorted(results, key=lambda result: -result[1])
+
+
+# Copied passages between two texts, e.g. a report and one reference document
+def compare(text, reference_text, **kwargs):
+    index = FingerprintIndex(**kwargs)
+    index.add(0, reference_text)
+    return index.find_passages(text)
+
+
+FINGERPRINT_PATH = 'fingerprints.log'
+_index = None
+_index_lock = threading.Lock()
+
+
+# Shared index for the process, with the documents other processes have added since the last call
+def get_index(path=FINGERPRINT_PATH):
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = FingerprintIndex(path=path)
+    _index.refresh()
+    return _index
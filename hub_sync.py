@@ -0,0 +1,256 @@
+import atexit
+import fnmatch
+import json
+import os
+import random
+import shutil
+import threading
+import time
+
+import metrics
+import segments
+
+REPO_ID = "Isuru0x01/plagiarism_checker_tfidf"
+
+
+class LocalHub:
+    """
+    Stand-in for huggingface_hub.HfApi that copies files into a local folder.
+
+    Args:
+        root (str): Folder playing the role of the hub repositories.
+        fail_times (int): Number of initial upload and listing calls that raise, for retry tests.
+    """
+
+    def __init__(self, root, fail_times=0):
+        self.root = root
+        self.fail_times = fail_times
+        self.calls = []
+
+    def _target(self, repo_id, path_in_repo):
+        target = os.path.join(self.root, repo_id, path_in_repo)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        return target
+
+    def _maybe_fail(self):
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise ConnectionError("Simulated hub failure")
+
+    def upload_file(self, path_or_fileobj, path_in_repo, repo_id, repo_type="model"):
+        self._maybe_fail()
+        self.calls.append(('upload_file', path_in_repo))
+        if isinstance(path_or_fileobj, bytes):
+            with open(self._target(repo_id, path_in_repo), 'wb') as f:
+                f.write(path_or_fileobj)
+        else:
+            shutil.copyfile(path_or_fileobj, self._target(repo_id, path_in_repo))
+
+    def upload_folder(self, folder_path, path_in_repo, repo_id, repo_type="model"):
+        self._maybe_fail()
+        self.calls.append(('upload_folder', path_in_repo))
+        shutil.copytree(folder_path, self._target(repo_id, path_in_repo), dirs_exist_ok=True)
+
+    def _files(self, repo_id):
+        root = os.path.join(self.root, repo_id)
+        return [os.path.relpath(os.path.join(directory, name), root).replace(os.sep, '/')
+                for directory, _, names in os.walk(root) for name in names]
+
+    def list_repo_files(self, repo_id, repo_type="model"):
+        self._maybe_fail()
+        return self._files(repo_id)
+
+    def snapshot_download(self, repo_id, allow_patterns, local_dir, repo_type="model"):
+        root = os.path.join(self.root, repo_id)
+        for path in self._files(repo_id):
+            if any(fnmatch.fnmatch(path, pattern) for pattern in allow_patterns):
+                target = os.path.join(local_dir, path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                shutil.copyfile(os.path.join(root, path), target)
+        return local_dir
+
+
+class HubSyncWorker:
+    """
+    Background thread that pushes corpus segments to the Hugging Face Hub.
+
+    The request path only calls mark_dirty(), which records segment names and
+    returns at once. The worker wakes every interval seconds when something
+    was marked, uploads every file of the current manifest that the hub does
+    not have yet (new append segments, a base written by the first append,
+    a compaction or a refit, stats and vectorizer files), followed by that
+    manifest, so many appends are coalesced into a single sync. Failed
+    uploads are retried with exponential backoff and stay queued for the
+    next interval if they keep failing.
+
+    Args:
+        api: Object with HfApi's upload_file/upload_folder/list_repo_files
+            methods (e.g. LocalHub in tests).
+        segment_dir (str): Local segment store folder.
+        repo_id (str): Hub repository to upload to.
+        interval (float): Seconds between syncs.
+        max_retries (int): Attempts per upload before giving up until the next sync.
+        backoff (float): Initial retry delay in seconds, doubled on each retry.
+    """
+
+    def __init__(self, api=None, segment_dir='tfidf_segments', repo_id=REPO_ID,
+                 interval=30.0, max_retries=5, backoff=1.0):
+        if api is None:
+            from huggingface_hub import HfApi
+            api = HfApi()
+        self.api = api
+        self.segment_dir = segment_dir
+        self.repo_id = repo_id
+        self.interval = interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.stats = {'syncs': 0, 'uploads': 0, 'retries': 0, 'failures': 0, 'last_error': None}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopped.clear()
+                self._thread = threading.Thread(target=self._run, name='hub-sync', daemon=True)
+                self._thread.start()
+        return self
+
+    def stop(self, flush=True):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        if flush:
+            self.flush()
+
+    def mark_dirty(self, *names):
+        """
+        Queues segment names for upload, which also brings every other file of
+        the current manifest up to date on the hub. Never blocks on the network.
+        """
+        with self._lock:
+            self._pending.update(names)
+
+    def pending(self):
+        with self._lock:
+            return set(self._pending)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if not self._stopped.is_set():
+                self.flush()
+
+    # Upload a file or folder of the segment store, or the given bytes under its name
+    def _upload(self, name, data=None):
+        path = os.path.join(self.segment_dir, name)
+        path_in_repo = f"tfidf_segments/{name}"
+        with metrics.timed('hub_upload', file=name):
+            if os.path.isdir(path):
+                succeeded, _ = self._with_retries(lambda: self.api.upload_folder(
+                    folder_path=path, path_in_repo=path_in_repo, repo_id=self.repo_id, repo_type="model"))
+            else:
+                succeeded, _ = self._with_retries(lambda: self.api.upload_file(
+                    path_or_fileobj=path if data is None else data, path_in_repo=path_in_repo,
+                    repo_id=self.repo_id, repo_type="model"))
+        if succeeded:
+            self.stats['uploads'] += 1
+        return succeeded
+
+    # Upload the part of the stats log a manifest version owns; False when it could not be uploaded
+    def _upload_stats_log(self, manifest):
+        try:
+            with open(os.path.join(self.segment_dir, manifest['stats_log']), 'rb') as f:
+                data = f.read(manifest['stats_log_size'])
+        except FileNotFoundError:
+            # Folded into a stats file by a newer version, which the next sync uploads
+            return False
+        return self._upload(manifest['stats_log'], data)
+
+    # Run a hub call, retrying with exponential backoff; returns (succeeded, result)
+    def _with_retries(self, call):
+        delay = self.backoff
+        for attempt in range(self.max_retries):
+            try:
+                return True, call()
+            except Exception as e:
+                self.stats['last_error'] = f"{type(e).__name__}: {e}"
+                if attempt + 1 < self.max_retries:
+                    self.stats['retries'] += 1
+                    time.sleep(delay * (1 + random.random() / 2))
+                    delay *= 2
+        self.stats['failures'] += 1
+        return False, None
+
+    # Names of the segment store files already on the hub; a folder segment counts once any of its files is
+    def _published(self):
+        succeeded, files = self._with_retries(lambda: self.api.list_repo_files(repo_id=self.repo_id,
+                                                                                repo_type="model"))
+        if not succeeded:
+            return None
+        return {path.split('/')[1] for path in files if path.startswith('tfidf_segments/')}
+
+    def flush(self):
+        """
+        Uploads every file of the current manifest missing from the hub, then
+        the manifest itself. The manifest is uploaded as it was read, so the
+        hub never names a file it does not have.
+
+        Returns:
+            bool: True when everything pending was uploaded.
+        """
+        with self._lock:
+            names, self._pending = self._pending, set()
+        if not names:
+            return True
+
+        store = segments.SegmentStore(self.segment_dir)
+        manifest = store.read_manifest()
+        published = self._published()
+        failed = published is None
+        if not failed:
+            files = [segment['name'] for segment in manifest['segments']]
+            # Corpus statistics and, after an IDF refresh, the vectorizer published with the manifest
+            files += [manifest[key] for key in ('stats', 'vectorizer') if manifest.get(key)]
+            failed = not all(self._upload(name) for name in files if name not in published)
+        if not failed and manifest.get('stats_log'):
+            # The stats log grows in place, so the part this version owns is uploaded on every sync
+            failed = not self._upload_stats_log(manifest)
+        if not failed:
+            failed = not self._upload(segments.MANIFEST, json.dumps(manifest, indent=2).encode('utf-8'))
+        if failed:
+            with self._lock:
+                self._pending.update(names)
+            return False
+        self.stats['syncs'] += 1
+        return True
+
+
+# Download the published segment store, e.g. on a fresh host with no local data
+def restore_segments(segment_dir='tfidf_segments', repo_id=REPO_ID, api=None):
+    if api is None:
+        from huggingface_hub import HfApi
+        api = HfApi()
+    name = os.path.basename(os.path.normpath(segment_dir))
+    api.snapshot_download(repo_id=repo_id, allow_patterns=[f"{name}/*", f"{name}/*/*"],
+                          local_dir=os.path.dirname(os.path.abspath(segment_dir)))
+    return os.path.exists(os.path.join(segment_dir, segments.MANIFEST))
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+# Shared sync worker for the whole process, flushed when the process exits
+def get_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = HubSyncWorker().start()
+            atexit.register(_worker.stop)
+        return _worker
@@ -0,0 +1,365 @@
+"""
+Concurrency-safe corpus writes through a write-ahead journal.
+
+Any process may submit rows: the rows are appended to the current journal
+file under a short exclusive lock and fsynced before submit() returns.
+Applying the journal is single-writer: whoever holds the writer lock
+rotates the journal, turns every queued entry into one segment and
+publishes a new manifest version by atomic rename. Readers only ever open
+the manifest and immutable segments, so they never wait on writers and
+never see a half-written file.
+
+Each manifest records which journal generations it has applied, so a
+crash between publishing and deleting a journal file is replayed
+idempotently. File locking uses fcntl and is Unix only.
+
+Every manifest version also names a corpus_stats.CorpusStats file and the
+vectorizer that matches its columns, so refit() can rebuild IDF weights and
+the vocabulary and publish them together with the re-weighted matrix.
+Applied batches are not written into the stats file: their rows and new
+terms are appended to a stats log in the journal's record format, and the
+manifest records how many bytes of it belong to the version. The log is
+folded into a new stats file by refit() and before a compaction. Like
+segments, the files a version replaces are kept until the next version is
+published.
+"""
+import fcntl
+import io
+import json
+import os
+import pickle
+import re
+import struct
+import zlib
+
+from scipy import sparse
+from scipy.sparse import vstack
+
+import corpus_stats
+from segments import atomic_write
+
+RECORD_HEADER = struct.Struct('<QQI')
+JOURNAL_PATTERN = re.compile(r"^journal-(\d+)\.log$")
+KEEP_GENERATIONS = 64
+
+
+class FileLock:
+    """
+    Exclusive advisory lock on a file, held for the duration of a with block.
+    """
+
+    def __init__(self, path, blocking=True):
+        self.path = path
+        self.blocking = blocking
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a+b')
+        flags = fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.flock(self._file.fileno(), flags)
+        except BlockingIOError:
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def __exit__(self, *exc):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+# Record: header, uncompressed npz of the rows, JSON of each row's unseen terms and the rows' vectorizer
+def _encode(rows, new_terms=None, vectorizer=None):
+    buffer = io.BytesIO()
+    sparse.save_npz(buffer, sparse.csr_matrix(rows), compressed=False)
+    matrix_bytes = buffer.getvalue()
+    terms = new_terms or [{}] * rows.shape[0]
+    if vectorizer is not None:
+        terms = {'new_terms': terms, 'vectorizer': vectorizer}
+    terms_bytes = json.dumps(terms).encode('utf-8')
+    payload = matrix_bytes + terms_bytes
+    return RECORD_HEADER.pack(len(matrix_bytes), len(terms_bytes), zlib.crc32(payload)) + payload
+
+
+# Complete records of a journal file as (offset, matrix, new terms, vectorizer); a torn tail is ignored
+def _read_records(path, size=None):
+    records = []
+    with open(path, 'rb') as f:
+        data = f.read() if size is None else f.read(size)
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        matrix_length, terms_length, checksum = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        payload = data[start:start + matrix_length + terms_length]
+        if len(payload) < matrix_length + terms_length or zlib.crc32(payload) != checksum:
+            break
+        rows = sparse.load_npz(io.BytesIO(payload[:matrix_length])).tocsr()
+        terms = json.loads(payload[matrix_length:].decode('utf-8'))
+        # Records without a vectorizer name hold only the list of new terms
+        if isinstance(terms, dict):
+            records.append((offset, rows, terms['new_terms'], terms['vectorizer']))
+        else:
+            records.append((offset, rows, terms, None))
+        offset = start + matrix_length + terms_length
+    return records
+
+
+class CorpusWriter:
+    """
+    Journaled, single-writer appends to a SegmentStore shared by many processes.
+
+    Args:
+        segments (SegmentStore): Store whose directory also holds the journal and lock files.
+        vectorizer_path (str): Vectorizer of stores whose manifest does not name one yet.
+    """
+
+    def __init__(self, segments, vectorizer_path='tfidf_vectorizer.pkl'):
+        self.segments = segments
+        self.vectorizer_path = vectorizer_path
+        self.directory = segments.directory
+        self._journal_lock = os.path.join(self.directory, 'journal.lock')
+        self._writer_lock = os.path.join(self.directory, 'writer.lock')
+        # (stats files of a manifest version, its CorpusStats), kept between applies of this writer
+        self._cached_stats = None
+
+    def _generations(self):
+        generations = []
+        for name in os.listdir(self.directory):
+            match = JOURNAL_PATTERN.match(name)
+            if match:
+                generations.append(int(match.group(1)))
+        return sorted(generations)
+
+    def _journal_path(self, generation):
+        return os.path.join(self.directory, f"journal-{generation:08d}.log")
+
+    def _applied_generation(self, manifest):
+        return manifest.get('applied_generation', 0)
+
+    @staticmethod
+    def _stats_key(manifest):
+        return manifest.get('stats'), manifest.get('stats_log'), manifest.get('stats_log_size', 0)
+
+    # Statistics of a manifest version, counted from its segments the first time; the caller may change them
+    def _stats(self, manifest):
+        cached, self._cached_stats = self._cached_stats, None
+        if cached is not None and cached[0] == self._stats_key(manifest):
+            return cached[1]
+        path = self.segments.file_for(manifest, 'stats')
+        if path is None:
+            return corpus_stats.CorpusStats.from_matrix(self.segments.load_parts(manifest))
+        stats = corpus_stats.CorpusStats.load(path)
+        log_path = self.segments.file_for(manifest, 'stats_log')
+        if log_path is not None:
+            for _, rows, new_terms, _ in _read_records(log_path, manifest['stats_log_size']):
+                stats.update(rows, new_terms)
+        return stats
+
+    def load_vectorizer(self, manifest):
+        with open(self.segments.file_for(manifest, 'vectorizer', self.vectorizer_path), 'rb') as f:
+            return pickle.load(f)
+
+    def initialize(self, tfidf_matrix):
+        """
+        Creates the segment store from a matrix unless another process already has.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with FileLock(self._writer_lock):
+            if not self.segments.exists():
+                self.segments.create(tfidf_matrix)
+
+    def submit(self, rows, new_terms=None, vectorizer=None):
+        """
+        Durably queues rows for the corpus.
+
+        Args:
+            rows (scipy.sparse matrix): Vectorized documents.
+            new_terms (list): Optional dict per row of terms outside the
+                vocabulary and their counts, see corpus_stats.new_terms.
+            vectorizer (str): Manifest name of the vectorizer that produced
+                the rows ('' for vectorizer_path). Rows applied to a version
+                with another vectorizer are re-weighted to its IDF weights.
+
+        Returns:
+            tuple: A ticket (generation, offset) identifying the journal entry.
+        """
+        record = _encode(rows, new_terms, vectorizer)
+        with FileLock(self._journal_lock):
+            generations = self._generations()
+            if generations:
+                generation = generations[-1]
+            else:
+                generation = self._applied_generation(self.segments.read_manifest()) + 1
+            with open(self._journal_path(generation), 'ab') as f:
+                offset = f.tell()
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+        return generation, offset
+
+    def apply(self, blocking=True):
+        """
+        Applies every queued journal entry as one segment and publishes the
+        new manifest.
+
+        Args:
+            blocking (bool): Wait for the writer lock; when False and another
+                process is applying, return None at once.
+
+        Returns:
+            dict: The published manifest, or None if the lock was busy.
+        """
+        with FileLock(self._writer_lock, blocking=blocking) as acquired:
+            if not acquired:
+                return None
+            manifest = self.segments.read_manifest()
+            applied = self._applied_generation(manifest)
+
+            # Freeze the current journal by starting a new generation for submitters
+            with FileLock(self._journal_lock):
+                generations = [g for g in self._generations() if g > applied]
+                if not any(os.path.getsize(self._journal_path(g)) for g in generations):
+                    return manifest
+                open(self._journal_path(generations[-1] + 1), 'ab').close()
+
+            first_row = sum(segment['rows'] for segment in manifest['segments'])
+            batches, terms, entries = [], [], manifest.get('applied_entries', {})
+            idf = {}
+            for generation in generations:
+                positions = []
+                for offset, rows, new_terms, vectorizer in _read_records(self._journal_path(generation)):
+                    positions.append([offset, first_row])
+                    first_row += rows.shape[0]
+                    if vectorizer is not None and vectorizer != (manifest.get('vectorizer') or ''):
+                        rows = self._reweighted(rows, vectorizer, manifest, idf)
+                    if rows.shape[1] < manifest['n_columns']:
+                        # Vectorized before a refit added columns; the new terms stay zero
+                        rows.resize((rows.shape[0], manifest['n_columns']))
+                    batches.append(rows)
+                    terms.extend(new_terms)
+                entries[str(generation)] = positions
+
+            for old in sorted(entries, key=int)[:-KEEP_GENERATIONS]:
+                del entries[old]
+            extra = {'applied_generation': generations[-1], 'applied_entries': entries}
+            if batches:
+                rows = vstack(batches, format='csr')
+                stats = self._stats(manifest)
+                stats.update(rows, terms)
+                if not manifest.get('stats') or len(manifest['segments']) + 1 > self.segments.max_segments:
+                    # First batch, or the append is about to be compacted: fold the log into a new stats file
+                    extra.update(stats=self._save_stats(stats, manifest), stats_log=None, stats_log_size=0)
+                    replaced = self._replaced(manifest, 'stats', 'stats_log')
+                else:
+                    extra.update(self._log_stats(manifest, rows, terms))
+                    replaced = []
+                manifest = self.segments.append(rows, extra=extra, replaced=replaced)
+                self._cached_stats = (self._stats_key(manifest), stats)
+                manifest = self.segments.maybe_compact()
+
+            for generation in generations:
+                os.remove(self._journal_path(generation))
+            # Journal files left by a crash after publishing are already applied
+            for generation in self._generations():
+                if generation <= applied:
+                    os.remove(self._journal_path(generation))
+            return manifest
+
+    # Rows vectorized before a refit, moved to the IDF weights of the manifest they are applied to
+    def _reweighted(self, rows, vectorizer, manifest, idf):
+        if None not in idf:
+            idf[None] = getattr(self.load_vectorizer(manifest), 'idf_', None)
+        if vectorizer not in idf:
+            path = os.path.join(self.directory, vectorizer) if vectorizer else self.vectorizer_path
+            # The vectorizer a refit replaced is kept for one more version
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    idf[vectorizer] = getattr(pickle.load(f), 'idf_', None)
+            else:
+                idf[vectorizer] = None
+        if idf[None] is None or idf[vectorizer] is None or rows.shape[1] != len(idf[vectorizer]):
+            return rows
+        return corpus_stats.reweight(rows, idf[vectorizer], idf[None]).astype(rows.dtype)
+
+    # Statistics are written under a name unique to the manifest version that will publish them
+    def _save_stats(self, stats, manifest):
+        name = f"stats-{manifest['next_segment']:06d}.npz"
+        stats.save(os.path.join(self.directory, name))
+        return name
+
+    # Append a batch to the stats log, past the bytes the current version owns; returns the manifest keys
+    def _log_stats(self, manifest, rows, new_terms):
+        name = manifest.get('stats_log') or f"stats-{manifest['next_segment']:06d}.log"
+        size = manifest.get('stats_log_size', 0)
+        record = _encode(rows, new_terms)
+        with open(os.path.join(self.directory, name), 'ab') as f:
+            # Bytes past the published size were logged by an apply that crashed before publishing
+            f.truncate(size)
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        return {'stats_log': name, 'stats_log_size': size + len(record)}
+
+    # Files of a manifest version that the next one replaces under the given keys
+    @staticmethod
+    def _replaced(manifest, *keys):
+        return [manifest[key] for key in keys if manifest.get(key)]
+
+    def documents(self):
+        """
+        Rows of the published corpus, or None before the store exists.
+        """
+        if not self.segments.exists():
+            return None
+        return sum(segment['rows'] for segment in self.segments.read_manifest()['segments'])
+
+    def refit(self, min_df=2, min_growth=0.0, baseline=0):
+        """
+        Recomputes IDF weights from the corpus statistics, promotes frequent
+        new terms into the vocabulary and publishes the re-weighted matrix
+        and new vectorizer as one manifest version. Readers keep serving the
+        previous version until they see the new manifest.
+
+        Args:
+            min_df (int): Documents a new term must appear in to be promoted.
+            min_growth (float): Skip the rebuild unless the corpus has grown
+                by this fraction since the last one.
+            baseline (int): Documents to measure growth from when the store
+                has never been rebuilt.
+
+        Returns:
+            dict: Rebuild summary, or None when it was skipped.
+        """
+        with FileLock(self._writer_lock):
+            if not self.segments.exists():
+                return None
+            manifest = self.segments.read_manifest()
+            stats = self._stats(manifest)
+            if stats.n_documents < manifest.get('refit_documents', baseline) * (1 + min_growth):
+                return None
+            vectorizer = self.load_vectorizer(manifest)
+            tfidf_matrix, vectorizer, promoted = corpus_stats.refit(
+                self.segments.load_parts(manifest), vectorizer, stats, min_df=min_df)
+
+            name = f"vectorizer-{manifest['next_segment']:06d}.pkl"
+            atomic_write(os.path.join(self.directory, name), lambda f: pickle.dump(vectorizer, f))
+            extra = {'vectorizer': name, 'stats': self._save_stats(stats, manifest), 'stats_log': None,
+                     'stats_log_size': 0, 'refit_documents': stats.n_documents}
+            replaced = self._replaced(manifest, 'vectorizer', 'stats', 'stats_log')
+            manifest = self.segments.replace(tfidf_matrix, extra=extra, manifest=manifest, replaced=replaced)
+            return {'version': manifest['version'], 'segment': manifest['segments'][0]['name'],
+                    'documents': stats.n_documents,
+                    'columns': tfidf_matrix.shape[1], 'promoted_terms': len(promoted)}
+
+    def row_of(self, ticket, manifest):
+        """
+        Corpus row of a submitted entry's first row, once it has been applied.
+        """
+        generation, offset = ticket
+        for entry_offset, row in manifest.get('applied_entries', {}).get(str(generation), []):
+            if entry_offset == offset:
+                return row
+        return None
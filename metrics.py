@@ -0,0 +1,282 @@
+"""
+Lightweight instrumentation for the check pipeline.
+
+Counters, gauges and histograms live in one process-wide registry and are
+exposed in the Prometheus text format by render(). Every stage timed with
+timed() also writes one structured (JSON) line to the 'plagiarism.metrics'
+logger, tagged with the id of the check it belongs to, so a slow check can
+be traced stage by stage in the logs.
+
+    with metrics.trace() as stages:
+        with metrics.timed('vectorize', documents=3):
+            ...
+    stages  # {'vectorize': 0.0021}
+
+Instrumentation is on by default. With METRICS_ENABLED=0, timed() returns
+a shared no-op context and the record functions return at once. Set
+METRICS_LOG=INFO to print the structured logs to stderr.
+"""
+import bisect
+import contextvars
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+ENABLED = os.environ.get('METRICS_ENABLED', '1').lower() not in ('0', 'false', 'no', 'off')
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1e3, 5e3, 1e4, 2.5e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 5e6, 1e7, 5e7)
+
+logger = logging.getLogger('plagiarism.metrics')
+if os.environ.get('METRICS_LOG'):
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(os.environ['METRICS_LOG'].upper())
+
+# Stage durations of the check running in the current thread or task, see trace()
+_trace = contextvars.ContextVar('metrics_trace', default=None)
+_trace_ids = itertools.count(1)
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in key) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    Monotonically increasing count per label set.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Gauge(Counter):
+    """
+    Current value per label set.
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+class Histogram:
+    """
+    Observations counted into cumulative buckets, with their sum and count.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                for bound, cumulative in zip(self.buckets + (float('inf'),), itertools.accumulate(counts)):
+                    samples.append((f"{self.name}_bucket", key + (('le', _format_value(float(bound))),), cumulative))
+                samples.append((f"{self.name}_sum", key, total))
+                samples.append((f"{self.name}_count", key, count))
+        return samples
+
+    def summary(self):
+        """
+        Count, total and mean per label set, for JSON reports.
+        """
+        with self._lock:
+            return {','.join(str(value) for _, value in key) or 'all':
+                    {'count': count, 'sum': round(total, 6), 'mean': round(total / count, 6)}
+                    for key, (_, total, count) in self._values.items()}
+
+
+class Registry:
+    """
+    Named metrics of a process, rendered together.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format (version 0.0.4).
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'plagiarism_stage_seconds', "Time spent in each pipeline stage."))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    'plagiarism_stage_errors_total', "Pipeline stages that raised an exception."))
+CHECKS = REGISTRY.register(Counter(
+    'plagiarism_checks_total', "Reports checked, by how the result was obtained."))
+DOCUMENT_CHARACTERS = REGISTRY.register(Histogram(
+    'plagiarism_document_characters', "Characters per checked report.", SIZE_BUCKETS))
+UPLOAD_BYTES = REGISTRY.register(Histogram(
+    'plagiarism_upload_bytes', "Size of extracted documents by format.", SIZE_BUCKETS))
+CORPUS_DOCUMENTS = REGISTRY.register(Gauge(
+    'plagiarism_corpus_documents', "Reference documents in the loaded corpus."))
+CORPUS_SEGMENTS = REGISTRY.register(Gauge(
+    'plagiarism_corpus_segments', "Segments of the loaded corpus."))
+CORPUS_BYTES = REGISTRY.register(Gauge(
+    'plagiarism_corpus_matrix_bytes', "Bytes of the loaded TF-IDF matrix."))
+CORPUS_VERSION = REGISTRY.register(Gauge(
+    'plagiarism_corpus_version', "Times the corpus was (re)loaded in this process."))
+
+
+class _Timer:
+    __slots__ = ('stage', 'fields', 'start')
+
+    def __init__(self, stage, fields):
+        self.stage = stage
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(seconds, stage=self.stage)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(stage=self.stage)
+        current = _trace.get()
+        if current is not None:
+            current['stages'][self.stage] = current['stages'].get(self.stage, 0.0) + seconds
+        if logger.isEnabledFor(logging.INFO):
+            record = {'event': 'stage', 'stage': self.stage, 'seconds': round(seconds, 6),
+                      'ok': exc_type is None, **self.fields}
+            if current is not None:
+                record['check'] = current['id']
+            if exc_type is not None:
+                record['error'] = exc_type.__name__
+            logger.info(json.dumps(record, default=str))
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timed(stage, **fields):
+    """
+    Context manager timing one pipeline stage.
+
+    Args:
+        stage (str): Stage name, the 'stage' label of plagiarism_stage_seconds.
+        **fields: Extra values for the structured log line (e.g. sizes).
+    """
+    if not ENABLED:
+        return _NULL_TIMER
+    return _Timer(stage, fields)
+
+
+@contextmanager
+def trace():
+    """
+    Collects the stage durations of one check as {stage: seconds} and tags
+    its log lines with a check id. The trace is held in a context variable,
+    so checks running in other threads or asyncio tasks are kept apart.
+    """
+    stages = {}
+    if not ENABLED:
+        yield stages
+        return
+    token = _trace.set({'id': next(_trace_ids), 'stages': stages})
+    try:
+        yield stages
+    finally:
+        _trace.reset(token)
+
+
+def inc(counter, value=1, **labels):
+    if ENABLED:
+        counter.inc(value, **labels)
+
+
+def observe(histogram, value, **labels):
+    if ENABLED:
+        histogram.observe(value, **labels)
+
+
+def set_gauge(gauge, value, **labels):
+    if ENABLED:
+        gauge.set(value, **labels)
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,104 @@
+"""
+Uncompressed on-disk layout for sparse matrices that can be memory-mapped.
+
+A matrix is a directory holding data.npy, indices.npy, indptr.npy and
+meta.json. Opening it maps the three arrays read-only, so every process on
+a host shares the same page cache instead of holding its own decompressed
+copy, and startup does no decompression.
+
+Usage:
+    python mmap_matrix.py tfidf_matrix.npz tfidf_matrix.mm [--format csr]
+
+CSC is the default: search.SearchIndex scores a normalised CSC matrix in
+place, while any other layout is copied into a CSC matrix per process.
+"""
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+from scipy import sparse
+
+FORMATS = {
+    'csr': sparse.csr_matrix,
+    'csc': sparse.csc_matrix,
+}
+
+
+def is_mmap_matrix(path):
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+def save_mmap(matrix, directory, format='csc'):
+    """
+    Writes a sparse matrix in the raw layout. The directory is built under a
+    temporary name and renamed into place, so it appears complete or not at all.
+
+    Args:
+        matrix (scipy.sparse matrix): Matrix to write.
+        directory (str): Destination directory, which must not exist yet.
+        format (str): 'csc' for column (posting) access, as search uses it, or 'csr' for row access.
+    """
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format!r}. Use 'csr' or 'csc'.")
+    matrix = FORMATS[format](matrix)
+    matrix.sort_indices()
+    tmp_directory = f"{directory}.tmp-{os.getpid()}"
+    os.makedirs(tmp_directory)
+    try:
+        for name in ('data', 'indices', 'indptr'):
+            with open(os.path.join(tmp_directory, f"{name}.npy"), 'wb') as f:
+                np.save(f, getattr(matrix, name))
+                f.flush()
+                os.fsync(f.fileno())
+        with open(os.path.join(tmp_directory, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'format': format, 'shape': list(matrix.shape), 'nnz': int(matrix.nnz)}, f)
+        os.rename(tmp_directory, directory)
+    except BaseException:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+
+
+def load_mmap(directory):
+    """
+    Opens a raw-layout matrix as a zero-copy CSR or CSC view over read-only
+    memory maps.
+    """
+    with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    arrays = [np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')
+              for name in ('data', 'indices', 'indptr')]
+    matrix = FORMATS[meta['format']](tuple(arrays), shape=tuple(meta['shape']), copy=False)
+    matrix.has_sorted_indices = True
+    return matrix
+
+
+def convert_npz(npz_path, directory, format='csc'):
+    """
+    Converts a scipy .npz matrix (e.g. tfidf_matrix.npz) to the raw layout.
+    """
+    save_mmap(sparse.load_npz(npz_path), directory, format=format)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a .npz sparse matrix to the memory-mapped layout.")
+    parser.add_argument('npz_path')
+    parser.add_argument('directory')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='csc')
+    args = parser.parse_args(argv)
+
+    convert_npz(args.npz_path, args.directory, format=args.format)
+
+    start = time.perf_counter()
+    sparse.load_npz(args.npz_path)
+    npz_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    load_mmap(args.directory)
+    mmap_seconds = time.perf_counter() - start
+    print(f"Wrote {args.directory}: npz load {npz_seconds * 1000:.1f} ms, mmap open {mmap_seconds * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+import argparse
+import os
+import re
+import string
+import threading
+
+# Importing nltk takes seconds, so it is only imported once a preprocessor is built
+NLTK_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nltk_data')
+# NLTK resources each tokenizer needs; the stopword lists are always needed
+NLTK_RESOURCES = {
+    'nltk': ('corpora/stopwords', 'tokenizers/punkt_tab'),
+    'regex': ('corpora/stopwords',),
+}
+# Never download at run time, e.g. on hosts without network access
+NLTK_OFFLINE = os.environ.get('NLTK_OFFLINE', '0').lower() not in ('0', 'false', 'no', '')
+
+# Built once instead of on every preprocess() call
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation)
+
+# After ASCII punctuation is stripped, these are the only rules of NLTK's
+# Treebank word tokenizer that still fire: the fused-word contractions
+# (e.g. "cannot" -> "can not") and the non-ASCII quote characters.
+_CONTRACTIONS = [
+    re.compile(r"(?i)\b(can)(not)\b"),
+    re.compile(r"(?i)\b(gim)(me)\b"),
+    re.compile(r"(?i)\b(gon)(na)\b"),
+    re.compile(r"(?i)\b(got)(ta)\b"),
+    re.compile(r"(?i)\b(lem)(me)\b"),
+    re.compile(r"(?i)\b(wan)(na)(?=\s|$)"),
+]
+_QUOTES = re.compile(r"([«“‘„»”’])")
+
+
+# Regex tokenizer matching word_tokenize on punctuation-free text, without punkt
+def fast_tokenize(text):
+    for pattern in _CONTRACTIONS:
+        text = pattern.sub(r" \1 \2 ", text)
+    text = _QUOTES.sub(r" \1 ", text)
+    return text.split()
+
+
+# NLTK's word_tokenize, imported on the first call
+def nltk_tokenize(text):
+    from nltk.tokenize import word_tokenize
+    return word_tokenize(text)
+
+
+TOKENIZERS = {
+    'nltk': nltk_tokenize,
+    'regex': fast_tokenize,
+}
+
+_checked_resources = set()
+_nltk_lock = threading.Lock()
+
+
+def ensure_nltk_data(resources=NLTK_RESOURCES['nltk'], download=None):
+    """
+    Makes sure NLTK resources are installed, checking each one once per process.
+
+    The bundled nltk_data folder next to this file is searched first, then
+    NLTK's usual locations (NLTK_DATA, ~/nltk_data, ...). A missing resource
+    is downloaded into NLTK_DATA or the bundled folder, unless downloads are
+    off (NLTK_OFFLINE=1), in which case LookupError is raised.
+
+    Args:
+        resources (tuple): NLTK resource paths such as 'corpora/stopwords'.
+        download (bool): Whether missing resources may be downloaded, defaults to not NLTK_OFFLINE.
+
+    Returns:
+        list: The resources that had to be downloaded.
+    """
+    download = not NLTK_OFFLINE if download is None else download
+    with _nltk_lock:
+        missing = [resource for resource in resources if resource not in _checked_resources]
+        if not missing:
+            return []
+        import nltk
+        if os.path.isdir(NLTK_DATA_DIR) and NLTK_DATA_DIR not in nltk.data.path:
+            nltk.data.path.insert(0, NLTK_DATA_DIR)
+        downloaded = []
+        for resource in missing:
+            try:
+                nltk.data.find(resource)
+            except LookupError:
+                if not download:
+                    raise LookupError(f"NLTK resource {resource!r} is not installed and downloads are off. "
+                                      f"Run `python preprocessing.py --download` to provision it.") from None
+                directory = os.environ.get('NLTK_DATA', NLTK_DATA_DIR).split(os.pathsep)[0]
+                os.makedirs(directory, exist_ok=True)
+                if directory not in nltk.data.path:
+                    nltk.data.path.insert(0, directory)
+                if not nltk.download(resource.rsplit('/', 1)[-1], download_dir=directory, quiet=True):
+                    raise LookupError(f"Could not download NLTK resource {resource!r}.")
+                downloaded.append(resource)
+            _checked_resources.add(resource)
+        return downloaded
+
+
+class Preprocessor:
+    """
+    Lowercases, strips punctuation, tokenizes and removes stopwords.
+
+    The stopword set, translation table and tokenizer are resolved once
+    when the preprocessor is built, so each call only does the per-text work.
+
+    Args:
+        tokenizer (str): 'nltk' for word_tokenize or 'regex' for fast_tokenize.
+        language (str): NLTK stopword list to use.
+    """
+
+    def __init__(self, tokenizer='nltk', language='english'):
+        if tokenizer not in TOKENIZERS:
+            raise ValueError(f"Unknown tokenizer {tokenizer!r}. Use one of {sorted(TOKENIZERS)}.")
+        ensure_nltk_data(NLTK_RESOURCES.get(tokenizer, NLTK_RESOURCES['nltk']))
+        from nltk.corpus import stopwords
+        self.tokenizer = tokenizer
+        self.stop_words = frozenset(stopwords.words(language))
+        self._tokenize = TOKENIZERS[tokenizer]
+
+    def __call__(self, text):
+        # Joining list elements into a string, as utils.preprocess always has
+        if not isinstance(text, str):
+            text = ' '.join(text)
+        text = text.lower().translate(PUNCTUATION_TABLE)
+        stop_words = self.stop_words
+        return ' '.join([word for word in self._tokenize(text) if word not in stop_words])
+
+    def preprocess_many(self, texts):
+        """
+        Lazily preprocesses an iterable of texts, yielding one result per text.
+        """
+        for text in texts:
+            yield self(text)
+
+
+_preprocessors = {}
+_preprocessors_lock = threading.Lock()
+
+
+# Shared preprocessor per tokenizer, built on first use
+def get_preprocessor(tokenizer='nltk'):
+    with _preprocessors_lock:
+        if tokenizer not in _preprocessors:
+            _preprocessors[tokenizer] = Preprocessor(tokenizer)
+        return _preprocessors[tokenizer]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Provision the NLTK data used for preprocessing.")
+    parser.add_argument('--download', action='store_true', help="Download missing resources, else only check")
+    args = parser.parse_args(argv)
+    missing = False
+    for resource in sorted({resource for needed in NLTK_RESOURCES.values() for resource in needed}):
+        try:
+            status = 'downloaded' if ensure_nltk_data((resource,), download=args.download) else 'installed'
+        except LookupError:
+            status, missing = 'missing', True
+        print(f"{resource}: {status}")
+    return 1 if missing else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,251 @@
+"""
+Result cache for repeated submissions.
+
+Students resubmit the same file many times. Each check result (extracted
+text, TF-IDF vector, top matches and copied passages) is cached under a
+hash of the normalised text, and the raw upload bytes are an alias for it,
+so a byte-identical upload skips extraction as well. Results are tied to
+the corpus_id of the CorpusStore they were computed against and are
+recomputed once the corpus changes; the extracted text stays valid.
+
+The in-memory layer is an LRU shared by all sessions in the process. The
+optional on-disk layer keeps results across restarts and processes.
+
+DuplicateIndex recognises reports that are already in the corpus from a
+hash of their TF-IDF row, so they can be reported without scoring.
+"""
+import hashlib
+import json
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+from scipy import sparse
+
+from fingerprint import PassageMatch
+from segments import atomic_write
+
+CACHE_DIR = 'result_cache'
+
+
+def bytes_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# Case and whitespace differences do not make a resubmission new
+def text_key(text):
+    return hashlib.sha256(' '.join(text.lower().split()).encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """
+    LRU cache of check results with an optional on-disk layer.
+
+    An entry is a dict with 'text', 'vector', 'matches' ([(row, score)]),
+    'passages' ([PassageMatch]), 'semantic' ([(row, score)] from
+    semantic.SemanticIndex.rerank, None when the engine was off),
+    'duplicate_of' (row or None), 'k' and 'corpus_id'.
+
+    Args:
+        max_entries (int): Entries kept in memory.
+        directory (str): Folder for the on-disk layer, or None for memory only.
+        max_disk_entries (int): Entries kept on disk; the oldest are removed first.
+    """
+
+    def __init__(self, max_entries=256, directory=None, max_disk_entries=10000):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self._entries = OrderedDict()
+        self._aliases = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'stale': 0, 'disk_hits': 0}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _remember(self, mapping, key, value):
+        mapping[key] = value
+        mapping.move_to_end(key)
+        while len(mapping) > self.max_entries:
+            mapping.popitem(last=False)
+
+    def _path(self, key, extension):
+        return os.path.join(self.directory, f"{key}.{extension}")
+
+    def _read_disk(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with np.load(self._path(key, 'npz')) as data:
+                meta = json.loads(bytes(data['meta']).decode('utf-8'))
+                vector = sparse.csr_matrix((data['data'], data['indices'], data['indptr']),
+                                           shape=tuple(meta.pop('shape')))
+        except (OSError, ValueError, KeyError):
+            return None
+        meta['vector'] = vector
+        meta['matches'] = [tuple(match) for match in meta['matches']]
+        # Entries written before the paraphrase engine existed count as checked without it
+        semantic = meta.get('semantic')
+        meta['semantic'] = None if semantic is None else [tuple(match) for match in semantic]
+        meta['passages'] = [PassageMatch(*passage) for passage in meta['passages']]
+        return meta
+
+    def _write_disk(self, key, entry):
+        meta = {name: entry[name] for name in ('text', 'matches', 'duplicate_of', 'k', 'corpus_id')}
+        meta['semantic'] = entry.get('semantic')
+        meta['passages'] = [list(passage) for passage in entry['passages']]
+        meta['shape'] = list(entry['vector'].shape)
+        vector = sparse.csr_matrix(entry['vector'])
+        arrays = {
+            'data': vector.data, 'indices': vector.indices, 'indptr': vector.indptr,
+            'meta': np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8),
+        }
+        atomic_write(self._path(key, 'npz'), lambda f: np.savez(f, **arrays))
+        self._prune_disk()
+
+    def _prune_disk(self):
+        files = [entry for entry in os.scandir(self.directory) if entry.name.endswith(('.npz', '.ref'))]
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files) - self.max_disk_entries]:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    # Entry for a text key from memory, else disk; None when neither has it
+    def _entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        entry = self._read_disk(key)
+        if entry is not None:
+            self.stats['disk_hits'] += 1
+            with self._lock:
+                self._remember(self._entries, key, entry)
+        return entry
+
+    def cached_text(self, data):
+        """
+        Extracted text of a previously seen upload, whatever corpus it was checked against.
+        """
+        key = bytes_key(data)
+        with self._lock:
+            target = self._aliases.get(key)
+        if target is None and self.directory is not None:
+            try:
+                with open(self._path(key, 'ref'), 'r', encoding='utf-8') as f:
+                    target = f.read().strip()
+            except OSError:
+                return None
+        entry = self._entry(target) if target else None
+        return entry['text'] if entry is not None else None
+
+    def get(self, text, corpus_id, k=5):
+        """
+        Cached result for a text, or None if it was not checked against this corpus version.
+        """
+        entry = self._entry(text_key(text))
+        if entry is None:
+            self.stats['misses'] += 1
+            return None
+        if entry['corpus_id'] != corpus_id or entry['k'] < k:
+            self.stats['stale'] += 1
+            return None
+        self.stats['hits'] += 1
+        return entry
+
+    def put(self, entry, data=None):
+        """
+        Stores a result, and the upload bytes it was extracted from if given.
+        """
+        key = text_key(entry['text'])
+        with self._lock:
+            self._remember(self._entries, key, entry)
+            if data is not None:
+                self._remember(self._aliases, bytes_key(data), key)
+        if self.directory is not None:
+            self._write_disk(key, entry)
+            if data is not None:
+                alias = key.encode('utf-8')
+                atomic_write(self._path(bytes_key(data), 'ref'), lambda f: f.write(alias))
+
+
+# Hash of which terms a TF-IDF row contains, equal for equal texts under one vectorizer
+def _row_hash(indices):
+    return hashlib.blake2b(np.asarray(indices, dtype=np.int64).tobytes(), digest_size=16).digest()
+
+
+class DuplicateIndex:
+    """
+    Finds corpus rows equal to a query vector without scoring the corpus.
+
+    Rows are hashed per segment and segments never change, so after an
+    append only the new segment is hashed. A hash hit is confirmed with a
+    cosine check against the stored row, which also absorbs the float
+    rounding of re-weighted rows.
+    """
+
+    def __init__(self, min_cosine=0.9999):
+        self.min_cosine = min_cosine
+        self._segments = {}
+        self._lock = threading.Lock()
+
+    def _segment_hashes(self, part):
+        cached = self._segments.get(id(part))
+        if cached is not None and cached[0]() is part:
+            return cached[1]
+        csr = sparse.csr_matrix(part)
+        hashes = {}
+        for row in range(csr.shape[0]):
+            indices = csr.indices[csr.indptr[row]:csr.indptr[row + 1]]
+            if len(indices):
+                hashes.setdefault(_row_hash(np.sort(indices)), []).append(row)
+        self._segments[id(part)] = (weakref.ref(part), hashes)
+        return hashes
+
+    def find(self, vector, parts):
+        """
+        Corpus row equal to vector, or None.
+        """
+        vector = sparse.csr_matrix(vector)
+        if not vector.nnz:
+            return None
+        key = _row_hash(np.sort(vector.indices))
+        norm = np.sqrt(vector.multiply(vector).sum())
+        with self._lock:
+            live = {id(part) for part in parts}
+            for stale in [part_id for part_id in self._segments if part_id not in live]:
+                del self._segments[stale]
+            offset = 0
+            for part in parts:
+                for row in self._segment_hashes(part).get(key, ()):
+                    stored = sparse.csr_matrix(part[row])
+                    cosine = (stored @ vector.T).toarray()[0, 0] / (norm * np.sqrt(stored.multiply(stored).sum()))
+                    if cosine >= self.min_cosine:
+                        return offset + row
+                offset += part.shape[0]
+        return None
+
+
+_cache = None
+_duplicates = DuplicateIndex()
+_cache_lock = threading.Lock()
+
+
+# Shared cache for the process, persisted under CACHE_DIR
+def get_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache(directory=CACHE_DIR)
+        return _cache
+
+
+def get_duplicates():
+    return _duplicates
@@ -0,0 +1,179 @@
+import os
+import threading
+
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+import corpus_store
+import utils
+
+
+# True when every non-empty row of a CSC matrix has unit L2 norm
+def _rows_normalised(matrix):
+    norms = np.bincount(matrix.indices, weights=np.square(matrix.data), minlength=matrix.shape[0])
+    norms = norms[norms > 0]
+    return bool(np.allclose(norms, 1.0, atol=1e-6))
+
+
+# Column-wise, L2-normalised view of a segment, reused in place when possible
+def to_postings(matrix):
+    if matrix.format == 'csc' and matrix.has_sorted_indices and _rows_normalised(matrix):
+        return matrix
+    postings = normalize(sparse.csr_matrix(matrix, dtype=np.float64), norm='l2', copy=True).tocsc()
+    postings.sort_indices()
+    return postings
+
+
+class SearchIndex:
+    """
+    Top-k cosine search over the reference TF-IDF matrix.
+
+    Rows are L2-normalised once and stored column-wise (CSC), so each
+    vocabulary term gives the posting list of documents containing it.
+    A query only touches the postings of its own terms, and only documents
+    sharing at least one term with it are scored.
+
+    The reference set may be given as a list of row segments. Segments that
+    are already normalised CSC (such as memory-mapped segment bases) are
+    searched in place without copying.
+
+    Args:
+        tfidf_matrix (scipy.sparse matrix or list): Reference documents, one per row.
+        vectorizer (TfidfVectorizer): Fitted vectorizer used to encode queries.
+    """
+
+    def __init__(self, tfidf_matrix, vectorizer):
+        parts = tfidf_matrix if isinstance(tfidf_matrix, (list, tuple)) else [tfidf_matrix]
+        self.parts = []
+        offset = 0
+        for part in parts:
+            self.parts.append((offset, to_postings(part)))
+            offset += part.shape[0]
+        self.vectorizer = vectorizer
+        self.n_documents = offset
+
+    # Mask of the documents a search may return, None for all of them
+    def _allowed(self, rows):
+        if rows is None:
+            return None
+        allowed = np.zeros(self.n_documents, dtype=bool)
+        rows = np.asarray(rows, dtype=np.int64)
+        allowed[rows[(rows >= 0) & (rows < self.n_documents)]] = True
+        return allowed
+
+    def search_vector(self, query_vector, k=5, min_score=0.0, rows=None):
+        """
+        Scores an already vectorized query.
+
+        Returns:
+            list: (document index, cosine score) pairs, best first.
+        """
+        query = normalize(sparse.csr_matrix(query_vector, dtype=np.float64), norm='l2')
+        if query.nnz == 0 or self.n_documents == 0:
+            return []
+        allowed = self._allowed(rows)
+
+        candidates, scores = [], []
+        for offset, postings in self.parts:
+            # Gather the posting lists of the query terms only
+            columns = postings[:, query.indices]
+            contributions = columns.data * np.repeat(query.data, np.diff(columns.indptr))
+            part_candidates, positions = np.unique(columns.indices, return_inverse=True)
+            candidates.append(part_candidates + offset)
+            scores.append(np.bincount(positions, weights=contributions, minlength=len(part_candidates)))
+        candidates, scores = np.concatenate(candidates), np.concatenate(scores)
+
+        keep = scores >= min_score
+        if allowed is not None:
+            keep &= allowed[candidates]
+        candidates, scores = candidates[keep], scores[keep]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            candidates, scores = candidates[top], scores[top]
+        order = np.argsort(-scores, kind='stable')
+        return [(int(candidates[i]), float(scores[i])) for i in order]
+
+    def search_many(self, query_matrix, k=5, min_score=0.0, rows=None):
+        """
+        Scores a batch of vectorized queries with one sparse product per segment.
+
+        Args:
+            query_matrix (scipy.sparse matrix): One vectorized query per row.
+            k (int): Maximum number of matches per query.
+            min_score (float): Matches scoring below this are dropped.
+            rows (array-like): Only these documents may be returned, e.g. the
+                rows of one course from documents.DocumentStore.rows(); all if None.
+
+        Returns:
+            list: One list of (document index, cosine score) pairs per query row, best first.
+        """
+        queries = normalize(sparse.csr_matrix(query_matrix, dtype=np.float64), norm='l2')
+        allowed = self._allowed(rows)
+        if self.n_documents == 0:
+            return [[] for _ in range(queries.shape[0])]
+        # The transposed CSC postings are CSR term x document matrices
+        scores = sparse.hstack([queries @ postings.T for _, postings in self.parts], format='csr')
+        results = []
+        for row in range(scores.shape[0]):
+            start, end = scores.indptr[row], scores.indptr[row + 1]
+            candidates, values = scores.indices[start:end], scores.data[start:end]
+            keep = values >= min_score
+            if allowed is not None:
+                keep &= allowed[candidates]
+            candidates, values = candidates[keep], values[keep]
+            if len(values) > k:
+                top = np.argpartition(-values, k - 1)[:k]
+                candidates, values = candidates[top], values[top]
+            order = np.argsort(-values, kind='stable')
+            results.append([(int(candidates[i]), float(values[i])) for i in order])
+        return results
+
+    def search(self, text, k=5, min_score=0.0, rows=None):
+        """
+        Finds the k reference documents most similar to a raw text.
+
+        Args:
+            text (str): Report text, preprocessed here with utils.preprocess.
+            k (int): Maximum number of matches to return.
+            min_score (float): Matches scoring below this are dropped.
+            rows (array-like): Only these documents may be returned; all if None.
+
+        Returns:
+            list: (document index, cosine score) pairs, best first.
+        """
+        query_vector = self.vectorizer.transform([utils.preprocess(text)])
+        return self.search_vector(query_vector, k=k, min_score=min_score, rows=rows)
+
+
+# Split the shared index into this many shards searched in parallel (see shards.py)
+SHARDS = int(os.environ.get('SEARCH_SHARDS', '1'))
+
+_index = None
+_index_version = None
+_index_lock = threading.Lock()
+
+
+# Index over the shared corpus, rebuilt only when the corpus version changes
+def get_index(store=None):
+    global _index, _index_version
+    store = store or corpus_store.get_store()
+    parts, vectorizer = store.get_parts()
+    with _index_lock:
+        if _index is None or _index_version != store.version:
+            if SHARDS > 1:
+                import shards
+                # The new index takes over the previous one's thread pool, which readers may still be using
+                previous = _index if isinstance(_index, shards.ShardedIndex) else None
+                _index = shards.ShardedIndex.from_parts(parts, vectorizer, SHARDS, previous=previous)
+            else:
+                _index = SearchIndex(parts, vectorizer)
+            _index_version = store.version
+        return _index
+
+
+def search(text, k=5, min_score=0.0, rows=None):
+    """
+    Top-k search of the shared corpus, see SearchIndex.search.
+    """
+    return get_index().search(text, k=k, min_score=min_score, rows=rows)
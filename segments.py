@@ -0,0 +1,246 @@
+import json
+import os
+import shutil
+import threading
+
+from scipy import sparse
+from scipy.sparse import vstack
+
+import mmap_matrix
+
+MANIFEST = 'manifest.json'
+
+
+# Write a file through a temporary name and rename it into place, so readers
+# only ever see the old or the new complete file
+def atomic_write(path, write):
+    tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    try:
+        with open(tmp_path, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+class SegmentStore:
+    """
+    Append-only on-disk TF-IDF matrix made of immutable segments.
+
+    A base segment holds the bulk of the corpus and every accepted report is
+    written as a small append segment, so an append costs I/O proportional to
+    the report. The manifest lists the live segments in row order and is
+    replaced atomically; a segment file only becomes visible once the
+    manifest naming it has been renamed into place. Files that a version
+    replaces are removed only when the next version is published, so a
+    reader of the previous manifest can still open them. compact() merges
+    all segments into a new base. Writers in several processes must be
+    serialised, see journal.CorpusWriter.
+
+    Base segments use the memory-mapped layout from mmap_matrix in CSC
+    order, so worker processes share one copy of the bulk of the corpus and
+    the search index reads its postings in place. Append segments are small
+    compressed .npz files.
+
+    Args:
+        directory (str): Folder holding the manifest and segment files.
+        max_segments (int): Append segments tolerated before maybe_compact() merges.
+    """
+
+    def __init__(self, directory='tfidf_segments', max_segments=32):
+        self.directory = directory
+        self.max_segments = max_segments
+        self.manifest_path = os.path.join(directory, MANIFEST)
+        self._cache = {}
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def read_manifest(self):
+        with open(self.manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        data = json.dumps(manifest, indent=2).encode('utf-8')
+        atomic_write(self.manifest_path, lambda f: f.write(data))
+
+    # Publish a new manifest version. Files it replaces are only retired: they are removed
+    # when the next version is published, so readers of the previous manifest can still open them.
+    def _publish(self, manifest, replaced=()):
+        previous = manifest.get('retired', [])
+        manifest['retired'] = list(replaced)
+        self._write_manifest(manifest)
+        live = {segment['name'] for segment in manifest['segments']}
+        for name in previous:
+            if name not in live:
+                self.remove(name)
+
+    def _write_segment(self, name, matrix):
+        path = os.path.join(self.directory, name)
+        if name.endswith('.npz'):
+            atomic_write(path, lambda f: sparse.save_npz(f, matrix))
+        else:
+            mmap_matrix.save_mmap(matrix, path, format='csc')
+
+    def create(self, tfidf_matrix):
+        """
+        Starts a new store whose base segment is the given matrix.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        name = 'base-000001'
+        self._write_segment(name, tfidf_matrix)
+        self._write_manifest({
+            'version': 1,
+            'next_segment': 2,
+            'n_columns': tfidf_matrix.shape[1],
+            'segments': [{'name': name, 'rows': tfidf_matrix.shape[0]}],
+        })
+
+    def append(self, rows, extra=None, replaced=()):
+        """
+        Writes new rows as an append segment.
+
+        Args:
+            rows (scipy.sparse matrix): Rows to add.
+            extra (dict): Optional keys to publish in the same manifest version.
+            replaced (list): Files of the previous version that extra replaces, retired with it.
+
+        Returns:
+            dict: The new manifest.
+        """
+        manifest = self.read_manifest()
+        manifest.update(extra or {})
+        if rows.shape[1] != manifest['n_columns']:
+            raise ValueError(f"Expected {manifest['n_columns']} columns, got {rows.shape[1]}.")
+        name = f"append-{manifest['next_segment']:06d}.npz"
+        self._write_segment(name, sparse.csr_matrix(rows))
+        manifest['segments'].append({'name': name, 'rows': rows.shape[0]})
+        manifest['next_segment'] += 1
+        manifest['version'] += 1
+        self._publish(manifest, replaced)
+        return manifest
+
+    # Corpus row ranges of the live segments
+    @staticmethod
+    def segment_for_row(manifest, row):
+        first_row = 0
+        for segment in manifest['segments']:
+            if row < first_row + segment['rows']:
+                return segment['name']
+            first_row += segment['rows']
+        return None
+
+    def _load_segment(self, name):
+        # Segments are immutable, so a loaded one never needs re-reading
+        if name not in self._cache:
+            path = os.path.join(self.directory, name)
+            if mmap_matrix.is_mmap_matrix(path):
+                self._cache[name] = mmap_matrix.load_mmap(path)
+            else:
+                self._cache[name] = sparse.load_npz(path).tocsr()
+        return self._cache[name]
+
+    def load_parts(self, manifest=None):
+        """
+        Returns the live segments as a list of matrices in row order, without
+        copying the memory-mapped base.
+        """
+        if manifest is None:
+            return self.snapshot()[1]
+        names = [segment['name'] for segment in manifest['segments']]
+        matrices = [self._load_segment(name) for name in names]
+        for name in list(self._cache):
+            if name not in names:
+                del self._cache[name]
+        return matrices
+
+    def snapshot(self):
+        """
+        Reads the current manifest and its segments as one consistent version.
+
+        Returns:
+            tuple: (manifest, [matrix segments in row order])
+        """
+        manifest = self.read_manifest()
+        while True:
+            try:
+                return manifest, self.load_parts(manifest)
+            except FileNotFoundError:
+                # A compaction may have replaced the segments after we read the manifest;
+                # if it did not, a segment is really missing
+                latest = self.read_manifest()
+                if latest['version'] == manifest['version']:
+                    raise
+                manifest = latest
+
+    # File published with the manifest under the given key, or default if it has none
+    def file_for(self, manifest, key, default=None):
+        name = manifest.get(key)
+        return os.path.join(self.directory, name) if name else default
+
+    def remove(self, name):
+        self._cache.pop(name, None)
+        path = os.path.join(self.directory, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def load(self, manifest=None):
+        """
+        Reads every live segment and returns them as one matrix.
+        """
+        matrices = self.load_parts(manifest)
+        if len(matrices) == 1:
+            return matrices[0]
+        return vstack(matrices, format='csr')
+
+    def compact(self):
+        """
+        Merges all live segments into a single new base segment and retires
+        the old segment files.
+        """
+        manifest = self.read_manifest()
+        return self.replace(self.load(manifest), manifest=manifest)
+
+    def replace(self, tfidf_matrix, extra=None, manifest=None, replaced=()):
+        """
+        Publishes tfidf_matrix as the new single base segment, e.g. after the
+        corpus was re-weighted, and retires the old segment files. The
+        matrix may have more columns than the segments it replaces.
+
+        Args:
+            tfidf_matrix (scipy.sparse matrix): The whole corpus.
+            extra (dict): Optional keys to publish in the same manifest version.
+            manifest (dict): Manifest to base the new version on, defaults to the current one.
+            replaced (list): Other files of the previous version that extra replaces, retired with it.
+
+        Returns:
+            dict: The new manifest.
+        """
+        if manifest is None:
+            manifest = self.read_manifest()
+        manifest.update(extra or {})
+        old_names = [segment['name'] for segment in manifest['segments']]
+        name = f"base-{manifest['next_segment']:06d}"
+        self._write_segment(name, tfidf_matrix)
+        manifest['segments'] = [{'name': name, 'rows': tfidf_matrix.shape[0]}]
+        manifest['n_columns'] = tfidf_matrix.shape[1]
+        manifest['next_segment'] += 1
+        manifest['version'] += 1
+        self._publish(manifest, old_names + list(replaced))
+        return manifest
+
+    def maybe_compact(self):
+        manifest = self.read_manifest()
+        if len(manifest['segments']) > self.max_segments:
+            return self.compact()
+        return manifest
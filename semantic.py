@@ -0,0 +1,831 @@
+"""
+Paraphrase detection: a second stage that re-ranks TF-IDF candidates by meaning.
+
+TF-IDF over whole words scores a reworded report low: inflected or
+respelled words are different columns, and synonyms share nothing. Here
+each document is split into overlapping windows of words (chunks) and
+every chunk becomes a dense vector. The default HashedEmbedder needs no
+model. Each word adds signed hash buckets for itself and for its
+character n-grams, weighted by the corpus vectorizer's IDF, so "analyse",
+"analysed" and "analysis" land close together and word order does not
+matter. With SEMANTIC_MODEL set, a local sentence-transformers model
+(an optional dependency) embeds the chunks instead and also places
+synonyms together.
+
+Chunk vectors are stored int8-quantised, with one scale per vector, in an
+IVF index. Spherical k-means centroids, trained on NumPy, split the
+vectors into lists, and a query chunk only scores the lists of its nprobe
+nearest centroids. Until enough vectors exist to train the centroids, the
+index is searched exhaustively.
+
+A document's semantic score is its coverage of the report: the mean,
+over the report's chunks, of each chunk's best cosine with one of the
+document's chunks. rerank() scores the TF-IDF top candidates together
+with the documents the IVF search finds for the report's chunks, so a
+paraphrase that TF-IDF ranked low still surfaces.
+
+The engine is optional: set SEMANTIC_ENABLED=1 to use it in checker.
+The index is shared by processes through semantic_index.npz and the log
+of chunks added since it was written; checker appends each accepted
+report to the log. Index the documents already in the document store
+(which also empties the log) with:
+    python semantic.py build
+"""
+import hashlib
+import os
+import struct
+import threading
+import zlib
+
+import numpy as np
+from scipy import sparse
+
+from fingerprint import WORD_PATTERN
+import metrics
+from segments import atomic_write
+
+ENABLED = os.environ.get('SEMANTIC_ENABLED', '0').lower() not in ('0', 'false', 'no', 'off', '')
+# Name or path of a sentence-transformers model; the hashed embedder is used when unset
+MODEL = os.environ.get('SEMANTIC_MODEL')
+SEMANTIC_PATH = 'semantic_index.npz'
+# Chunks added since the index file was saved are appended to a log next to it (SEMANTIC_PATH with .log)
+LOG_MAGIC = b'SEMLOG01'
+# magic, length of the embedder name that follows
+LOG_HEADER = struct.Struct('<8sI')
+# corpus row, chunks, CRC-32 of the payload (float32 scales, int64 starts, int64 ends, int8 codes)
+RECORD_HEADER = struct.Struct('<qII')
+# TF-IDF matches handed to rerank(), and the coverage that makes a match a likely paraphrase
+CANDIDATES = 50
+THRESHOLD = 0.5
+
+
+def chunks(text, size=40, stride=20):
+    """
+    Overlapping windows of words, the units that are embedded.
+
+    Returns:
+        tuple: (list of word lists, start offsets, end offsets) of each chunk in text.
+    """
+    matches = list(WORD_PATTERN.finditer(text.lower()))
+    if not matches:
+        return [], np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    words = [match.group() for match in matches]
+    begins = list(range(0, max(len(words) - size, 0) + 1, stride))
+    # The last words get a chunk of their own
+    if begins[-1] + size < len(words):
+        begins.append(len(words) - size)
+    starts = np.array([matches[begin].start() for begin in begins], dtype=np.int64)
+    ends = np.array([matches[min(begin + size, len(words)) - 1].end() for begin in begins], dtype=np.int64)
+    return [words[begin:begin + size] for begin in begins], starts, ends
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class HashedEmbedder:
+    """
+    Chunk vectors from signed feature hashing of words and their character n-grams.
+
+    A word's vector is the sum of its own feature and its n-gram features
+    (the n-grams sharing as much weight as the word), each added with a
+    random sign at `taps` hashed positions, times the word's IDF. A chunk's
+    vector is the sum of its words' vectors with sublinear counts,
+    L2-normalised. Word features are cached, so a batch only hashes words
+    it has not seen before.
+
+    Args:
+        dim (int): Vector size, a power of two up to 4096.
+        ngram_range (tuple): Smallest and largest character n-gram.
+        taps (int): Hashed positions per feature.
+        vectorizer: Fitted TF-IDF vectorizer whose idf_ weights the words;
+            unknown words get the largest weight. Unweighted if None. A
+            digest of the weights is part of the embedder's name.
+        stop_words (frozenset): Words left out.
+        word_weight (float): Weight of a word's own feature relative to its n-grams.
+    """
+
+    def __init__(self, dim=256, ngram_range=(3, 5), taps=4, vectorizer=None, stop_words=frozenset(), word_weight=1.0):
+        if dim & (dim - 1) or not 0 < dim <= 4096:
+            raise ValueError("dim must be a power of two up to 4096.")
+        self.dim = dim
+        self.ngram_range = ngram_range
+        self.taps = taps
+        self.stop_words = stop_words
+        self.word_weight = word_weight
+        self._vocabulary = getattr(vectorizer, 'vocabulary_', None)
+        self._idf = getattr(vectorizer, 'idf_', None)
+        self.name = f"hashed-{dim}-{ngram_range[0]}-{ngram_range[1]}-{taps}-{word_weight:g}"
+        if self._idf is not None:
+            # Vectors from different IDF weights are not comparable, so the weights are part of the name
+            weights = hashlib.blake2b(np.ascontiguousarray(self._idf, dtype=np.float64).tobytes(), digest_size=6)
+            self.name += f"-idf{weights.hexdigest()}"
+        self._max_idf = float(self._idf.max()) if self._idf is not None and len(self._idf) else 1.0
+        self._features = {}
+        self._lock = threading.Lock()
+
+    def _word_features(self, word):
+        cached = self._features.get(word)
+        if cached is not None:
+            return cached
+        low, high = self.ngram_range
+        marked = f"<{word}>"
+        grams = [marked[i:i + n] for n in range(low, high + 1) for i in range(len(marked) - n + 1)]
+        hashes = np.array([_hash('w:' + word)] + [_hash(gram) for gram in grams], dtype=np.uint64)
+        weights = np.full(len(hashes), 1.0 / np.sqrt(max(len(grams), 1)))
+        weights[0] = self.word_weight
+        if self._vocabulary is not None:
+            column = self._vocabulary.get(word)
+            weights *= self._max_idf if column is None else float(self._idf[column])
+        with self._lock:
+            # The cache only holds per-word hashes, but is still bounded for long-running processes
+            if len(self._features) > 500_000:
+                self._features.clear()
+            self._features[word] = (hashes, weights)
+        return hashes, weights
+
+    # Dense vector of each word, one row per word
+    def _word_vectors(self, words):
+        features = [self._word_features(word) for word in words]
+        owners = np.repeat(np.arange(len(words), dtype=np.int64), [len(hashes) for hashes, _ in features])
+        hashes = np.concatenate([hashes for hashes, _ in features])
+        weights = np.concatenate([weights for _, weights in features]) / np.sqrt(self.taps)
+        vectors = np.zeros(len(words) * self.dim)
+        for tap in range(self.taps):
+            positions = (hashes >> np.uint64(12 * tap)) & np.uint64(self.dim - 1)
+            signs = np.where((hashes >> np.uint64(48 + tap)) & np.uint64(1), 1.0, -1.0)
+            vectors += np.bincount(owners * self.dim + positions.astype(np.int64), weights=signs * weights,
+                                   minlength=len(vectors))
+        return vectors.reshape(len(words), self.dim)
+
+    def embed(self, chunk_words):
+        """
+        L2-normalised float32 vectors, one row per chunk (a list of words).
+        """
+        distinct, rows, columns = {}, [], []
+        for i, words in enumerate(chunk_words):
+            for word in words:
+                if word not in self.stop_words:
+                    rows.append(i)
+                    columns.append(distinct.setdefault(word, len(distinct)))
+        if not distinct:
+            return np.zeros((len(chunk_words), self.dim), dtype=np.float32)
+        counts = sparse.csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(chunk_words), len(distinct)))
+        counts.sum_duplicates()
+        counts.data = 1.0 + np.log(counts.data)
+        vectors = np.asarray(counts @ self._word_vectors(list(distinct)), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+
+class ModelEmbedder:
+    """
+    Chunk vectors from a local sentence-transformers model, run on the CPU.
+
+    Args:
+        model_name (str): Model name or path, e.g. a small MiniLM model saved locally.
+        batch_size (int): Chunks encoded per forward pass.
+    """
+
+    def __init__(self, model_name, batch_size=32):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name, device='cpu')
+        self.batch_size = batch_size
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = f"model:{model_name}"
+
+    def embed(self, chunk_words):
+        return self.model.encode([' '.join(words) for words in chunk_words], batch_size=self.batch_size,
+                                 normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+def quantize(vectors):
+    """
+    Symmetric int8 codes with one float32 scale per vector.
+
+    Returns:
+        tuple: (codes, scales) where codes * scales[:, None] approximates vectors.
+    """
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def _dequantize(codes, scales):
+    return codes.astype(np.float32) * scales[:, None]
+
+
+# Row of the most similar centroid for each vector, computed in blocks to bound memory
+def _nearest(vectors, centroids, block=65536):
+    return np.concatenate([np.argmax(vectors[start:start + block] @ centroids.T, axis=1)
+                           for start in range(0, len(vectors), block)]) if len(vectors) else np.empty(0, dtype=np.int64)
+
+
+def kmeans(vectors, n_clusters, iterations=10, sample=100_000, seed=0):
+    """
+    Spherical k-means on L2-normalised vectors, trained on a sample.
+
+    Returns:
+        np.ndarray: float32 unit-length centroids, one row per cluster.
+    """
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample:
+        vectors = vectors[rng.choice(len(vectors), sample, replace=False)]
+    n_clusters = min(n_clusters, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)].astype(np.float32)
+    for _ in range(iterations):
+        assignment = _nearest(vectors, centroids)
+        members = sparse.csr_matrix((np.ones(len(vectors), dtype=np.float32), (assignment, np.arange(len(vectors)))),
+                                    shape=(n_clusters, len(vectors)))
+        sums = np.asarray(members @ vectors, dtype=np.float32)
+        # An empty cluster restarts from a random vector
+        empty = np.flatnonzero(np.bincount(assignment, minlength=n_clusters) == 0)
+        sums[empty] = vectors[rng.choice(len(vectors), len(empty))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.where(norms > 0, norms, 1.0)
+    return centroids
+
+
+class SemanticIndex:
+    """
+    IVF index of int8-quantised chunk vectors, searched per report chunk.
+
+    Vectors are kept sorted by inverted list, so a list is one contiguous
+    slice. New documents are assigned to the nearest centroid and merged on
+    the next search. The centroids are trained once min_train vectors
+    exist, with about sqrt(n) lists; rebuild() retrains them.
+
+    With a path, the index is shared through two files: save() writes every
+    vector to the index file, and add() appends each document's chunks to a
+    log next to it under a file lock. refresh() reads the log records added
+    since the last read, or the whole index again when another process
+    saved it, so an accepted report costs one small append. Both files name
+    the embedder they were built with and are ignored by any other one.
+
+    Args:
+        embedder: HashedEmbedder or ModelEmbedder.
+        nprobe (int): Lists scored per query chunk.
+        chunk_words (int): Words per chunk.
+        chunk_stride (int): Words between chunk starts.
+        min_train (int): Vectors needed before the centroids are trained.
+        batch_size (int): Chunks embedded per embedder call.
+        path (str): Optional index file, read now if it was built with this embedder.
+    """
+
+    def __init__(self, embedder, nprobe=8, chunk_words=40, chunk_stride=20, min_train=4096, batch_size=512,
+                 path=None):
+        self.embedder = embedder
+        self.nprobe = nprobe
+        self.chunk_words = chunk_words
+        self.chunk_stride = chunk_stride
+        self.min_train = min_train
+        self.batch_size = batch_size
+        self.path = path
+        self.log_path = None if path is None else f"{os.path.splitext(path)[0]}.log"
+        # Whether the files at path were written with another embedder, see get_index()
+        self.stale_files = False
+        self._reset()
+        # Never equal to the files' signature, so the first refresh() reads them
+        self._signature = ()
+        self._log_offset = 0
+        self._lock = threading.Lock()
+        self.refresh()
+
+    # Empty arrays, before the index file is read (called under the lock, or from __init__)
+    def _reset(self):
+        self.centroids = None
+        dim = self.embedder.dim
+        self.codes = np.empty((0, dim), dtype=np.int8)
+        self.scales = np.empty(0, dtype=np.float32)
+        self.owners = np.empty(0, dtype=np.int64)
+        self.starts = np.empty(0, dtype=np.int64)
+        self.ends = np.empty(0, dtype=np.int64)
+        self.lists = np.empty(0, dtype=np.int32)
+        self.offsets = np.zeros(2, dtype=np.int64)
+        self._pending = []
+        self._by_owner = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.owners) + sum(len(pending[1]) for pending in self._pending)
+
+    def embed(self, texts):
+        """
+        Chunks of several texts embedded in batches.
+
+        Returns:
+            tuple: (float32 vectors, text index, start offsets, end offsets) per chunk.
+        """
+        words, owners, starts, ends = [], [], [], []
+        for i, text in enumerate(texts):
+            text_words, text_starts, text_ends = chunks(text, self.chunk_words, self.chunk_stride)
+            words.extend(text_words)
+            owners.append(np.full(len(text_words), i, dtype=np.int64))
+            starts.append(text_starts)
+            ends.append(text_ends)
+        if not words:
+            return (np.empty((0, self.embedder.dim), dtype=np.float32),) + tuple(np.empty(0, dtype=np.int64)
+                                                                                 for _ in range(3))
+        vectors = np.vstack([self.embedder.embed(words[start:start + self.batch_size])
+                             for start in range(0, len(words), self.batch_size)])
+        return vectors, np.concatenate(owners), np.concatenate(starts), np.concatenate(ends)
+
+    # Queue quantised chunks for the next merge (called under the lock)
+    def _queue(self, codes, scales, owners, starts, ends):
+        lists = np.zeros(len(codes), dtype=np.int32) if self.centroids is None else \
+            _nearest(_dequantize(codes, scales), self.centroids).astype(np.int32)
+        self._pending.append((codes, scales, owners, starts, ends, lists))
+
+    def add_many(self, rows, texts):
+        """
+        Indexes documents under their corpus rows, appending them to the log
+        when the index has a path.
+        """
+        vectors, owners, starts, ends = self.embed(texts)
+        codes, scales = quantize(vectors)
+        if self.path is None:
+            with self._lock:
+                self._queue(codes, scales, np.asarray(rows, dtype=np.int64)[owners], starts, ends)
+            return
+        records = []
+        for i, row in enumerate(rows):
+            mine = owners == i
+            if mine.any():
+                payload = scales[mine].tobytes() + starts[mine].tobytes() + ends[mine].tobytes() + \
+                    codes[mine].tobytes()
+                records.append(RECORD_HEADER.pack(int(row), int(mine.sum()), zlib.crc32(payload)) + payload)
+        # The journal's file lock; imported here so checker does not load the writer at startup
+        from journal import FileLock
+        with FileLock(f"{self.log_path}.lock"):
+            # Read what others wrote first; anything past it was torn by a crash and is dropped
+            self.refresh()
+            if self.stale_files:
+                # The files belong to another embedder; keep the chunks in this process only
+                with self._lock:
+                    self._queue(codes, scales, np.asarray(rows, dtype=np.int64)[owners], starts, ends)
+                return
+            with open(self.log_path, 'ab') as f:
+                if f.tell() < self._log_offset:
+                    f.truncate(0)
+                    f.write(_log_header(self.embedder.name))
+                elif f.tell() > self._log_offset:
+                    f.truncate(self._log_offset)
+                f.writelines(records)
+                f.flush()
+                os.fsync(f.fileno())
+        self.refresh()
+
+    def add(self, row, text):
+        self.add_many([row], [text])
+
+    def documents(self):
+        """
+        Set of the corpus rows that have chunks in the index.
+        """
+        with self._lock:
+            self._merge_pending()
+            return set(np.unique(self.owners).tolist())
+
+    def refresh(self):
+        """
+        Reads what other processes (and this one) added to the shared files
+        since the last refresh: everything again after a save(), otherwise
+        only the new log records.
+
+        Returns:
+            int: Documents read from the log.
+        """
+        if self.path is None:
+            return 0
+        with self._lock:
+            try:
+                log = open(self.log_path, 'rb')
+            except FileNotFoundError:
+                log = None
+            try:
+                # save() replaces the log after the index file, so either one changing means a reload
+                signature = (_file_signature(self.path), None if log is None else os.fstat(log.fileno()).st_ino)
+                if signature != self._signature:
+                    self._read_index(signature)
+                if self.stale_files or log is None:
+                    return 0
+                name = _read_log_header(log)
+                if name is None:
+                    # No complete header yet: the next append writes one
+                    return 0
+                if name != self.embedder.name:
+                    self.stale_files = True
+                    return 0
+                log.seek(self._log_offset)
+                data = log.read()
+            finally:
+                if log is not None:
+                    log.close()
+            offset, count, dim = 0, 0, self.embedder.dim
+            while offset + RECORD_HEADER.size <= len(data):
+                row, n_chunks, checksum = RECORD_HEADER.unpack_from(data, offset)
+                start = offset + RECORD_HEADER.size
+                end = start + n_chunks * (20 + dim)
+                payload = data[start:end]
+                if end > len(data) or zlib.crc32(payload) != checksum:
+                    break
+                scales = np.frombuffer(payload, dtype=np.float32, count=n_chunks)
+                starts = np.frombuffer(payload, dtype=np.int64, count=n_chunks, offset=n_chunks * 4)
+                ends = np.frombuffer(payload, dtype=np.int64, count=n_chunks, offset=n_chunks * 12)
+                codes = np.frombuffer(payload, dtype=np.int8, offset=n_chunks * 20).reshape(n_chunks, dim)
+                self._queue(codes, scales, np.full(n_chunks, row, dtype=np.int64), starts, ends)
+                offset, count = end, count + 1
+            self._log_offset += offset
+            return count
+
+    # Read the index file, or start empty without one (called under the lock)
+    def _read_index(self, signature):
+        self._reset()
+        self._signature = signature
+        self._log_offset = len(_log_header(self.embedder.name))
+        self.stale_files = False
+        if signature[0] is None:
+            return
+        with np.load(self.path) as data:
+            if bytes(data['embedder']).decode('utf-8') != self.embedder.name:
+                self.stale_files = True
+                return
+            self.nprobe, self.chunk_words, self.chunk_stride, self.min_train = (int(value) for value in data['params'])
+            if len(data['centroids']):
+                self.centroids = data['centroids']
+            self._store(data['codes'], data['scales'], data['owners'], data['starts'], data['ends'], data['lists'])
+
+    # Called with the lock held
+    def _merge_pending(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        codes = np.concatenate([self.codes] + [part[0] for part in pending])
+        scales = np.concatenate([self.scales] + [part[1] for part in pending])
+        owners = np.concatenate([self.owners] + [part[2] for part in pending])
+        starts = np.concatenate([self.starts] + [part[3] for part in pending])
+        ends = np.concatenate([self.ends] + [part[4] for part in pending])
+        lists = np.concatenate([self.lists] + [part[5] for part in pending])
+        if self.centroids is None and len(codes) >= self.min_train:
+            vectors = _dequantize(codes, scales)
+            self.centroids = kmeans(vectors, int(np.sqrt(len(codes))))
+            lists = _nearest(vectors, self.centroids).astype(np.int32)
+        self._store(codes, scales, owners, starts, ends, lists)
+
+    def _store(self, codes, scales, owners, starts, ends, lists):
+        order = np.argsort(lists, kind='stable')
+        self.codes, self.scales, self.owners = codes[order], scales[order], owners[order]
+        self.starts, self.ends, self.lists = starts[order], ends[order], lists[order]
+        n_lists = 1 if self.centroids is None else len(self.centroids)
+        self.offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.lists, minlength=n_lists), out=self.offsets[1:])
+        self._by_owner = np.argsort(self.owners, kind='stable')
+
+    def rebuild(self, n_lists=None):
+        """
+        Retrains the centroids on every vector, e.g. after the corpus grew a
+        lot. Without n_lists, indexes smaller than min_train stay exhaustive.
+        """
+        with self._lock:
+            self._merge_pending()
+            if not len(self.codes) or (n_lists is None and len(self.codes) < self.min_train):
+                return
+            vectors = _dequantize(self.codes, self.scales)
+            self.centroids = kmeans(vectors, n_lists or int(np.sqrt(len(vectors))))
+            self._store(self.codes, self.scales, self.owners, self.starts, self.ends,
+                        _nearest(vectors, self.centroids).astype(np.int32))
+
+    # (list, queries probing it) pairs; every query probes the single list of an untrained index
+    def _probes(self, queries):
+        if self.centroids is None:
+            return [(0, np.arange(len(queries)))]
+        nprobe = min(self.nprobe, len(self.centroids))
+        probed = np.argpartition(-(queries @ self.centroids.T), nprobe - 1, axis=1)[:, :nprobe].ravel()
+        order = np.argsort(probed, kind='stable')
+        lists, bounds = np.unique(probed[order], return_index=True)
+        who = np.split(order // nprobe, bounds[1:])
+        return list(zip(lists.tolist(), who))
+
+    def search_chunks(self, queries, k=10):
+        """
+        Approximate nearest indexed chunks of each query vector.
+
+        Each probed list is scored as one contiguous slice against the
+        queries probing it, so only those lists' codes are converted.
+
+        Returns:
+            tuple: (corpus rows of the chunks, cosine scores), arrays of shape
+            (queries, k) best first; missing neighbours have row -1.
+        """
+        found_rows = [[] for _ in range(len(queries))]
+        found_scores = [[] for _ in range(len(queries))]
+        with self._lock:
+            self._merge_pending()
+            for list_id, who in self._probes(queries):
+                start, stop = self.offsets[list_id], self.offsets[list_id + 1]
+                if start == stop:
+                    continue
+                scores = (queries[who] @ self.codes[start:stop].T.astype(np.float32)) * self.scales[start:stop]
+                if scores.shape[1] > k:
+                    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                else:
+                    top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+                owners = self.owners[start:stop]
+                for position, query in enumerate(who):
+                    found_rows[query].append(owners[top[position]])
+                    found_scores[query].append(scores[position, top[position]])
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        best = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for query in range(len(queries)):
+            if not found_rows[query]:
+                continue
+            query_rows, query_scores = np.concatenate(found_rows[query]), np.concatenate(found_scores[query])
+            order = np.argsort(-query_scores, kind='stable')[:k]
+            rows[query, :len(order)] = query_rows[order]
+            best[query, :len(order)] = query_scores[order]
+        return rows, best
+
+    # Chunk positions of each row, in row order, and the rows that have any
+    def _chunks_of(self, rows):
+        sorted_owners = self.owners[self._by_owner]
+        rows = np.asarray(rows, dtype=np.int64)
+        left = np.searchsorted(sorted_owners, rows, side='left')
+        right = np.searchsorted(sorted_owners, rows, side='right')
+        present = right > left
+        positions = [self._by_owner[start:stop] for start, stop in zip(left[present], right[present])]
+        return rows[present], positions
+
+    def coverage(self, queries, rows):
+        """
+        Semantic score of each row: the mean, over the query chunks, of the
+        best cosine with one of the row's chunks.
+
+        Returns:
+            tuple: (rows that have chunks, scores, best cosine per query chunk and row).
+        """
+        with self._lock:
+            self._merge_pending()
+            rows, positions = self._chunks_of(rows)
+            if not len(rows):
+                return rows, np.empty(0), np.empty((len(queries), 0))
+            flat = np.concatenate(positions)
+            similarity = queries @ _dequantize(self.codes[flat], self.scales[flat]).T
+        bounds = np.cumsum([0] + [len(chunk) for chunk in positions[:-1]])
+        best = np.maximum.reduceat(similarity, bounds, axis=1)
+        return rows, best.mean(axis=0), best
+
+    def rerank_many(self, texts, candidates, k=5, rows=None, neighbours=10):
+        """
+        Re-ranks the TF-IDF candidates of several reports by semantic coverage.
+
+        The chunks of all reports are embedded and searched together, so a
+        batch costs one embedder pass and one product per probed list.
+        Documents the IVF search finds for a report's chunks are scored too,
+        so paraphrases TF-IDF ranked below the candidates are not missed.
+
+        Args:
+            texts (list): Report texts.
+            candidates (list): Per report, (row, TF-IDF score) pairs, e.g. the top CANDIDATES matches.
+            k (int): Matches kept per report.
+            rows (array-like): Only these documents may be returned; all if None.
+            neighbours (int): Nearest indexed chunks looked up per report chunk.
+
+        Returns:
+            list: Per report, (row, semantic score) pairs, best first.
+        """
+        queries, owners, _, _ = self.embed(texts)
+        if not len(queries) or not len(self):
+            return [[] for _ in texts]
+        found, _ = self.search_chunks(queries, neighbours)
+        results = []
+        for i, report_candidates in enumerate(candidates):
+            mine = owners == i
+            report_found = found[mine]
+            scored = np.union1d(np.array([row for row, _ in report_candidates], dtype=np.int64),
+                                report_found[report_found >= 0])
+            if rows is not None:
+                scored = np.intersect1d(scored, np.asarray(rows, dtype=np.int64))
+            if not mine.any() or not len(scored):
+                results.append([])
+                continue
+            scored, scores, _ = self.coverage(queries[mine], scored)
+            order = np.argsort(-scores, kind='stable')[:k]
+            results.append([(int(scored[j]), float(scores[j])) for j in order])
+        return results
+
+    def rerank(self, text, candidates, k=5, rows=None, neighbours=10):
+        """
+        rerank_many() for one report.
+        """
+        return self.rerank_many([text], [candidates], k, rows, neighbours)[0]
+
+    def paraphrased_spans(self, text, row, threshold=THRESHOLD):
+        """
+        Character spans of text whose chunks closely match a chunk of one document.
+
+        Returns:
+            list: (start, end) spans in text, for utils.highlight_spans.
+        """
+        queries, _, starts, ends = self.embed([text])
+        if not len(queries):
+            return []
+        _, _, best = self.coverage(queries, [row])
+        if not best.shape[1]:
+            return []
+        matched = best[:, 0] > threshold
+        return list(zip(starts[matched].tolist(), ends[matched].tolist()))
+
+    def save(self, path=None):
+        """
+        Writes every vector to the index file (the index's own path if
+        omitted) and starts a new, empty log for it.
+        """
+        path = path or self.path
+        log_path = f"{os.path.splitext(path)[0]}.log"
+        from journal import FileLock
+        with FileLock(f"{log_path}.lock"):
+            if path == self.path:
+                # Records other processes appended since the last refresh belong in the new file
+                self.refresh()
+            with self._lock:
+                self._merge_pending()
+                arrays = {
+                    'params': np.array([self.nprobe, self.chunk_words, self.chunk_stride, self.min_train],
+                                       dtype=np.int64),
+                    'embedder': np.frombuffer(self.embedder.name.encode('utf-8'), dtype=np.uint8),
+                    'centroids': np.empty((0, self.embedder.dim), dtype=np.float32) if self.centroids is None
+                    else self.centroids,
+                    'codes': self.codes, 'scales': self.scales, 'owners': self.owners,
+                    'starts': self.starts, 'ends': self.ends, 'lists': self.lists,
+                }
+                atomic_write(path, lambda f: np.savez(f, **arrays))
+                # A crash before the log is replaced only replays chunks the file already has
+                header = _log_header(self.embedder.name)
+                atomic_write(log_path, lambda f: f.write(header))
+                if path == self.path:
+                    self._signature = (_file_signature(path), os.stat(log_path).st_ino)
+                    self._log_offset = len(header)
+                    self.stale_files = False
+
+
+# Header of a new log for the embedder with this name
+def _log_header(name):
+    name = name.encode('utf-8')
+    return LOG_HEADER.pack(LOG_MAGIC, len(name)) + name
+
+
+# Embedder name in a log's header, or None when the header is incomplete
+def _read_log_header(f):
+    header = f.read(LOG_HEADER.size)
+    if len(header) < LOG_HEADER.size:
+        return None
+    magic, length = LOG_HEADER.unpack(header)
+    if magic != LOG_MAGIC:
+        raise ValueError("Not a semantic index log.")
+    name = f.read(length)
+    return name.decode('utf-8') if len(name) == length else None
+
+
+# Identity of a file's current version, None when it does not exist
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def build_index(index, store=None, batch=256, skip=()):
+    """
+    Indexes every text in the document store, e.g. after the embedder changed.
+
+    Args:
+        index (SemanticIndex): Index to add to, usually an empty one without a path.
+        store (documents.DocumentStore): Source of the texts, the shared one if omitted.
+        batch (int): Documents embedded together.
+        skip (set): Rows already indexed.
+
+    Returns:
+        int: Documents indexed.
+    """
+    if store is None:
+        import documents
+        store = documents.get_store()
+    rows, count = [row for row in store.rows() if int(row) not in skip], 0
+    for begin in range(0, len(rows), batch):
+        texts = [(int(row), store.text(row)) for row in rows[begin:begin + batch]]
+        texts = [(row, text) for row, text in texts if text]
+        index.add_many([row for row, _ in texts], [text for _, text in texts])
+        count += len(texts)
+    return count
+
+
+_embedder = None
+_embedder_vectorizer = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder():
+    """
+    The sentence-transformers model named by SEMANTIC_MODEL, else a
+    HashedEmbedder weighted by the corpus vectorizer. The embedder is
+    reused until an IDF refresh replaces the vectorizer.
+    """
+    global _embedder, _embedder_vectorizer
+    with _embedder_lock:
+        if MODEL:
+            if _embedder is None:
+                _embedder = ModelEmbedder(MODEL)
+            return _embedder
+        import corpus_store
+        import preprocessing
+        _, vectorizer = corpus_store.get_store().get_parts()
+        if _embedder is None or vectorizer is not _embedder_vectorizer:
+            stop_words = preprocessing.get_preprocessor('regex').stop_words
+            embedder = HashedEmbedder(vectorizer=vectorizer, stop_words=stop_words)
+            # A reloaded vectorizer with the same weights keeps the embedder and its word cache
+            if _embedder is None or embedder.name != _embedder.name:
+                _embedder = embedder
+            _embedder_vectorizer = vectorizer
+        return _embedder
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+_rebuild_thread = None
+
+
+# Build the shared files for a new embedder from the document store, then make them the process's index
+def _rebuild(path, embedder):
+    global _index
+    from journal import FileLock
+    # One process rebuilds; the others wait here, in the background, and read its file
+    with FileLock(f"{path}.build.lock"):
+        if get_embedder().name != embedder.name:
+            # Another refit replaced the weights meanwhile; the next get_index() builds for those
+            return
+        index = SemanticIndex(embedder, path=path)
+        if index.stale_files:
+            with metrics.timed('semantic_rebuild', embedder=embedder.name):
+                rebuilt = SemanticIndex(embedder, index.nprobe, index.chunk_words, index.chunk_stride,
+                                        index.min_train)
+                build_index(rebuilt)
+                rebuilt.rebuild()
+                rebuilt.save(path)
+            index.refresh()
+    with _index_lock:
+        _index = index
+    # Reports added to the previous index while this one was built
+    build_index(index, skip=index.documents())
+
+
+# Shared index for the process, with what other processes added since the last call
+def get_index(path=SEMANTIC_PATH):
+    """
+    The process's index over the shared files at path.
+
+    A refit changes the IDF weights and with them the embedder's name. The
+    index is then rebuilt from the document store on a background thread,
+    and the previous index and embedder keep serving until it is done. A
+    process whose files were built with another embedder starts with an
+    empty index in the meantime.
+    """
+    global _index, _rebuild_thread
+    embedder = get_embedder()
+    with _index_lock:
+        if _index is None:
+            _index = SemanticIndex(embedder, path=path)
+        if (_index.embedder.name != embedder.name or _index.stale_files) and \
+                (_rebuild_thread is None or not _rebuild_thread.is_alive()):
+            _rebuild_thread = threading.Thread(target=_rebuild, args=(path, embedder), name='semantic-rebuild',
+                                               daemon=True)
+            _rebuild_thread.start()
+        index = _index
+    index.refresh()
+    return index
+
+
+def main(argv=None):
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Build the semantic index from the texts in the document store.")
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('--output', default=SEMANTIC_PATH)
+    parser.add_argument('--lists', type=int, default=None, help="IVF lists, about sqrt(chunks) if omitted")
+    parser.add_argument('--batch', type=int, default=256, help="Documents embedded together")
+    args = parser.parse_args(argv)
+
+    index = SemanticIndex(get_embedder())
+    start = time.perf_counter()
+    build_index(index, batch=args.batch)
+    index.rebuild(args.lists)
+    index.save(args.output)
+    lists = 0 if index.centroids is None else len(index.centroids)
+    print(f"Indexed {len(index)} chunks of {len(np.unique(index.owners))} documents in {lists or 'no'} lists "
+          f"({index.codes.nbytes / 1e6:.1f} MB of codes) in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
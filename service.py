@@ -0,0 +1,398 @@
+"""
+Headless HTTP scoring service, for LMS integrations and load-balanced deployments.
+
+The corpus, search index and fingerprint index (and the semantic index,
+with SEMANTIC_ENABLED=1) are loaded once per process and shared by every
+request. The asyncio event loop only parses requests:
+text extraction runs in a process pool, and scoring runs in a thread pool
+next to the in-memory corpus. Concurrent /check requests are coalesced by
+a MicroBatcher, so a burst of checks costs one vectorizer call and one
+sparse product against the corpus.
+
+Endpoints:
+    POST /check         JSON {"text": ..., "threshold": 0.2, "k": 5}, or a multipart "file" upload;
+                        "course", "submitter" or "exclude_submitter" limit the documents compared against
+    POST /batch-check   JSON {"texts": [...]}, or several multipart "file" uploads
+    POST /corpus        JSON {"text": ...} or a "file" upload; adds the report to the reference set,
+                        with optional "id", "submitter", "course" and "submitted_at" (epoch seconds)
+    GET  /documents/{row}  Metadata of a corpus document, and its text with ?text=1
+    GET  /health        Corpus version and size
+    GET  /metrics       Request counts and latency percentiles per endpoint
+    GET  /metrics/prometheus  Pipeline stage timings, sizes and corpus gauges (see metrics.py)
+
+Usage:
+    python service.py --port 8080 --workers 4
+"""
+import argparse
+import asyncio
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from aiohttp import web
+
+import checker
+import corpus_store
+import documents
+import extraction
+import fingerprint
+import metrics
+import result_cache
+import search
+import semantic
+
+
+class LatencyTracker:
+    """
+    Request counts and latency percentiles per endpoint over a sliding window.
+    """
+
+    def __init__(self, window=10000):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._counts = defaultdict(int)
+        self._errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, error=False):
+        self._samples[endpoint].append(seconds)
+        self._counts[endpoint] += 1
+        if error:
+            self._errors[endpoint] += 1
+
+    def summary(self):
+        summary = {}
+        for endpoint, samples in self._samples.items():
+            p50, p90, p99 = np.percentile(np.fromiter(samples, dtype=np.float64), [50, 90, 99]) * 1e3
+            summary[endpoint] = {
+                'count': self._counts[endpoint],
+                'errors': self._errors[endpoint],
+                'p50_ms': round(float(p50), 3),
+                'p90_ms': round(float(p90), 3),
+                'p99_ms': round(float(p99), 3),
+                'max_ms': round(max(samples) * 1e3, 3),
+            }
+        return summary
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into batches for a function run in an executor.
+
+    A batch is dispatched when it reaches max_batch items or max_wait seconds
+    after its first item arrived, whichever comes first.
+
+    Args:
+        function (callable): Takes a list of items, returns a list of results in the same order.
+        executor: Executor the function runs in.
+        max_batch (int): Largest batch.
+        max_wait (float): Longest time the first item of a batch waits for company.
+        concurrency (int): Batches allowed to run at the same time.
+    """
+
+    def __init__(self, function, executor, max_batch=32, max_wait=0.005, concurrency=1):
+        self.function = function
+        self.executor = executor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.concurrency = concurrency
+        self.batch_sizes = deque(maxlen=1000)
+        self._queue = None
+        self._slots = None
+        self._task = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._slots.acquire()
+            loop.create_task(self._execute(batch))
+
+    async def _execute(self, batch):
+        try:
+            self.batch_sizes.append(len(batch))
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.function, [item for item, _ in batch])
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._slots.release()
+
+
+# Metadata filters a request may restrict its check with (see documents.DocumentStore.rows)
+FILTERS = ('course', 'submitter', 'exclude_submitter')
+
+
+# Scores a batch of (text, data, threshold, k, filters) items, one analyse_many() call per distinct filter
+def _check_batch(items):
+    groups = defaultdict(list)
+    for position, item in enumerate(items):
+        groups[item[4]].append(position)
+    verdicts = [None] * len(items)
+    for filters, positions in groups.items():
+        k = max(items[position][3] for position in positions)
+        results = checker.analyse_many([items[position][0] for position in positions], k=k,
+                                       data=[items[position][1] for position in positions],
+                                       filters=dict(filters) if filters else None)
+        for position, result in zip(positions, results):
+            text, _, threshold, item_k, _ = items[position]
+            verdict = checker.verdict(result, threshold)
+            verdict['matches'] = verdict['matches'][:item_k]
+            verdict['characters'] = len(text)
+            verdicts[position] = verdict
+    # Every matched row is described by its metadata, looked up together
+    records = documents.get_store().get_many(
+        [row for verdict in verdicts for row, _ in verdict['matches'] + verdict['paraphrases']] +
+        [passage.doc_id for verdict in verdicts for passage in verdict['passages']] +
+        [verdict['duplicate_of'] for verdict in verdicts if verdict['duplicate_of'] is not None])
+    for verdict in verdicts:
+        verdict['documents'] = records
+    return verdicts
+
+
+def _verdict_json(verdict):
+    records = verdict['documents']
+    return {
+        'flagged': verdict['flagged'],
+        'duplicate_of': verdict['duplicate_of'],
+        'characters': verdict['characters'],
+        'matches': [{'row': row, 'score': round(score, 6), 'document': records.get(row)}
+                    for row, score in verdict['matches']],
+        'paraphrases': [{'row': row, 'score': round(score, 6), 'document': records.get(row)}
+                        for row, score in verdict['paraphrases']],
+        'passages': [{'row': p.doc_id, 'start': p.query_start, 'end': p.query_end, 'fingerprints': p.fingerprints,
+                      'document': records.get(p.doc_id)}
+                     for p in verdict['passages']],
+    }
+
+
+class ScoringService:
+    """
+    aiohttp application holding the worker pools, the batcher and the metrics.
+
+    Args:
+        workers (int): Extraction processes and scoring threads.
+        max_batch (int): Largest batch of /check requests scored together.
+        max_wait (float): Seconds a /check request may wait to be batched.
+        timeout (float): Seconds allowed to extract one upload.
+        max_upload (int): Largest accepted request body in bytes.
+    """
+
+    def __init__(self, workers=None, max_batch=32, max_wait=0.005, timeout=60, max_upload=50 * 1024 * 1024):
+        self.workers = workers or os.cpu_count() or 1
+        self.timeout = timeout
+        self.max_upload = max_upload
+        self.extract_pool = None
+        self.score_pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='score')
+        self.batcher = MicroBatcher(_check_batch, self.score_pool, max_batch, max_wait, concurrency=self.workers)
+        self.latency = LatencyTracker()
+        # Held from the duplicate check of a POST /corpus report until it is added
+        self._add_lock = threading.Lock()
+
+    def app(self):
+        app = web.Application(client_max_size=self.max_upload, middlewares=[self._track_latency])
+        app.router.add_post('/check', self.check)
+        app.router.add_post('/batch-check', self.batch_check)
+        app.router.add_post('/corpus', self.add_to_corpus)
+        app.router.add_get('/documents/{row}', self.document)
+        app.router.add_get('/health', self.health)
+        app.router.add_get('/metrics', self.metrics)
+        app.router.add_get('/metrics/prometheus', self.prometheus)
+        app.on_startup.append(self._startup)
+        app.on_cleanup.append(self._cleanup)
+        return app
+
+    async def _startup(self, app):
+        self.extract_pool = ProcessPoolExecutor(max_workers=self.workers)
+        # Load the corpus and both indexes before taking traffic
+        await asyncio.get_running_loop().run_in_executor(self.score_pool, self._warm_up)
+        self.batcher.start()
+
+    @staticmethod
+    def _warm_up():
+        search.get_index()
+        fingerprint.get_index()
+        if semantic.ENABLED:
+            semantic.get_index()
+
+    async def _cleanup(self, app):
+        await self.batcher.stop()
+        self.extract_pool.shutdown(cancel_futures=True)
+        self.score_pool.shutdown()
+
+    @web.middleware
+    async def _track_latency(self, request, handler):
+        start = time.perf_counter()
+        error = True
+        try:
+            response = await handler(request)
+            error = response.status >= 400
+            return response
+        finally:
+            self.latency.record(request.path, time.perf_counter() - start, error)
+
+    # Reports, raw bytes, options and metadata filters of a request; uploads are extracted in the process pool
+    async def _read_reports(self, request, many):
+        if request.content_type.startswith('multipart/'):
+            form = await request.post()
+            uploads = [field for field in form.getall('file', []) if hasattr(field, 'file')]
+            if not uploads:
+                raise web.HTTPBadRequest(text="Expected a multipart 'file' field.")
+            if not many:
+                uploads = uploads[:1]
+            data = [upload.file.read() for upload in uploads]
+            texts = await asyncio.gather(*(self._extract(blob, upload.filename)
+                                           for blob, upload in zip(data, uploads)), return_exceptions=many)
+            options = form
+        else:
+            try:
+                options = await request.json()
+            except ValueError:
+                raise web.HTTPBadRequest(text="Expected a JSON body.")
+            if not isinstance(options, dict):
+                raise web.HTTPBadRequest(text="Expected a JSON object.")
+            texts = options.get('texts') if many else [options.get('text')]
+            if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                raise web.HTTPBadRequest(text="Expected 'texts' as a list of strings." if many
+                                         else "Expected 'text' as a string.")
+            data = [None] * len(texts)
+        try:
+            threshold, k = float(options.get('threshold', 0.2)), int(options.get('k', 5))
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text="'threshold' and 'k' must be numbers.")
+        if k < 1:
+            raise web.HTTPBadRequest(text="'k' must be at least 1.")
+        # Hashable, so requests with the same filters are scored together
+        filters = tuple((name, str(options[name])) for name in FILTERS if options.get(name)) or None
+        return texts, data, threshold, k, filters, options
+
+    async def _extract(self, data, filename):
+        text = result_cache.get_cache().cached_text(data)
+        if text is not None:
+            return text
+        try:
+            # Extraction metrics of the worker processes stay there, so the pool call is timed here
+            with metrics.timed('extract_pool', filename=filename, bytes=len(data)):
+                return await asyncio.get_running_loop().run_in_executor(
+                    self.extract_pool, extraction.extract, data, filename, self.timeout)
+        except Exception as e:
+            raise web.HTTPUnprocessableEntity(text=f"Could not extract {filename}: {type(e).__name__}: {e}")
+
+    async def check(self, request):
+        texts, data, threshold, k, filters, _ = await self._read_reports(request, many=False)
+        verdict = await self.batcher.submit((texts[0], data[0], threshold, k, filters))
+        return web.json_response(_verdict_json(verdict))
+
+    async def batch_check(self, request):
+        texts, data, threshold, k, filters, _ = await self._read_reports(request, many=True)
+        items = [(text, blob, threshold, k, filters) for text, blob in zip(texts, data) if isinstance(text, str)]
+        # Already a batch, so it goes straight to the scoring pool
+        verdicts = iter(await asyncio.get_running_loop().run_in_executor(self.score_pool, _check_batch, items)
+                        if items else [])
+        # Uploads that could not be extracted are reported in place, without failing the batch
+        results = [_verdict_json(next(verdicts)) if isinstance(text, str) else {'error': text.text}
+                   for text in texts]
+        return web.json_response({'results': results})
+
+    async def add_to_corpus(self, request):
+        texts, data, _, _, _, options = await self._read_reports(request, many=False)
+        try:
+            timestamp = float(options['submitted_at']) if options.get('submitted_at') else None
+        except (TypeError, ValueError):
+            raise web.HTTPBadRequest(text="'submitted_at' must be seconds since the epoch.")
+        metadata = [options.get(name) or None for name in ('id', 'submitter', 'course')]
+        row, added = await asyncio.get_running_loop().run_in_executor(
+            self.score_pool, self._add_unique, texts[0], data[0], metadata, timestamp)
+        if not added:
+            return web.json_response({'row': row, 'added': False}, status=409)
+        return web.json_response({'row': row, 'added': True, 'document': documents.get_store().get(row)},
+                                 status=201)
+
+    # Checks and adds a report in one step, so two concurrent adds of the same text cannot both pass the check
+    def _add_unique(self, text, data, metadata, timestamp):
+        with self._add_lock:
+            result = checker.analyse_report(text, 5, data)
+            if result['duplicate_of'] is not None:
+                return result['duplicate_of'], False
+            return checker.add_report(text, result['vector'], *metadata, timestamp), True
+
+    async def document(self, request):
+        try:
+            row = int(request.match_info['row'])
+        except ValueError:
+            raise web.HTTPBadRequest(text="The row must be an integer.")
+        store = documents.get_store()
+        record = store.get(row)
+        if record is None:
+            raise web.HTTPNotFound(text=f"No metadata for row {row}.")
+        if request.query.get('text') in ('1', 'true'):
+            record['text'] = store.text(row)
+        return web.json_response(record)
+
+    async def health(self, request):
+        stats = corpus_store.get_store().stats()
+        return web.json_response({'status': 'ok', 'version': stats['version'], 'documents': stats['documents']})
+
+    async def metrics(self, request):
+        sizes = self.batcher.batch_sizes
+        return web.json_response({
+            'endpoints': self.latency.summary(),
+            'mean_batch_size': round(sum(sizes) / len(sizes), 2) if sizes else 0.0,
+            'corpus': corpus_store.get_store().stats(),
+            'result_cache': result_cache.get_cache().stats,
+            'stages': metrics.STAGE_SECONDS.summary(),
+        })
+
+    async def prometheus(self, request):
+        return web.Response(body=metrics.render().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the plagiarism scoring HTTP service.")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=None, help="Extraction processes and scoring threads")
+    parser.add_argument('--max-batch', type=int, default=32, help="Largest batch of /check requests")
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help="How long a /check waits to be batched")
+    parser.add_argument('--timeout', type=float, default=60, help="Seconds allowed per upload extraction")
+    args = parser.parse_args(argv)
+    service = ScoringService(args.workers, args.max_batch, args.max_wait_ms / 1000, args.timeout)
+    web.run_app(service.app(), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
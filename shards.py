@@ -0,0 +1,205 @@
+"""
+Sharded corpus with parallel scatter-gather top-k search.
+
+The corpus rows are split into contiguous shards, each searched by its own
+SearchIndex. A query is sent to every shard at once, each shard returns its
+own top-k with global row numbers, and merge_top_k() keeps the best k
+overall. Because a document lives in exactly one shard, the merged result
+is the same as searching the whole corpus.
+
+Two ways to run the shards:
+    ShardedIndex.from_parts(parts, vectorizer, n_shards)
+        In-process shards on a thread pool. Used by search.get_index() when
+        SEARCH_SHARDS is set; the base segment's shards are kept across
+        appends and only the appended rows form a new tail shard.
+    ShardedIndex.open(directory, vectorizer)
+        One worker process per shard, each memory-mapping its shard written
+        by write_shards(), so scoring is not limited by the GIL.
+"""
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import vstack
+
+import mmap_matrix
+import search
+import utils
+from segments import atomic_write
+
+SHARD_DIR = 'tfidf_shards'
+SHARD_MANIFEST = 'shards.json'
+
+
+# Contiguous, balanced (start, stop) row ranges
+def shard_ranges(n_rows, n_shards):
+    n_shards = max(1, min(n_shards, n_rows)) if n_rows else 1
+    bounds = [n_rows * i // n_shards for i in range(n_shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def merge_top_k(results, k):
+    """
+    Merges per-shard (row, score) lists into the overall top k, best first.
+    Ties are broken by row so the result does not depend on shard timing.
+    """
+    merged = [match for matches in results for match in matches]
+    merged.sort(key=lambda match: (-match[1], match[0]))
+    return merged[:k]
+
+
+def write_shards(tfidf_matrix, directory=SHARD_DIR, n_shards=4):
+    """
+    Splits a matrix into n_shards memory-mappable shards for ShardedIndex.open().
+    Shards are stored normalised in CSC order, ready to be searched in place.
+    """
+    os.makedirs(directory, exist_ok=True)
+    tfidf_matrix = sparse.csr_matrix(tfidf_matrix)
+    shards = []
+    for i, (start, stop) in enumerate(shard_ranges(tfidf_matrix.shape[0], n_shards)):
+        name = f"shard-{i:03d}"
+        mmap_matrix.save_mmap(search.to_postings(tfidf_matrix[start:stop]), os.path.join(directory, name), format='csc')
+        shards.append({'name': name, 'offset': start, 'rows': stop - start})
+    manifest = json.dumps({'n_columns': tfidf_matrix.shape[1], 'shards': shards}, indent=2).encode('utf-8')
+    atomic_write(os.path.join(directory, SHARD_MANIFEST), lambda f: f.write(manifest))
+    return shards
+
+
+# Shard held by a worker process, set once by its initializer
+_shard = None
+
+
+def _load_shard(path, offset):
+    global _shard
+    _shard = (offset, search.SearchIndex(mmap_matrix.load_mmap(path), None))
+
+
+# Global rows falling in a shard, as rows of the shard
+def _shard_rows(rows, offset, n_rows):
+    if rows is None:
+        return None
+    rows = np.asarray(rows, dtype=np.int64) - offset
+    return rows[(rows >= 0) & (rows < n_rows)]
+
+
+def _search_shard(queries, k, min_score, rows=None):
+    offset, index = _shard
+    return [[(offset + row, score) for row, score in matches]
+            for matches in index.search_many(queries, k, min_score, _shard_rows(rows, offset, index.n_documents))]
+
+
+class _LocalShard:
+    def __init__(self, offset, matrix):
+        self.offset = offset
+        self.base = matrix
+        self.index = search.SearchIndex(matrix, None)
+
+    def search_many(self, queries, k, min_score, rows=None):
+        rows = _shard_rows(rows, self.offset, self.index.n_documents)
+        return [[(self.offset + row, score) for row, score in matches]
+                for matches in self.index.search_many(queries, k, min_score, rows)]
+
+
+class ShardedIndex:
+    """
+    Scatter-gather top-k cosine search over corpus shards, with the same
+    search/search_vector/search_many interface as search.SearchIndex.
+    Use the from_parts() or open() constructors.
+    """
+
+    def __init__(self, vectorizer, n_documents):
+        self.vectorizer = vectorizer
+        self.n_documents = n_documents
+        self._local = []
+        self._executors = []
+        self._pool = None
+        self._owns_pool = False
+        self._base = None
+        self._tail = None
+
+    @classmethod
+    def from_parts(cls, parts, vectorizer, n_shards=4, previous=None):
+        """
+        Thread-pool shards over in-memory segments. The first (base) segment
+        is split into n_shards; later append segments form one tail shard.
+        Shards of previous whose base is the same segment are reused, and so
+        is its thread pool: searches still running on previous keep working,
+        and close() on it no longer stops the pool.
+        """
+        parts = parts if isinstance(parts, (list, tuple)) else [parts]
+        index = cls(vectorizer, sum(part.shape[0] for part in parts))
+        base = parts[0]
+        if previous is not None and previous._local and previous._base is base:
+            index._local = [shard for shard in previous._local if shard.base is not previous._tail]
+        else:
+            csr = sparse.csr_matrix(base)
+            index._local = [_LocalShard(start, csr[start:stop]) for start, stop in shard_ranges(base.shape[0], n_shards)]
+        index._base = base
+        if len(parts) > 1:
+            index._tail = vstack(parts[1:], format='csr')
+            index._local.append(_LocalShard(base.shape[0], index._tail))
+        if previous is not None and previous._pool is not None:
+            index._pool, index._owns_pool = previous._pool, previous._owns_pool
+            previous._owns_pool = False
+        else:
+            # Room for the base shards and the tail shard of every later generation
+            index._pool = ThreadPoolExecutor(max_workers=n_shards + 1, thread_name_prefix='shard')
+            index._owns_pool = True
+        return index
+
+    @classmethod
+    def open(cls, directory=SHARD_DIR, vectorizer=None, mp_context=None):
+        """
+        One single-process pool per shard written by write_shards(); each
+        worker maps its shard once at start-up.
+        """
+        with open(os.path.join(directory, SHARD_MANIFEST), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        index = cls(vectorizer, sum(shard['rows'] for shard in manifest['shards']))
+        for shard in manifest['shards']:
+            index._executors.append(ProcessPoolExecutor(
+                max_workers=1, mp_context=mp_context, initializer=_load_shard,
+                initargs=(os.path.join(directory, shard['name']), shard['offset'])))
+        return index
+
+    @property
+    def n_shards(self):
+        return len(self._local) or len(self._executors)
+
+    def search_many(self, query_matrix, k=5, min_score=0.0, rows=None):
+        """
+        Scores a batch of vectorized queries on every shard in parallel.
+        rows restricts the documents returned, as in SearchIndex.search_many.
+
+        Returns:
+            list: One list of (document index, cosine score) pairs per query row, best first.
+        """
+        queries = sparse.csr_matrix(query_matrix)
+        if self._local:
+            futures = [self._pool.submit(shard.search_many, queries, k, min_score, rows) for shard in self._local]
+        else:
+            futures = [executor.submit(_search_shard, queries, k, min_score, rows) for executor in self._executors]
+        per_shard = [future.result() for future in futures]
+        return [merge_top_k([shard[row] for shard in per_shard], k) for row in range(queries.shape[0])]
+
+    def search_vector(self, query_vector, k=5, min_score=0.0, rows=None):
+        return self.search_many(query_vector, k, min_score, rows)[0]
+
+    def search(self, text, k=5, min_score=0.0, rows=None):
+        query_vector = self.vectorizer.transform([utils.preprocess(text)])
+        return self.search_vector(query_vector, k=k, min_score=min_score, rows=rows)
+
+    def close(self):
+        if self._owns_pool:
+            self._pool.shutdown(wait=False)
+            self._owns_pool = False
+        for executor in self._executors:
+            executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
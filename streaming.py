@@ -0,0 +1,115 @@
+"""
+Streaming TF-IDF vectorisation for very large documents.
+
+A document is read as a stream of pages, paragraphs or lines
+(extraction.iter_chunks). Each chunk is normalised, tokenised and counted
+straight into the vectorizer's vocabulary before the next one is read, so
+peak memory depends on the chunk size and the number of distinct words
+rather than on the document length. The result matches
+vectorizer.transform([preprocess(text)]) for the whole text.
+"""
+import os
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+import extraction
+from preprocessing import get_preprocessor
+
+
+def count_terms(chunks, vectorizer, tokenizer='nltk'):
+    """
+    Accumulates vocabulary term counts over an iterable of text chunks.
+
+    Returns:
+        tuple: (Counter of term index -> count, dict of chunk/character/token totals)
+    """
+    preprocessor = get_preprocessor(tokenizer)
+    analyze = vectorizer.build_analyzer()
+    vocabulary = vectorizer.vocabulary_
+    term_counts = Counter()
+    stats = {'chunks': 0, 'characters': 0, 'tokens': 0}
+    for chunk in chunks:
+        stats['chunks'] += 1
+        stats['characters'] += len(chunk)
+        terms = analyze(preprocessor(chunk))
+        stats['tokens'] += len(terms)
+        term_counts.update(terms)
+    # Each distinct term is looked up once, in bulk when the vocabulary supports it
+    terms = list(term_counts)
+    if hasattr(vocabulary, 'lookup'):
+        indices = [index if index >= 0 else None for index in vocabulary.lookup(terms).tolist()]
+    else:
+        indices = map(vocabulary.get, terms)
+    counts = Counter({index: term_counts[term] for term, index in zip(terms, indices) if index is not None})
+    return counts, stats
+
+
+# Apply the vectorizer's tf/idf/norm settings to a single row of term counts
+def weight_counts(counts, vectorizer):
+    indices = np.fromiter(sorted(counts), dtype=np.int32, count=len(counts))
+    data = np.fromiter((counts[index] for index in indices), dtype=np.float64, count=len(counts))
+    if vectorizer.binary:
+        data[:] = 1.0
+    if vectorizer.sublinear_tf:
+        data = np.log(data) + 1.0
+    if vectorizer.use_idf:
+        data *= vectorizer.idf_[indices]
+    row = sparse.csr_matrix((data, indices, np.array([0, len(indices)])),
+                            shape=(1, len(vectorizer.vocabulary_)), dtype=vectorizer.dtype)
+    if vectorizer.norm is not None:
+        row = normalize(row, norm=vectorizer.norm, copy=False)
+    return row
+
+
+def stream_vectorize(chunks, vectorizer, tokenizer='nltk'):
+    """
+    TF-IDF row for a document given as an iterable of text chunks.
+
+    Returns:
+        tuple: (1 x vocabulary CSR row, dict of chunk/character/token totals)
+    """
+    counts, stats = count_terms(chunks, vectorizer, tokenizer)
+    return weight_counts(counts, vectorizer), stats
+
+
+def vectorize_document(file_or_bytes, vectorizer, filename=None, tokenizer='nltk'):
+    """
+    Streams a .txt, .docx or .pdf document straight into a TF-IDF row without
+    materialising its full text.
+    """
+    return stream_vectorize(extraction.iter_chunks(file_or_bytes, filename), vectorizer, tokenizer)
+
+
+_worker_vectorizer = None
+
+
+# ExtractionPool initializer: each worker unpickles the vectorizer once
+def init_worker(vectorizer):
+    global _worker_vectorizer
+    _worker_vectorizer = vectorizer
+
+
+# ExtractionPool task: (row, stats, error) for one document, under the pool's timeout
+def vectorize_task(source, filename, timeout):
+    try:
+        with extraction.deadline(timeout):
+            row, stats = vectorize_document(source, _worker_vectorizer, filename)
+        return row, stats, None
+    except Exception as e:
+        return None, None, f"{type(e).__name__}: {e}"
+
+
+def vectorize_many(sources, vectorizer, workers=None, timeout=60):
+    """
+    Streams many documents through worker processes, each returning only
+    its sparse TF-IDF row, never its text.
+
+    Yields:
+        tuple: (row or None, stats or None, error or None) in input order.
+    """
+    with extraction.ExtractionPool(workers=workers or os.cpu_count(), timeout=timeout,
+                                   initializer=init_worker, initargs=(vectorizer,)) as pool:
+        yield from pool.map_tasks(vectorize_task, sources)
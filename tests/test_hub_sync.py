@@ -0,0 +1,116 @@
+"""
+HubSyncWorker against hub_sync.LocalHub: coalescing, retries, compaction and restore.
+
+Usage:
+    python -m pytest tests/test_hub_sync.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scipy import sparse
+
+import hub_sync
+from journal import CorpusWriter
+from segments import SegmentStore
+
+REPO_ID = 'test/corpus'
+
+
+def make_rows(n_rows, seed, n_columns=50):
+    return sparse.random(n_rows, n_columns, density=0.2, format='csr', random_state=seed)
+
+
+def make_store(tmp_path, max_segments=32):
+    store = SegmentStore(str(tmp_path / 'tfidf_segments'), max_segments=max_segments)
+    writer = CorpusWriter(store)
+    writer.initialize(make_rows(10, seed=0))
+    return store, writer
+
+
+# Append rows through the journal and mark their segment like checker.add_report does
+def append(writer, worker, rows):
+    writer.submit(rows)
+    manifest = writer.apply()
+    worker.mark_dirty(SegmentStore.segment_for_row(manifest, sum(s['rows'] for s in manifest['segments']) - 1))
+
+
+def restore(hub, tmp_path):
+    restored = tmp_path / 'restored' / 'tfidf_segments'
+    assert hub_sync.restore_segments(str(restored), repo_id=REPO_ID, api=hub)
+    return SegmentStore(str(restored))
+
+
+def assert_restored(store, restored):
+    manifest, parts = restored.snapshot()
+    assert manifest == store.read_manifest()
+    assert (sparse.vstack(parts) != store.load()).nnz == 0
+
+
+def make_worker(hub, store, **options):
+    return hub_sync.HubSyncWorker(api=hub, segment_dir=store.directory, repo_id=REPO_ID,
+                                  backoff=0.001, **options)
+
+
+def test_marks_are_coalesced_into_one_sync(tmp_path):
+    hub = hub_sync.LocalHub(str(tmp_path / 'hub'))
+    store, writer = make_store(tmp_path)
+    worker = make_worker(hub, store)
+    for seed in range(1, 4):
+        append(writer, worker, make_rows(1, seed))
+
+    assert worker.flush()
+    assert worker.pending() == set()
+    assert worker.stats['syncs'] == 1
+    uploaded = [path for _, path in hub.calls]
+    assert uploaded.count('tfidf_segments/manifest.json') == 1
+    # The base written when the store was created is uploaded too
+    assert 'tfidf_segments/base-000001' in uploaded
+    assert_restored(store, restore(hub, tmp_path))
+
+    # Files already on the hub are not uploaded again
+    hub.calls.clear()
+    append(writer, worker, make_rows(1, seed=9))
+    assert worker.flush()
+    assert not any(path.startswith('tfidf_segments/base-') for _, path in hub.calls)
+
+
+def test_failed_uploads_are_retried_with_backoff(tmp_path):
+    hub = hub_sync.LocalHub(str(tmp_path / 'hub'), fail_times=2)
+    store, writer = make_store(tmp_path)
+    worker = make_worker(hub, store, max_retries=3)
+    append(writer, worker, make_rows(1, seed=1))
+
+    assert worker.flush()
+    assert worker.stats['retries'] == 2
+    assert worker.stats['failures'] == 0
+
+    # Failures beyond max_retries keep the marks queued for the next sync
+    hub.fail_times = 3
+    append(writer, worker, make_rows(1, seed=2))
+    assert not worker.flush()
+    assert worker.pending()
+    assert worker.stats['failures'] == 1
+    assert worker.flush()
+    assert worker.pending() == set()
+    assert_restored(store, restore(hub, tmp_path))
+
+
+def test_compaction_uploads_the_replacing_base(tmp_path):
+    hub = hub_sync.LocalHub(str(tmp_path / 'hub'))
+    store, writer = make_store(tmp_path, max_segments=2)
+    worker = make_worker(hub, store)
+    append(writer, worker, make_rows(2, seed=1))
+    assert worker.flush()
+
+    # The third append segment triggers a compaction into a new base
+    for seed in range(2, 5):
+        append(writer, worker, make_rows(2, seed))
+    manifest = store.read_manifest()
+    assert [segment['name'] for segment in manifest['segments']][0] != 'base-000001'
+    assert worker.flush()
+
+    restored = restore(hub, tmp_path)
+    assert_restored(store, restored)
+    assert restored.load().shape == (18, 50)
@@ -0,0 +1,31 @@
+"""
+The regex tokenizer against NLTK's Treebank word tokenizer on punctuation-free text.
+
+Usage:
+    python -m pytest tests/test_preprocessing.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from nltk.tokenize import NLTKWordTokenizer
+
+import preprocessing
+
+TEXTS = [
+    "the results cannot be reproduced without the raw data",
+    "Cannot gimme lemme gotta gonna wanna",
+    "we wanna",
+    "wanna\tgo",
+    "a wannabe gonnabe analysis",
+    "“quoted” ‘words’ and « guillemets »",
+    "",
+]
+
+
+@pytest.mark.parametrize('text', TEXTS)
+def test_fast_tokenize_matches_nltk(text):
+    text = text.translate(preprocessing.PUNCTUATION_TABLE)
+    assert preprocessing.fast_tokenize(text) == NLTKWordTokenizer().tokenize(text)
@@ -0,0 +1,59 @@
+"""
+POST /corpus: concurrent adds of the same report add it once.
+
+The checker is replaced by an in-memory corpus of exact texts, so the test
+only exercises the service's request handling and locking.
+
+Usage:
+    python -m pytest tests/test_service.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import service
+
+
+# Reports added so far, with a slow duplicate check that leaves room for a race
+class Corpus:
+    def __init__(self):
+        self.texts = []
+
+    def analyse_report(self, report, k=5, data=None, filters=None):
+        duplicate_of = self.texts.index(report) if report in self.texts else None
+        time.sleep(0.05)
+        return {'duplicate_of': duplicate_of, 'vector': None}
+
+    def add_report(self, report, vector=None, doc_id=None, submitter=None, course=None, timestamp=None):
+        self.texts.append(report)
+        return len(self.texts) - 1
+
+
+class Documents:
+    def get(self, row):
+        return {'row': row}
+
+
+async def post_twice(app, body):
+    async with TestClient(TestServer(app)) as client:
+        responses = await asyncio.gather(client.post('/corpus', json=body), client.post('/corpus', json=body))
+        return [(response.status, await response.json()) for response in responses]
+
+
+def test_concurrent_identical_adds(monkeypatch):
+    corpus = Corpus()
+    monkeypatch.setattr(service.checker, 'analyse_report', corpus.analyse_report)
+    monkeypatch.setattr(service.checker, 'add_report', corpus.add_report)
+    monkeypatch.setattr(service.documents, 'get_store', Documents)
+    monkeypatch.setattr(service.ScoringService, '_warm_up', staticmethod(lambda: None))
+
+    results = asyncio.run(post_twice(service.ScoringService(workers=2).app(), {'text': 'the same report'}))
+
+    assert sorted(status for status, _ in results) == [201, 409]
+    assert [body['row'] for _, body in results] == [0, 0]
+    assert corpus.texts == ['the same report']
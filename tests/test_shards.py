@@ -0,0 +1,98 @@
+"""
+search.get_index() with SEARCH_SHARDS > 1: searches keep working while appends swap the index.
+
+Usage:
+    python -m pytest tests/test_shards.py
+"""
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+import search
+import shards
+
+
+def make_rows(n_rows, seed, n_columns=40):
+    return normalize(sparse.random(n_rows, n_columns, density=0.3, format='csr', random_state=seed))
+
+
+# The parts of a corpus store and the version that changes on each append
+class Store:
+    def __init__(self, base):
+        self.parts = [base]
+        self.version = 1
+
+    def get_parts(self):
+        return list(self.parts), None
+
+    def append(self, rows):
+        self.parts.append(rows)
+        self.version += 1
+
+
+def test_old_index_still_searches_after_swap(monkeypatch):
+    monkeypatch.setattr(search, 'SHARDS', 3)
+    monkeypatch.setattr(search, '_index', None)
+    store = Store(make_rows(30, seed=0))
+    old = search.get_index(store)
+    store.append(make_rows(2, seed=1))
+    new = search.get_index(store)
+    assert isinstance(new, shards.ShardedIndex) and new is not old
+
+    queries = make_rows(4, seed=2)
+    assert old.search_many(queries, k=3)
+    # Closing a replaced index leaves the pool the new one uses running
+    old.close()
+    assert old.search_many(queries, k=3)
+    assert new.search_many(queries, k=3)
+    new.close()
+
+
+def test_search_while_get_index_swaps(monkeypatch):
+    monkeypatch.setattr(search, 'SHARDS', 3)
+    monkeypatch.setattr(search, '_index', None)
+    store = Store(make_rows(30, seed=0))
+    queries = make_rows(4, seed=99)
+    errors = []
+    done = threading.Event()
+
+    def reader():
+        try:
+            while not done.is_set():
+                index = search.get_index(store)
+                expected = search.SearchIndex(index_parts[index], None).search_many(queries, k=3)
+                found = index.search_many(queries, k=3)
+                assert [[row for row, _ in matches] for matches in found] == \
+                    [[row for row, _ in matches] for matches in expected]
+        except Exception as error:
+            errors.append(error)
+
+    # Parts behind each index generation, for the unsharded reference results
+    index_parts = {search.get_index(store): list(store.parts)}
+    original_from_parts = shards.ShardedIndex.from_parts
+
+    def from_parts(parts, *args, **kwargs):
+        index = original_from_parts(parts, *args, **kwargs)
+        index_parts[index] = list(parts)
+        return index
+
+    monkeypatch.setattr(shards.ShardedIndex, 'from_parts', from_parts)
+    threads = [threading.Thread(target=reader) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for seed in range(1, 30):
+        store.append(make_rows(1, seed))
+        search.get_index(store)
+    done.set()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert search.get_index(store).n_documents == 59
+    search.get_index(store).close()
@@ -1,53 +1,38 @@
-import nltk
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-import string
-from docx import Document
-import PyPDF2
-
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import re
+
 import numpy as np # Import numpy to access vstack
 from scipy.sparse import vstack # Import vstack for sparse matrices
 # Import necessary libraries
 import pickle
 from scipy import sparse  # Import the sparse module
-from huggingface_hub import hf_hub_download
+from preprocessing import get_preprocessor
+import extraction
+import mmap_matrix
+import fingerprint
+import metrics
 
-nltk.download('punkt')
-nltk.download('stopwords')
+# NLTK data is checked once, when the first preprocessor is built (see preprocessing.ensure_nltk_data).
+# scikit-learn and huggingface_hub are imported by the functions that use them, to keep imports fast.
 
-def preprocess(text):
-    # Lowercasing
-    # Check if the input is a string before calling lower()
-    if isinstance(text, str):
-        text = text.lower()
-    else:
-        # If not a string, potentially handle it (e.g., convert to string)
-        # or raise an error
-        text = ' '.join(text).lower()  # Joining list elements into a string
+def preprocess(text, tokenizer='nltk'):
+    # Lowercasing, punctuation and stopword removal with a precomputed pipeline
+    with metrics.timed('preprocess', characters=len(text)):
+        return get_preprocessor(tokenizer)(text)
 
-    
-    # Remove punctuation
-    text = text.translate(str.maketrans('', '', string.punctuation))
-    
-    # Tokenize text
-    words = word_tokenize(text)
-    
-    # Remove stopwords
-    stop_words = set(stopwords.words('english'))
-    words = [word for word in words if word not in stop_words]
-    
-    return ' '.join(words)
+# Preprocess many documents lazily, e.g. for bulk re-indexing
+def preprocess_many(texts, tokenizer='nltk'):
+    return get_preprocessor(tokenizer).preprocess_many(texts)
 
 # Calculation of the TF-IDF vectors from documents
 def get_tfidf_vectors(documents):
+    from sklearn.feature_extraction.text import TfidfVectorizer
     vectorizer = TfidfVectorizer()
     tfidf_matrix = vectorizer.fit_transform(documents)
     return tfidf_matrix
 
 # Check Similarity using new report vector and using reference vectors
 def check_similarity(new_report_vector, reference_vectors):
+    from sklearn.metrics.pairwise import cosine_similarity
     similarities = cosine_similarity(new_report_vector, reference_vectors)
     return similarities
 
@@ -61,9 +46,7 @@ def jaccard_similarity(doc1, doc2):
 
 # Read a Word file
 def read_word_file(file_path):
-    doc = Document(file_path)
-    guidelines = [p.text for p in doc.paragraphs if p.text]
-    return ' '.join(guidelines) 
+    return ' '.join(extraction.iter_docx_paragraphs(file_path))
 
 # Read a Text file
 def read_txt_file(file_path):
@@ -76,30 +59,24 @@ def read_txt_file(file_path):
     Returns:
         str: The contents of the file as a single string.
     """
-    with open(file_path, 'r', encoding='utf-8') as file:
-        lines = file.readlines()
-        # Join all lines into a single string, stripping newline characters
-        return ' '.join(line.strip() for line in lines if line.strip())
+    # Join all lines into a single string, stripping newline characters
+    return ' '.join(extraction.iter_txt_lines(file_path))
 
 
-# Reading a PDF document
+# Reading a PDF document, page by page with the file closed afterwards
 def read_pdf_file(file_path):
-    pdf_file = open(file_path, 'rb')
-    pdf_reader = PyPDF2.PdfReader(pdf_file)
-    guidelines = ''
-    for page_number in range(len(pdf_reader.pages)):
-        page = pdf_reader.pages[page_number]
-        guidelines += page.extract_text()
-    return ' '.join(guidelines)
-
-# Reading coursework guidelines (assumes it's either a PDF or a Word document)
+    return ' '.join(extraction.iter_pdf_pages(file_path))
+
+# Reading coursework guidelines or submissions (PDF, Word or text documents)
 def read_files(file_path):
     if file_path.endswith('.pdf'):
         return read_pdf_file(file_path)
     elif file_path.endswith('.docx'):
         return read_word_file(file_path)
+    elif file_path.endswith('.txt'):
+        return read_txt_file(file_path)
     else:
-        raise ValueError("Unsupported file format. Use PDF or Word files.") 
+        raise ValueError("Unsupported file format. Use PDF, Word or text files.")
 
 # Append new report to the existing TF-IDF matrix
 def append_to_tfidf_matrix(new_report, vectorizer, tfidf_matrix):
@@ -114,28 +91,34 @@ def save_tfidf_data(tfidf_matrix, vectorizer):
         pickle.dump(vectorizer, f)
         
 # Load the TF-IDF matrix and vectorizer
-def load_tfidf_data():
-    # If the local file is not in the system, pull from the huggingface.
-    repo_id = "Isuru0x01/plagiarism_checker_tfidf"
-    try:
-        tfidf_matrix = sparse.load_npz('tfidf_matrix.npz')
-        with open('tfidf_vectorizer.pkl', 'rb') as f:
-            vectorizer = pickle.load(f)
-    except:
-        # Download the TF-IDF matrix
-        matrix_path = hf_hub_download(repo_id=repo_id, filename="tfidf_matrix.npz")
-        tfidf_matrix = sparse.load_npz(matrix_path)
-
-        # Download the vectorizer
-        vectorizer_path = hf_hub_download(repo_id=repo_id, filename="tfidf_vectorizer.pkl")
-        with open(vectorizer_path, 'rb') as f:
-            vectorizer = pickle.load(f)
+def load_tfidf_data(matrix_path='tfidf_matrix.npz', vectorizer_path='tfidf_vectorizer.pkl', mmap_path='tfidf_matrix.mm'):
+    with metrics.timed('load_tfidf_data'):
+        # If the local file is not in the system, pull from the huggingface.
+        repo_id = "Isuru0x01/plagiarism_checker_tfidf"
+        try:
+            # Prefer the memory-mapped copy (see mmap_matrix.py), shared between processes
+            if mmap_matrix.is_mmap_matrix(mmap_path):
+                tfidf_matrix = mmap_matrix.load_mmap(mmap_path)
+            else:
+                tfidf_matrix = sparse.load_npz(matrix_path)
+            with open(vectorizer_path, 'rb') as f:
+                vectorizer = pickle.load(f)
+        except:
+            from huggingface_hub import hf_hub_download
+            # Download the TF-IDF matrix
+            matrix_path = hf_hub_download(repo_id=repo_id, filename="tfidf_matrix.npz")
+            tfidf_matrix = sparse.load_npz(matrix_path)
+
+            # Download the vectorizer
+            vectorizer_path = hf_hub_download(repo_id=repo_id, filename="tfidf_vectorizer.pkl")
+            with open(vectorizer_path, 'rb') as f:
+                vectorizer = pickle.load(f)
             
     return tfidf_matrix, vectorizer
 
 # Check similarity between a new report and existing reports
 def check_similarity(new_report, reference_vectors, vectorizer, threshold=0.8):
-    
+    from sklearn.metrics.pairwise import cosine_similarity
     new_report_vector = vectorizer.transform([preprocess(new_report)])
     similarities = cosine_similarity(new_report_vector, reference_vectors)
     
@@ -150,35 +133,67 @@ def add_report_to_tfidf(new_report, documents, vectorizer):
     tfidf_matrix = vectorizer.fit_transform(documents)  # Refit the vectorizer to include the new report
     return tfidf_matrix
 
-def highlight_similar_text(new_report, reference_report, vectorizer):
+# Wrap character spans of a text in bold markers, merging overlapping spans
+def highlight_spans(text, spans):
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    pieces, position = [], 0
+    for start, end in merged:
+        pieces.append(text[position:start])
+        pieces.append(f"**{text[start:end]}**")
+        position = end
+    pieces.append(text[position:])
+    return ''.join(pieces)
+
+def highlight_similar_text(new_report, reference_report, vectorizer, passages=True):
     """
-    Highlight similar text between new report and reference report
+    Highlight similar text between new report and reference report.
+
+    With passages=True, passages copied from the reference (found through
+    shingle fingerprints) are highlighted when there are any; otherwise the
+    individual words the two reports share are highlighted.
     """
-    # Store original case version for highlighting
-    original_report = new_report
-    
-    # Preprocess reports for vectorization
-    new_report_proc = preprocess(new_report)
-    reference_report_proc = preprocess(reference_report)
-    
-    # Vectorize preprocessed reports
-    new_report_vector = vectorizer.transform([new_report_proc]).toarray()[0]
-    reference_report_vector = vectorizer.transform([reference_report_proc]).toarray()[0]
-    
-    # Get the feature names (words)
-    feature_names = vectorizer.get_feature_names_out()
-    
-    # Find matching terms
-    matching_indices = np.where((new_report_vector > 0) & (reference_report_vector > 0))[0]
-    matching_words = [feature_names[i] for i in matching_indices]
-    
-    # Sort matching words by length (longest first) to avoid partial word replacements
-    matching_words.sort(key=len, reverse=True)
-    
-    # Create case-insensitive pattern for each word
-    highlighted_report = original_report
-    for word in matching_words:
-        pattern = re.compile(re.escape(word), re.IGNORECASE)
-        highlighted_report = pattern.sub(lambda m: f"**{m.group()}**", highlighted_report)
-    
-    return highlighted_report, matching_words
\ No newline at end of file
+    with metrics.timed('highlight', characters=len(new_report)):
+        if passages:
+            copied = fingerprint.compare(new_report, reference_report)
+            if copied:
+                matching_passages = [reference_report[p.reference_start:p.reference_end] for p in copied]
+                return highlight_spans(new_report, [(p.query_start, p.query_end) for p in copied]), matching_passages
+
+        spans = similar_word_spans(new_report, reference_report, vectorizer)
+        highlighted_report = highlight_spans(new_report, [(start, end) for start, end, _ in spans])
+
+        # Sort matching words by length (longest first), as callers have always received them
+        matching_words = sorted({word for _, _, word in spans}, key=len, reverse=True)
+        return highlighted_report, matching_words
+
+def similar_word_spans(new_report, reference_report, vectorizer):
+    """
+    Finds the words of new_report whose vocabulary terms also occur in
+    reference_report.
+
+    The shared terms come from intersecting the sparse column indices of the
+    two vectors, and the report is scanned once with the vectorizer's own
+    token pattern, so the cost is linear in the report length.
+
+    Returns:
+        list: (start, end, term) tuples in text order, for UI rendering.
+    """
+    new_report_vector = vectorizer.transform([preprocess(new_report)])
+    reference_report_vector = vectorizer.transform([preprocess(reference_report)])
+    shared_terms = set(np.intersect1d(new_report_vector.indices, reference_report_vector.indices).tolist())
+    if not shared_terms:
+        return []
+
+    vocabulary = vectorizer.vocabulary_
+    token_pattern = re.compile(vectorizer.token_pattern)
+    spans = []
+    for match in token_pattern.finditer(new_report):
+        term = match.group().lower()
+        if vocabulary.get(term) in shared_terms:
+            spans.append((match.start(), match.end(), term))
+    return spans